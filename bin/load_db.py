@@ -5,54 +5,206 @@ Script to create and load CcdVisit, Object, and ForcedSource tables.
 from __future__ import absolute_import, print_function, division
 import os
 import sys
+import shutil
+import socket
+import tempfile
 from warnings import filterwarnings
 from collections import OrderedDict
 import lsst.log as lsst_log
 import desc.pserv
 import desc.pserv.utils as pserv_utils
+import desc.pserv.pipeline as pserv_pipeline
+import desc.pserv.sharding as pserv_sharding
 
 lsst_log.setLevel(lsst_log.getDefaultLoggerName(), lsst_log.INFO)
 
 # Suppress warnings from database module.
 filterwarnings('ignore')
 
-def ingest_forced_catalogs(connection, repo_info, project, tract=0,
-                           dry_run=False):
+def _delete_previous_rows(connection, table_names, ccdVisitId, project):
     """
-    Ingest forced source catalogs into ForcedSource table.  The
-    CcdVisit table must be filled first so that the zero point flux
-    can be retrieved.
+    Delete the rows of a forced source catalog left by an earlier
+    ingest, so that a changed or partially loaded catalog can be
+    reloaded.  'LOAD DATA LOCAL INFILE' would otherwise skip the rows
+    with duplicate keys.
+    """
+    for table_name in table_names:
+        connection.apply("""delete from %s where ccdVisitId=%i
+                            and project='%s'"""
+                         % (table_name, ccdVisitId, project))
+
+def forced_catalogs(repo_info, tract=0):
+    """
+    List the forced source catalogs for all of the visits and sensors
+    of a repository.
+
+    Returns
+    -------
+    list
+        (visit_name, raft, sensor, ccdVisitId, catalog_file) tuples.
     """
-    visits = repo_info.get_visits()
     sensors = repo_info.get_sensors()
-    failed_ingests = OrderedDict()
-    for band, visit_list in visits.items():
-        print("Processing band", band, "for", len(visit_list), "visits.")
-        sys.stdout.flush()
+    catalogs = []
+    for band, visit_list in repo_info.get_visits().items():
         for visitId in visit_list:
+            visit_name = 'v%i-f%s' % (visitId, band)
             for raft, sensor in sensors:
                 ccdVisitId = pserv_utils.make_ccdVisitId(visitId, raft, sensor)
-                query = 'select zeroPoint from CcdVisit where ccdVisitId=%i' \
-                        % ccdVisitId
-                zeroPoint = connection.apply(query,
-                                             lambda c: [x[0] for x in c][0])
-                flux_calibrator = pserv_utils.FluxCalibrator(zeroPoint)
-                visit_name = 'v%i-f%s' % (visitId, band)
                 catalog_file = os.path.join(repo_info.repo, 'forced',
                                             str(tract), visit_name,
                                             'R'+raft[:3:2],
                                             'S'+sensor[:3:2]+'.fits')
-                print("Processing", visit_name, 'R'+raft, 'S'+sensor)
+                catalogs.append((visit_name, raft, sensor, ccdVisitId,
+                                 catalog_file))
+    return catalogs
+
+def ingest_forced_catalogs(connection, repo_info, project, tract=0,
+                           dry_run=False, use_fifo=False, processes=0,
+                           loaders=1, queue_depth=4, extras=False,
+                           manifest=None, catalogs=None, loaded=None):
+    """
+    Ingest forced source catalogs into ForcedSource table.  The
+    CcdVisit table must be filled first so that the zero point flux
+    can be retrieved.  Catalogs without a zero point are skipped and
+    reported in the returned failures, which are keyed by catalog
+    file.  If extras is True, the ForcedSourceExtra table is filled
+    from the same read of each catalog.  If processes > 0, the
+    catalogs are converted by that many worker processes while
+    loaders threads load them (see
+    desc.pserv.pipeline.ingest_pipelined).  If a
+    desc.pserv.IngestManifest is given, catalogs that it records as
+    loaded and unchanged are skipped, and the outcome of each ingest
+    is recorded in it.  The catalogs to ingest default to those of
+    forced_catalogs(repo_info, tract), but a subset can be given,
+    e.g., a shard from desc.pserv.sharding.select_shard, or a
+    desc.pserv.sharding.WorkQueue, from which the catalogs are claimed
+    as they are ingested.  If a dict is given as loaded, the numbers
+    of rows loaded into each table are added to it, keyed by catalog
+    file.  use_fifo is only supported for the serial ingest of the
+    ForcedSource table alone, so a ValueError is raised if it is
+    combined with extras.
+    """
+    if use_fifo and extras:
+        raise ValueError('use_fifo cannot be combined with extras.')
+    table_names = ['ForcedSource']
+    if extras:
+        table_names.append('ForcedSourceExtra')
+    if catalogs is None:
+        catalogs = forced_catalogs(repo_info, tract)
+    if loaded is None:
+        loaded = dict()
+    zero_points = pserv_utils.ZeroPointLookup(connection, project)
+    failed_ingests = OrderedDict()
+    jobs = []
+    num_skipped = [0]
+
+    def record_failed(catalog_file, tables, eobj):
+        failed_ingests[catalog_file] = eobj
+        if manifest is not None and not dry_run:
+            for table_name in tables:
+                manifest.record_failed(catalog_file, table_name, eobj)
+
+    def record_loaded(catalog_file, table_name, nrows):
+        loaded.setdefault(catalog_file, OrderedDict())[table_name] = nrows
+        if manifest is not None:
+            manifest.record_loaded(catalog_file, table_name, nrows)
+
+    def pending_catalogs():
+        # Generator of the catalogs to ingest, so that catalogs are
+        # only claimed from a WorkQueue when they are ready to be
+        # processed.
+        for visit_name, raft, sensor, ccdVisitId, catalog_file in catalogs:
+            pending = table_names
+            if manifest is not None:
+                pending = manifest.pending(catalog_file, table_names)
+                if not pending:
+                    num_skipped[0] += 1
+                    continue
+            flux_calibrator = zero_points.calibrator(ccdVisitId)
+            if flux_calibrator is None:
+                message = 'No zeroPoint in CcdVisit for ccdVisitId %i' \
+                          % ccdVisitId
+                print("Skipping", visit_name, 'R'+raft, 'S'+sensor + ':',
+                      message)
                 sys.stdout.flush()
-                if not dry_run:
-                    try:
-                        pserv_utils.ingest_ForcedSource_data(connection,
-                                                             catalog_file,
-                                                             ccdVisitId,
-                                                             flux_calibrator,
-                                                             project)
-                    except Exception as eobj:
-                        failed_ingests[visit_name] = eobj
+                record_failed(catalog_file, pending, RuntimeError(message))
+                continue
+            print("Processing", visit_name, 'R'+raft, 'S'+sensor)
+            sys.stdout.flush()
+            if manifest is not None and not dry_run:
+                try:
+                    _delete_previous_rows(
+                        connection, [x for x in pending
+                                     if manifest.entry(catalog_file, x)],
+                        ccdVisitId, project)
+                except Exception as eobj:
+                    record_failed(catalog_file, pending, eobj)
+                    continue
+            yield ccdVisitId, catalog_file, pending, flux_calibrator
+
+    def pipeline_jobs():
+        for ccdVisitId, catalog_file, pending, flux_calibrator \
+                in pending_catalogs():
+            targets = []
+            for table_name in pending:
+                column_mapping, callbacks \
+                    = pserv_utils.forced_source_mappings[table_name](
+                        ccdVisitId, flux_calibrator, project)
+                targets.append(pserv_pipeline.TableTarget(
+                    table_name, column_mapping, callbacks))
+            jobs.append(pserv_pipeline.MultiTableJob(catalog_file,
+                                                     catalog_file, targets))
+            yield jobs[-1]
+
+    if dry_run:
+        for _ in pending_catalogs():
+            pass
+    elif processes > 0:
+        failures = pserv_pipeline.ingest_pipelined(
+            connection, pipeline_jobs(), processes=processes,
+            loaders=loaders, queue_depth=queue_depth,
+            on_loaded=lambda job, table_name, nrows:
+            record_loaded(job.fits_file, table_name, nrows))
+        for job in jobs:
+            if job.name in failures:
+                record_failed(job.fits_file,
+                              [x.table_name for x in job.targets
+                               if x.table_name not in loaded.get(job.name,
+                                                                 ())],
+                              failures[job.name])
+    else:
+        # Write the csv files in a directory for this run, so that
+        # concurrent runs in the same working directory, e.g., the
+        # shards of a job array, do not overwrite each other's files.
+        csv_dir = tempfile.mkdtemp(prefix='load_db_', dir='.')
+        csv_prefix = os.path.join(csv_dir, 'temp')
+        try:
+            for ccdVisitId, catalog_file, pending, flux_calibrator \
+                    in pending_catalogs():
+                try:
+                    if pending != ['ForcedSource']:
+                        nrows = pserv_utils.ingest_forced_source_tables(
+                            connection, catalog_file, ccdVisitId,
+                            flux_calibrator, project, table_names=pending,
+                            csv_prefix=csv_prefix)
+                    else:
+                        nrows = {'ForcedSource':
+                                 pserv_utils.ingest_ForcedSource_data(
+                                     connection, catalog_file, ccdVisitId,
+                                     flux_calibrator, project,
+                                     csv_file=csv_prefix + '.csv',
+                                     use_fifo=use_fifo)}
+                    for table_name in pending:
+                        record_loaded(catalog_file, table_name,
+                                      nrows[table_name])
+                except Exception as eobj:
+                    record_failed(catalog_file, pending, eobj)
+        finally:
+            shutil.rmtree(csv_dir, ignore_errors=True)
+    if num_skipped[0] > 0:
+        print("Skipped", num_skipped[0], "catalogs recorded as loaded in",
+              manifest.manifest_file)
+        sys.stdout.flush()
     return failed_ingests
 
 if __name__ == '__main__':
@@ -71,35 +223,170 @@ Source tables with Level 2 pipeline output."""
                         help='Port used by the database host')
     parser.add_argument('--dry_run', default=False, action='store_true',
                         help='Do not execute queries')
+    parser.add_argument('--use_fifo', default=False, action='store_true',
+                        help='Stream csv data through a named pipe instead '
+                        + 'of writing temporary csv files.  This cannot be '
+                        + 'combined with --extras')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Print a summary of the time spent in each '
+                        + 'kind of SQL statement at exit')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Number of processes for reading calexps and '
+                        + 'for converting forced source catalogs '
+                        + 'concurrently with loading them')
+    parser.add_argument('--loaders', type=int, default=1,
+                        help='Number of loader threads for use with '
+                        + '--processes')
+    parser.add_argument('--queue_depth', type=int, default=4,
+                        help='Maximum number of converted catalogs waiting '
+                        + 'to be loaded for use with --processes')
+    parser.add_argument('--extras', default=False, action='store_true',
+                        help='Also fill the ForcedSourceExtra table from '
+                        + 'the same read of each forced source catalog')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='SQLite file in which to record the ingested '
+                        + 'catalogs.  Catalogs that it records as loaded '
+                        + 'and unchanged are skipped, so that an '
+                        + 'interrupted ingest can be resumed')
+    parser.add_argument('--checksums', default=False, action='store_true',
+                        help='Also compare md5 checksums of the catalogs '
+                        + 'recorded in the manifest')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='Number of shards into which the forced source '
+                        + 'catalogs are divided, balanced by file size, '
+                        + 'e.g., the number of tasks in a Slurm job array.  '
+                        + 'Sharded runs only ingest the forced source '
+                        + 'catalogs, so the CcdVisit and Object tables must '
+                        + 'be filled beforehand')
+    parser.add_argument('--shard_index', type=int, default=None,
+                        help='Index of the shard to ingest, e.g., '
+                        + '$SLURM_ARRAY_TASK_ID.  This is also the label of '
+                        + 'the results file written to --results_dir')
+    parser.add_argument('--work_queue', type=str, default=None,
+                        help='Lock file, on a shared file system, through '
+                        + 'which concurrent runs claim forced source '
+                        + 'catalogs one at a time instead of using fixed '
+                        + 'shards.  It must not exist at the start of the '
+                        + 'ingest')
+    parser.add_argument('--results_dir', type=str, default=None,
+                        help='Directory in which to write the loaded and '
+                        + 'failed catalogs of this run for --merge_results')
+    parser.add_argument('--merge_results', default=False, action='store_true',
+                        help='Merge and print the results in --results_dir '
+                        + 'of the runs for all of the shards, then exit')
+    parser.add_argument('--sky_noise_stride', type=int, default=None,
+                        help='Estimate the calexp sky noise from every '
+                        + 'n-th pixel in each direction')
+    parser.add_argument('--calexp_metadata_only', default=False,
+                        action='store_true',
+                        help='Read only the calibration, WCS, and PSF of '
+                        + 'the calexps and do not compute the sky noise')
     args = parser.parse_args()
+    sharded = args.num_shards > 1 or args.work_queue is not None
+    if args.num_shards > 1 and args.shard_index is None:
+        parser.error('--shard_index is needed for --num_shards > 1')
+    if args.merge_results and args.results_dir is None:
+        parser.error('--merge_results needs --results_dir')
+    if args.use_fifo and args.extras:
+        parser.error('--use_fifo cannot be combined with --extras')
+
+    if args.merge_results:
+        loaded, failures, shards \
+            = pserv_sharding.merge_shard_results(args.results_dir)
+        for name, error in failures.items():
+            print(name, error)
+        print("%i shards: %i catalogs loaded with %i rows, %i failed"
+              % (len(shards), len(loaded),
+                 sum(nrows or 0 for x in loaded.values()
+                     for nrows in x.values()),
+                 len(failures)))
+        sys.exit(0)
 
     repo_info = desc.pserv.RepositoryInfo(args.repo)
 
     connect = desc.pserv.DbConnection(database=args.database,
                                       host=args.host,
                                       port=args.port)
+    if args.profile:
+        connect.enable_instrumentation().dump_at_exit()
+
+    manifest = None
+    if args.manifest is not None:
+        manifest = desc.pserv.IngestManifest(args.manifest,
+                                             use_checksums=args.checksums)
 
-    if args.dry_run:
+    if sharded:
+        print("Ingesting forced source catalogs only for a sharded run")
+    elif args.dry_run:
         print("Ingest registry file", repo_info.registry_file)
         print("Ingest calexp info")
     else:
         pserv_utils.ingest_registry(connect, repo_info.registry_file,
                                     args.project)
-        pserv_utils.ingest_calexp_info(connect, args.repo, args.project)
+        pserv_utils.ingest_calexp_info(connect, args.repo, args.project,
+                                       processes=max(args.processes, 1),
+                                       sky_noise_stride=args.sky_noise_stride,
+                                       metadata_only=args.calexp_metadata_only)
 
-    patches = repo_info.get_patches()
+    patches = repo_info.get_patches() if not sharded else {}
     for tract, patch_list in patches.items():
         for patch in patch_list:
             object_catalog \
                 = os.path.join(args.repo, 'deepCoadd-results/merged',
                                str(tract), patch,
                                'ref-%(tract)s-%(patch)s.fits' % locals())
-            if args.dry_run:
+            if (manifest is not None
+                    and not manifest.needs_ingest(object_catalog, 'Object')):
+                print("Skipping loaded object catalog", object_catalog)
+            elif args.dry_run:
                 print("Ingest object catalog", object_catalog)
             else:
-                pserv_utils.ingest_Object_data(connect, object_catalog,
-                                               args.project)
+                try:
+                    nobjs = pserv_utils.ingest_Object_data(connect,
+                                                           object_catalog,
+                                                           args.project)
+                except Exception as eobj:
+                    if manifest is not None:
+                        manifest.record_failed(object_catalog, 'Object',
+                                               eobj)
+                    raise
+                if manifest is not None:
+                    manifest.record_loaded(object_catalog, 'Object', nobjs)
+
+    # Build the full work list, with the largest catalogs first, and
+    # select the part of it for this run.
+    catalogs = forced_catalogs(repo_info)
+    catalogs, sizes = pserv_sharding.order_by_size(
+        catalogs, pserv_sharding.file_sizes([x[-1] for x in catalogs]))
+    if args.work_queue is not None:
+        catalogs = pserv_sharding.WorkQueue(args.work_queue, catalogs)
+    elif args.num_shards > 1:
+        catalogs = pserv_sharding.select_shard(catalogs, sizes,
+                                               args.shard_index,
+                                               args.num_shards)
+        print("Shard %i of %i:" % (args.shard_index, args.num_shards),
+              len(catalogs), "catalogs")
 
+    loaded = OrderedDict()
     failures = ingest_forced_catalogs(connect, repo_info, args.project,
-                                      dry_run=args.dry_run)
+                                      dry_run=args.dry_run,
+                                      use_fifo=args.use_fifo,
+                                      processes=args.processes,
+                                      loaders=args.loaders,
+                                      queue_depth=args.queue_depth,
+                                      extras=args.extras,
+                                      manifest=manifest,
+                                      catalogs=catalogs,
+                                      loaded=loaded)
     print(failures)
+    if args.results_dir is not None and not args.dry_run:
+        shard = args.shard_index
+        if shard is None:
+            shard = '%s_%i' % (socket.gethostname(), os.getpid())
+        pserv_sharding.write_shard_results(args.results_dir, shard,
+                                           loaded, failures)
+    if manifest is not None:
+        for (table_name, status), (count, nrows) \
+                in manifest.summary().items():
+            print(table_name, status, count, "catalogs", nrows or 0, "rows")
+        manifest.close()
@@ -9,69 +9,95 @@ from warnings import filterwarnings
 from collections import OrderedDict
 import desc.pserv
 import desc.pserv.utils as pserv_utils
+import desc.pserv.pipeline as pserv_pipeline
 
 # Suppress warnings from database module.
 filterwarnings('ignore')
 
 def ingest_forced_src_extras(connection, repo_info, project, tract=0,
                              fits_hdunum=1, csv_file='temp.csv',
-                             dry_run=True):
-    column_mapping =\
-        OrderedDict((('objectId', 'objectId'),
-                     ('ccdVisitId', None),
-                     ('ap_3_0_Flux', 'base_CircularApertureFlux_3_0_flux'),
-                     ('ap_3_0_Flux_Sigma', 'base_CircularApertureFlux_3_0_fluxSigma'),
-                     ('ap_9_0_Flux', 'base_CircularApertureFlux_9_0_flux'),
-                     ('ap_9_0_Flux_Sigma', 'base_CircularApertureFlux_9_0_fluxSigma'),
-                     ('ap_17_0_Flux', 'base_CircularApertureFlux_17_0_flux'),
-                     ('ap_17_0_Flux_Sigma', 'base_CircularApertureFlux_17_0_fluxSigma'),
-                     ('ap_25_0_Flux', 'base_CircularApertureFlux_25_0_flux'),
-                     ('ap_25_0_Flux_Sigma', 'base_CircularApertureFlux_25_0_fluxSigma'),
-                     ('ap_50_0_Flux', 'base_CircularApertureFlux_50_0_flux'),
-                     ('ap_50_0_Flux_Sigma', 'base_CircularApertureFlux_50_0_fluxSigma'),
-                     ('flags', 0),
-                     ('project', project)))
+                             dry_run=True, use_fifo=False, processes=0):
+    """
+    Ingest the aperture fluxes from the forced source catalogs into
+    the ForcedSourceExtra table.  Catalogs without a zero point in
+    the CcdVisit table are skipped and reported in the returned
+    failures, which are keyed by catalog file.  If processes > 0, the
+    catalogs are converted to csv files by that many worker processes
+    and loaded as they are completed.
+    """
     visits = repo_info.get_visits()
     sensors = repo_info.get_sensors()
+    zero_points = pserv_utils.ZeroPointLookup(connection, project)
     failed_ingests = OrderedDict()
+    jobs = []
     for band, visit_list in visits.items():
         print("Processing band", band, "for", len(visit_list), "visits.")
         sys.stdout.flush()
         for visitId in visit_list:
             visit_name = 'v%i-f%s' % (visitId, band)
             for raft, sensor in sensors:
-                print("Processing", visit_name, 'R'+raft, 'S'+sensor)
-                sys.stdout.flush()
                 ccdVisitId = pserv_utils.make_ccdVisitId(visitId, raft, sensor)
-                column_mapping['ccdVisitId'] = ccdVisitId
-                query = 'select zeroPoint from CcdVisit where ccdVisitId=%i' \
-                        % ccdVisitId
-                zeroPoint =\
-                        connection.apply(query,
-                                         lambda curs: [x[0] for x in curs][0])
-                flux_calibrator = pserv_utils.FluxCalibrator(zeroPoint)
-                callbacks = {}
-                for value in column_mapping.values():
-                    if str(value).startswith('base_'):
-                        callbacks[value] = flux_calibrator
                 catalog_file = os.path.join(repo_info.repo, 'forced',
                                             str(tract), visit_name,
                                             'R'+raft[:3:2],
                                             'S'+sensor[:3:2]+'.fits')
-                if not dry_run:
+                flux_calibrator = zero_points.calibrator(ccdVisitId)
+                if flux_calibrator is None:
+                    message = 'No zeroPoint in CcdVisit for ccdVisitId %i' \
+                              % ccdVisitId
+                    print("Skipping", visit_name, 'R'+raft, 'S'+sensor + ':',
+                          message)
+                    sys.stdout.flush()
+                    failed_ingests[catalog_file] = RuntimeError(message)
+                    continue
+                print("Processing", visit_name, 'R'+raft, 'S'+sensor)
+                sys.stdout.flush()
+                column_mapping, callbacks \
+                    = pserv_utils.make_ForcedSourceExtra_mapping(
+                        ccdVisitId, flux_calibrator, project)
+                if processes > 0:
+                    jobs.append(pserv_pipeline.ConversionJob(
+                        catalog_file, column_mapping, callbacks,
+                        fits_hdunum=fits_hdunum))
+                elif not dry_run:
                     try:
-                        desc.pserv.create_csv_file_from_fits(catalog_file,
-                                                             fits_hdunum,
-                                                             csv_file,
-                                                             column_mapping=column_mapping,
-                                                             callbacks=callbacks)
+                        if use_fifo:
+                            csv_text = desc.pserv.csv_text_from_fits(
+                                catalog_file, fits_hdunum,
+                                column_mapping=column_mapping,
+                                callbacks=callbacks)
+                            connection.load_csv_stream('ForcedSourceExtra',
+                                                       csv_text)
+                            continue
+                        desc.pserv.create_csv_file_from_fits(
+                            catalog_file, fits_hdunum, csv_file,
+                            column_mapping=column_mapping,
+                            callbacks=callbacks)
                         connection.load_csv('ForcedSourceExtra', csv_file)
                         try:
                             os.remove(csv_file)
-                        except OSerror:
+                        except OSError:
                             pass
                     except Exception as eobj:
-                        failed_ingests[visit_name] = eobj
+                        failed_ingests[catalog_file] = eobj
+    if jobs and not dry_run:
+        for result in pserv_pipeline.convert_catalogs(jobs,
+                                                      processes=processes):
+            try:
+                if result.error is not None:
+                    raise result.error
+                connection.load_csv('ForcedSourceExtra', result.output)
+                print("Loaded", result.job.fits_file)
+                sys.stdout.flush()
+            except Exception as eobj:
+                failed_ingests[result.job.fits_file] = eobj
+            finally:
+                # The outputs of failed conversions have been removed.
+                if result.error is None:
+                    try:
+                        os.remove(result.output)
+                    except OSError:
+                        pass
     return failed_ingests
 
 if __name__ == '__main__':
@@ -91,6 +117,15 @@ if __name__ == '__main__':
                         help='Drop existing table and recreate')
     parser.add_argument('--dry_run', default=False, action='store_true',
                         help='Do not execute queries')
+    parser.add_argument('--use_fifo', default=False, action='store_true',
+                        help='Stream csv data through a named pipe instead '
+                        + 'of writing temporary csv files')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Print a summary of the time spent in each '
+                        + 'kind of SQL statement at exit')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='Number of processes for converting forced '
+                        + 'source catalogs in parallel')
     args = parser.parse_args()
 
     repo_info = desc.pserv.RepositoryInfo(args.repo)
@@ -98,10 +133,14 @@ if __name__ == '__main__':
     connect = desc.pserv.DbConnection(database=args.database,
                                       host=args.host,
                                       port=args.port)
+    if args.profile:
+        connect.enable_instrumentation().dump_at_exit()
 
     pserv_utils.create_table(connect, 'ForcedSourceExtra',
                              dry_run=args.dry_run, clobber=args.clobber)
 
     failures = ingest_forced_src_extras(connect, repo_info, args.project,
-                                        dry_run=args.dry_run)
+                                        dry_run=args.dry_run,
+                                        use_fifo=args.use_fifo,
+                                        processes=args.processes)
     print(failures)
@@ -2,17 +2,43 @@
 Pserv: Practice LSST database server code.
 """
 from __future__ import absolute_import, print_function
+import os
 import copy
 import csv
+import itertools
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from collections import OrderedDict
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
 import numpy as np
 import pandas as pd
 import astropy.io.fits as fits
 import sqlalchemy
+import MySQLdb.cursors
+from MySQLdb.constants import FIELD_TYPE
 import lsst.daf.persistence as dp
+from .instrumentation import StatementStats
 
 __all__ = ['DbConnection', 'create_csv_file_from_fits',
-           'create_schema_from_fits', 'BinTableData']
+           'create_csv_files_from_fits', 'csv_text_from_fits', 'row_blocks_from_fits',
+           'csv_text_from_columns',
+           'create_schema_from_fits', 'BinTableData',
+           'get_engine', 'dispose_engines', 'StagingTable']
+
+# Process-wide registry of sqlalchemy engines, keyed by db url, so that
+# DbConnection objects for the same server share a connection pool.
+_engines = dict()
+_engines_lock = threading.Lock()
+
+# Cache of (username, password) tuples from DbAuth, keyed by (host, port).
+_credentials = dict()
 
 def null_func(*args):
     """
@@ -21,9 +47,237 @@ def null_func(*args):
     """
     return None
 
+def _batches(rows, batch_size):
+    """
+    Generator to split an iterable of rows into lists of at most
+    batch_size rows.
+    """
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+# numpy types for MySQL column types in query results.  Other column
+# types, e.g., BLOBs, are returned as python objects.
+_numpy_types = {FIELD_TYPE.TINY: np.int8,
+                FIELD_TYPE.SHORT: np.int16,
+                FIELD_TYPE.INT24: np.int32,
+                FIELD_TYPE.LONG: np.int32,
+                FIELD_TYPE.LONGLONG: np.int64,
+                FIELD_TYPE.FLOAT: np.float32,
+                FIELD_TYPE.DOUBLE: np.float64,
+                FIELD_TYPE.DECIMAL: np.float64,
+                FIELD_TYPE.NEWDECIMAL: np.float64,
+                FIELD_TYPE.TIMESTAMP: 'datetime64[us]',
+                FIELD_TYPE.DATETIME: 'datetime64[us]',
+                FIELD_TYPE.DATE: 'datetime64[D]'}
+
+_string_types = (FIELD_TYPE.STRING, FIELD_TYPE.VAR_STRING,
+                 FIELD_TYPE.VARCHAR)
+
+def _result_dtype(description, dtype=None):
+    """
+    Build a numpy structured dtype for a query result.
+
+    Parameters
+    ----------
+    description : sequence
+        The DBAPI 2 cursor.description of the query result.
+    dtype : numpy.dtype, list, or dict, optional
+        An explicit dtype to use for the result.  If a dict, it is
+        used to override the numpy types, keyed by column name, that
+        are otherwise inferred from the MySQL column types.
+        Default: None
+
+    Returns
+    -------
+    numpy.dtype
+        The structured dtype.
+    """
+    if dtype is not None and not isinstance(dtype, dict):
+        dtype = np.dtype(dtype)
+        if len(dtype.names) != len(description):
+            raise RuntimeError('Number of fields in dtype does not match '
+                               + 'the number of columns in the query.')
+        return dtype
+    overrides = dtype if dtype is not None else {}
+    fields = []
+    for column in description:
+        name, type_code, length = column[0], column[1], column[3]
+        if name in overrides:
+            fields.append((name, overrides[name]))
+        elif type_code in _string_types:
+            fields.append((name, 'U%i' % max(length, 1)))
+        else:
+            fields.append((name, _numpy_types.get(type_code, object)))
+    return np.dtype(fields)
+
+def _get_credentials(host, port):
+    """
+    Get the username and password for the specified host and port
+    using lsst.daf.persistence.DbAuth, caching the results.
+
+    Parameters
+    ----------
+    host : str
+        The database host.
+    port : str
+        The port used by the database host.
+
+    Returns
+    -------
+    tuple
+        (username, password)
+    """
+    key = (host, str(port))
+    try:
+        return _credentials[key]
+    except KeyError:
+        pass
+    # Use lsst.daf.persistence.DbAuth to get username and password
+    # from ~/.lsst/db-auth.paf
+    _credentials[key] = (dp.DbAuth.username(*key), dp.DbAuth.password(*key))
+    return _credentials[key]
+
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """
+    Pool checkout listener to check that a pooled connection is still
+    alive.  Raising DisconnectionError causes the pool to discard the
+    stale connection and retry with a fresh one.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('select 1')
+    except Exception:
+        raise sqlalchemy.exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+def get_engine(db_url, pool_size=5, max_overflow=10, pool_recycle=3600):
+    """
+    Get the sqlalchemy engine for the specified db url from the
+    process-wide registry, creating it if needed.
+
+    Parameters
+    ----------
+    db_url : sqlalchemy.engine.url.URL
+        The url of the database.
+    pool_size : int, optional
+        Number of connections to keep open in the pool.  Default: 5
+    max_overflow : int, optional
+        Number of connections that can be opened beyond pool_size
+        when the pool is exhausted.  Default: 10
+    pool_recycle : int, optional
+        Number of seconds after which a pooled connection is replaced
+        to avoid server-side timeouts.  Default: 3600
+
+    Returns
+    -------
+    sqlalchemy.engine.Engine
+        The engine managing the connection pool for db_url.
+
+    Notes
+    -----
+    The pool options are only used when the engine is created.
+    Engines are recorded with the id of the process that created
+    them, so that a child process forked from a process with open
+    connections gets its own pool rather than sharing sockets with
+    its parent.
+    """
+    key = str(db_url)
+    with _engines_lock:
+        try:
+            pid, engine = _engines[key]
+            if pid == os.getpid():
+                return engine
+        except KeyError:
+            pass
+        engine = sqlalchemy.create_engine(db_url, pool_size=pool_size,
+                                          max_overflow=max_overflow,
+                                          pool_recycle=pool_recycle)
+        sqlalchemy.event.listen(engine, 'checkout', _ping_connection)
+        _engines[key] = (os.getpid(), engine)
+        return engine
+
+def dispose_engines():
+    """
+    Close all pooled connections and clear the engine registry.
+    """
+    with _engines_lock:
+        for pid, engine in _engines.values():
+            if pid == os.getpid():
+                engine.dispose()
+        _engines.clear()
+
+class _FifoWriter(threading.Thread):
+    """
+    Thread to write chunks of text to a named pipe.  Any exception
+    raised while producing or writing the text is saved in the error
+    attribute.
+    """
+    def __init__(self, fifo, chunks):
+        """
+        Parameters
+        ----------
+        fifo : str
+            Path to the named pipe.
+        chunks : iterable
+            Strings to write to the named pipe.
+        """
+        super(_FifoWriter, self).__init__()
+        self.daemon = True
+        self.fifo = fifo
+        self.chunks = chunks
+        self.error = None
+
+    def run(self):
+        try:
+            with open(self.fifo, 'w') as output:
+                for chunk in self.chunks:
+                    output.write(chunk)
+        except Exception as eobj:
+            self.error = eobj
+
+    def finish(self):
+        """
+        Wait for the thread to finish.  If the reader has gone away
+        without consuming everything, opening and closing the read end
+        of the pipe releases a writer blocked in open() and makes any
+        further writes fail, so that the thread exits.
+        """
+        while self.is_alive():
+            fd = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                self.join(0.1)
+            finally:
+                os.close(fd)
+        self.join()
+
 class DbConnection(object):
     """
     Class to manage db connections using sqlalchemy and DbAuth.
+
+    Connections are checked out from a connection pool that is shared
+    by all DbConnection objects for the same database in a process.
+    The connection is checked back in to the pool by the close method
+    or on exit when the object is used as a context manager.
+
+    Attributes
+    ----------
+    autocommit : bool
+        If True, changes are committed after each write statement
+        outside of a transaction block.  If False, the commit method
+        must be called explicitly.  Changes that have not been committed
+        when the connection is closed are rolled back.
+    rowcount : int
+        The number of rows affected or returned by the last statement,
+        or -1 if not known.
+    stats : desc.pserv.StatementStats
+        If not None, the execution times and row counts of statements
+        and the commit times are recorded in this object.  See
+        enable_instrumentation.
     """
     def __init__(self, **kwds):
         """
@@ -34,21 +288,35 @@ class DbConnection(object):
         **kwds : **dict
             keyword arguments with the database info.  Minimally, this
             would include host (port=3306 by default), but can also
-            include the database name.
+            include the database name.  The connection pool options
+            pool_size, max_overflow, and pool_recycle of get_engine
+            and the autocommit policy (default: True) can also be given.
+            If instrument=True is given, then instrumentation is enabled.
         """
+        self._connect_kwds = copy.deepcopy(kwds)
+        self._schema_cache = dict()
+        self._load_sql_cache = dict()
+        self.autocommit = kwds.pop('autocommit', True)
+        self.stats = StatementStats() if kwds.pop('instrument', False) else None
+        self.rowcount = -1
+        self._in_transaction = False
+        self._commit_every = None
+        self._pending = 0
+        pool_kwds = dict()
+        for key in ('pool_size', 'max_overflow', 'pool_recycle'):
+            if key in kwds:
+                pool_kwds[key] = kwds.pop(key)
         if not kwds.has_key('port'):
             kwds['port'] = 3306
         if not kwds.has_key('query'): # enable LOAD LOCAL INFILE
             kwds['query'] = dict()
         kwds['query']['local_infile'] = 1
-        # Use lsst.daf.persistence.DbAuth to get username and password
-        # from ~/.lsst/db-auth.paf
-        kwds['username'] = dp.DbAuth.username(kwds['host'], str(kwds['port']))
-        kwds['password'] = dp.DbAuth.password(kwds['host'], str(kwds['port']))
+        kwds['username'], kwds['password'] \
+            = _get_credentials(kwds['host'], kwds['port'])
 
-        self._get_mysql_connection(kwds)
+        self._get_mysql_connection(kwds, **pool_kwds)
 
-    def _get_mysql_connection(self, kwds_par):
+    def _get_mysql_connection(self, kwds_par, **pool_kwds):
         """
         Set the self._mysql_connection attribute
 
@@ -56,6 +324,8 @@ class DbConnection(object):
         ----------
         kwds_par : dict
             Dictionary of connection info to pass to sqlalchemy.
+        **pool_kwds : **dict
+            Connection pool options to pass to get_engine.
         """
         kwds = copy.deepcopy(kwds_par)
         try:
@@ -69,10 +339,94 @@ class DbConnection(object):
         except KeyError:
             pass
 
-        # Create a new mysql connection object.
+        # Check out a mysql connection object from the pool.
         db_url = sqlalchemy.engine.url.URL('mysql+mysqldb', **kwds)
-        engine = sqlalchemy.create_engine(db_url)
-        self._mysql_connection = engine.raw_connection()
+        self._engine = get_engine(db_url, **pool_kwds)
+        self._mysql_connection = self._engine.raw_connection()
+
+    def close(self):
+        """
+        Check the connection back in to the pool.
+        """
+        if self._mysql_connection is not None:
+            self._mysql_connection.close()
+            self._mysql_connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def checkout(self):
+        """
+        Context manager that checks out another pooled connection to
+        the same database, e.g., for use in a worker thread, and
+        checks it back in on exit.
+
+        Yields
+        ------
+        DbConnection
+            A connection object sharing this object's connection pool.
+        """
+        connection = DbConnection(**self._connect_kwds)
+        connection.stats = self.stats
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def enable_instrumentation(self, stats=None):
+        """
+        Record the execution time and row count of each statement and
+        the time of each commit.
+
+        Parameters
+        ----------
+        stats : desc.pserv.StatementStats, optional
+            Object in which to record the statistics, e.g., to share it
+            with other connections.  If None, then a new one is created.
+            Default: None
+
+        Returns
+        -------
+        desc.pserv.StatementStats
+            The object in which the statistics are recorded.  Its
+            summary, to_json, and dump_at_exit methods can be used to
+            report the results.
+        """
+        self.stats = stats if stats is not None else StatementStats()
+        return self.stats
+
+    def _execute(self, cursor, sql, args=None, many=False):
+        """
+        Execute an SQL statement with a cursor, recording the execution
+        time and row count if instrumentation is enabled.
+
+        Parameters
+        ----------
+        cursor : DBAPI 2 cursor
+            The cursor to use.
+        sql : str
+            The SQL statement.
+        args : sequence, optional
+            Values to bind to the statement placeholders.  For
+            many=True, a sequence of such sequences.  Default: None
+        many : bool, optional
+            If True, use cursor.executemany.  Default: False
+        """
+        execute = cursor.executemany if many else cursor.execute
+        if self.stats is None:
+            execute(sql, args)
+            self.rowcount = cursor.rowcount
+            return
+        t0 = time.time()
+        try:
+            execute(sql, args)
+        finally:
+            self.stats.record(sql, time.time() - t0, cursor.rowcount)
+        self.rowcount = cursor.rowcount
 
     def apply(self, sql, cursorFunc=null_func):
         """
@@ -91,13 +445,124 @@ class DbConnection(object):
 
         """
         cursor = self._mysql_connection.cursor()
-        cursor.execute(sql)
+        self._execute(cursor, sql)
         results = cursorFunc(cursor)
         cursor.close()
         if cursorFunc is null_func:
-            self._mysql_connection.commit()
+            self._statement_done()
         return results
 
+    def commit(self):
+        """
+        Commit the pending changes.
+        """
+        t0 = time.time()
+        self._mysql_connection.commit()
+        if self.stats is not None:
+            self.stats.record_commit(time.time() - t0)
+        self._pending = 0
+
+    def rollback(self):
+        """
+        Roll back the pending changes.
+        """
+        self._mysql_connection.rollback()
+        self._pending = 0
+
+    def _statement_done(self, nwrites=1):
+        """
+        Commit after write statements according to the commit policy.
+
+        Parameters
+        ----------
+        nwrites : int, optional
+            Number of writes, e.g., statements or rows, that were
+            applied.  Default: 1
+        """
+        if self._in_transaction:
+            self._pending += nwrites
+            if (self._commit_every is not None
+                    and self._pending >= self._commit_every):
+                self.commit()
+        elif self.autocommit:
+            self.commit()
+
+    @contextmanager
+    def transaction(self, commit_every=None):
+        """
+        Context manager to group write statements into transactions.
+        The changes are committed on exit from the with block, or
+        rolled back if an exception is raised.
+
+        Parameters
+        ----------
+        commit_every : int, optional
+            If given, also commit whenever this many writes (statements,
+            or rows for apply_many) have been applied since the last
+            commit.  Changes committed this way are not rolled back if
+            an exception is raised later.  Default: None
+
+        Notes
+        -----
+        Nested transaction blocks are merged into the outermost one.
+        """
+        if self._in_transaction:
+            yield self
+            return
+        self._in_transaction = True
+        self._commit_every = commit_every
+        self._pending = 0
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        else:
+            self.commit()
+        finally:
+            self._in_transaction = False
+            self._commit_every = None
+
+    def apply_many(self, sql, rows, batch_size=1000):
+        """
+        Apply a parameterized SQL statement to a sequence of rows of
+        values using the DBAPI 2 executemany method.
+
+        Parameters
+        ----------
+        sql : str
+            An SQL statement with %s placeholders for the values, e.g.,
+            'insert into CcdVisit (ccdVisitId, visitId) values (%s, %s)'.
+        rows : iterable
+            Tuples of values to bind to the placeholders.  numpy scalars
+            should be converted to python types, e.g., via .tolist().
+        batch_size : int, optional
+            Number of rows to send per executemany call.  Outside of a
+            transaction block, the changes are committed after each
+            batch if autocommit is True.  Default: 1000
+
+        Returns
+        -------
+        int
+            The total number of rows affected, as reported by the server.
+
+        Notes
+        -----
+        MySQLdb rewrites 'insert ... values (...)' statements, including
+        any 'on duplicate key update' clause, as a single multi-row
+        insert for each batch, so that each batch costs one round trip.
+        """
+        nrows = 0
+        cursor = self._mysql_connection.cursor()
+        try:
+            for batch in _batches(rows, batch_size):
+                self._execute(cursor, sql, batch, many=True)
+                nrows += cursor.rowcount
+                self._statement_done(len(batch))
+        finally:
+            cursor.close()
+        return nrows
+
     def run_script(self, script, dry_run=False):
         """Execute a script of SQL code.
 
@@ -129,26 +594,207 @@ class DbConnection(object):
         csv_file : str
             The name of the csv file containing the data.
 
+        Returns
+        -------
+        int
+            The number of rows loaded.
+
         Notes
         -----
         Non-char data has to be type converted explicitly using a cast
         for those columns.
         """
-        # Get the column names and data types.
+        column_names, sql = self._load_data_sql(table_name)
+        self.check_column_names(column_names, csv_file)
+        self.apply("LOAD DATA LOCAL INFILE '%s'" % csv_file + sql)
+        return self.rowcount
+
+    def load_csv_stream(self, table_name, csv_text):
+        """
+        Load csv data produced by an iterable into the specified table
+        without writing it to disk.  The text is fed to 'LOAD DATA
+        LOCAL INFILE' through a named pipe by a separate thread, so
+        that producing the data and loading it overlap.
+
+        Parameters
+        ----------
+        table_name : str
+            The name of the db table to load into.
+        csv_text : iterable
+            Strings of csv text, e.g., as produced by csv_text_from_fits.
+            The first string must start with the header line of column
+            names.
+
+        Returns
+        -------
+        int
+            The number of rows loaded.
+
+        Raises
+        ------
+        RuntimeError
+            If the header does not match the columns of the db table.
+
+        Notes
+        -----
+        If csv_text raises an exception, the partially loaded data are
+        rolled back and the exception is re-raised.  This requires a
+        transactional storage engine such as InnoDB.
+        """
+        csv_text = iter(csv_text)
+        try:
+            first = next(csv_text)
+        except StopIteration:
+            raise RuntimeError('No csv data to load into %s.' % table_name)
+        column_names, sql = self._load_data_sql(table_name)
+        self.check_header(column_names, first.split('\n', 1)[0])
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fifo = os.path.join(tmpdir, '%s.csv' % table_name)
+            os.mkfifo(fifo)
+            writer = _FifoWriter(fifo, itertools.chain([first], csv_text))
+            writer.start()
+            cursor = self._mysql_connection.cursor()
+            try:
+                self._execute(cursor,
+                              "LOAD DATA LOCAL INFILE '%s'" % fifo + sql)
+            except:
+                self.rollback()
+                raise
+            finally:
+                cursor.close()
+                writer.finish()
+            if writer.error is not None:
+                self.rollback()
+                raise writer.error
+            self._statement_done()
+        finally:
+            shutil.rmtree(tmpdir)
+        return self.rowcount
+
+    def get_table_schema(self, table_name):
+        """
+        Get the column names and data types of a table in the current
+        database.  The results are cached by (database, table_name).
+
+        Parameters
+        ----------
+        table_name : str
+            The name of the db table.
+
+        Returns
+        -------
+        tuple
+            (column name, data type) tuples in the order of the table
+            columns.  This is empty if the table does not exist.
+        """
+        key = (self._connect_kwds.get('database'), table_name)
+        try:
+            return self._schema_cache[key]
+        except KeyError:
+            pass
         query = """SELECT COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS
-                   WHERE TABLE_NAME='%(table_name)s'""" % locals()
-        def dtype_tuple(curs):
-            dtypes = OrderedDict()
-            for x in curs:
-                dtypes[x] = 1
-            return tuple(dtypes.keys())
-        data_types = self.apply(query, cursorFunc=dtype_tuple)
-        sql = """LOAD DATA LOCAL INFILE '%(csv_file)s'
+                   WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='%(table_name)s'
+                   ORDER BY ORDINAL_POSITION""" % locals()
+        data_types = self.apply(query, cursorFunc=lambda curs: tuple(
+            tuple(x) for x in curs))
+        if data_types:
+            # Only cache tables that exist.
+            self._schema_cache[key] = data_types
+        return data_types
+
+    def get_primary_key(self, table_name):
+        """
+        Get the primary key columns of a table in the current database.
+        The results are cached by (database, table_name).
+
+        Parameters
+        ----------
+        table_name : str
+            The name of the db table.
+
+        Returns
+        -------
+        tuple
+            The primary key column names in key order.
+        """
+        key = (self._connect_kwds.get('database'), table_name, 'primary key')
+        try:
+            return self._schema_cache[key]
+        except KeyError:
+            pass
+        query = """SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
+                   WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='%(table_name)s'
+                   AND CONSTRAINT_NAME='PRIMARY'
+                   ORDER BY ORDINAL_POSITION""" % locals()
+        columns = self.apply(query, cursorFunc=lambda curs: tuple(
+            x[0] for x in curs))
+        if columns:
+            self._schema_cache[key] = columns
+        return columns
+
+    def cache_table_schema(self, table_name, data_types):
+        """
+        Set the schema information for a table that is not listed in
+        INFORMATION_SCHEMA, e.g., a TEMPORARY table, so that it can be
+        used with load_csv and load_csv_stream.
+
+        Parameters
+        ----------
+        table_name : str
+            The name of the db table.
+        data_types : sequence
+            (column name, data type) tuples in the order of the table
+            columns, as returned by get_table_schema.
+        """
+        key = (self._connect_kwds.get('database'), table_name)
+        self._load_sql_cache.pop(key, None)
+        self._schema_cache[key] = tuple(tuple(x) for x in data_types)
+
+    def invalidate_schema_cache(self, table_name=None):
+        """
+        Remove cached schema information, e.g., after a table has been
+        dropped or altered.
+
+        Parameters
+        ----------
+        table_name : str, optional
+            The table for which to remove the schema information.  If
+            None, then the information for all tables is removed.
+            Default: None
+        """
+        for cache in (self._schema_cache, self._load_sql_cache):
+            for key in list(cache.keys()):
+                if table_name is None or key[1] == table_name:
+                    del cache[key]
+
+    def _load_data_sql(self, table_name):
+        """
+        Get the column names and the part of the LOAD DATA statement
+        following the infile name for the specified table.  The results
+        are cached by (database, table_name).
+
+        Parameters
+        ----------
+        table_name : str
+            The name of the db table to load into.
+
+        Returns
+        -------
+        tuple
+            (tuple of column names, SQL string)
+        """
+        key = (self._connect_kwds.get('database'), table_name)
+        try:
+            return self._load_sql_cache[key]
+        except KeyError:
+            pass
+        data_types = self.get_table_schema(table_name)
+        sql = """
                  INTO TABLE %(table_name)s
                  FIELDS TERMINATED BY ',' LINES TERMINATED BY '\n'
                  IGNORE 1 LINES (""" % locals()
         column_names = tuple(x[0] for x in data_types)
-        self.check_column_names(column_names, csv_file)
         sql += ',\n'.join(column_names) + ')'
         # Check for conversions from non-char(n) data types.
         conversions = [dt_pair for dt_pair in data_types
@@ -167,7 +813,9 @@ class DbConnection(object):
                     '%(column_name)s=cast(%(column_name)s as %(my_dtype)s)'
                     % locals())
             sql += ',\n'.join(cast_list) + ';'
-        self.apply(sql)
+        if data_types:
+            self._load_sql_cache[key] = (column_names, sql)
+        return column_names, sql
 
     @staticmethod
     def check_column_names(column_names, csv_file):
@@ -188,7 +836,27 @@ class DbConnection(object):
             the ones in the csv file.
         """
         with open(csv_file, 'r') as csv_input:
-            csv_cols = csv_input.readline().strip().split(',')
+            DbConnection.check_header(column_names, csv_input.readline())
+
+    @staticmethod
+    def check_header(column_names, header):
+        """
+        Check the column names against those in a csv header line.
+
+        Parameters
+        ----------
+        column_names : sequence
+            The column names expected to be in the csv header.
+        header : str
+            The header line of the csv data.
+
+        Raises
+        ------
+        RuntimeError
+            If there is any mismatch between the expected columns and
+            the ones in the csv header.
+        """
+        csv_cols = header.strip().split(',')
         if len(csv_cols) != len(column_names):
             raise RuntimeError('Number of columns in csv file do not match '
                                + 'the number of columns of db table.')
@@ -198,7 +866,7 @@ class DbConnection(object):
                 message += ' %s vs %s' % (csv_col, table_col)
                 raise RuntimeError(message)
 
-    def get_pandas_data_frame(self, query):
+    def get_pandas_data_frame(self, query, chunksize=None):
         """
         Retrieve a pandas DataFrame via the specified query.
 
@@ -207,12 +875,316 @@ class DbConnection(object):
         query : str
             A select query of the form
             'select [<colunms>,*] from <table_name> where <condition>'
+        chunksize : int, optional
+            If given, return a generator of data frames with at most
+            chunksize rows each, which are streamed from the server
+            using iter_query.  Default: None
+
+        Returns
+        -------
+        pandas.DataFrame : A data frame containing the selected table data,
+            or a generator of data frames if chunksize is given.
+        """
+        if chunksize is not None:
+            return self.iter_query(query, chunksize=chunksize)
+        if self.stats is None:
+            return pd.read_sql(query, con=self._mysql_connection)
+        t0 = time.time()
+        df = pd.read_sql(query, con=self._mysql_connection)
+        self.stats.record(query, time.time() - t0, len(df))
+        return df
+
+    def iter_query(self, query, chunksize=100000, as_records=False):
+        """
+        Generator to stream the results of a query in chunks using a
+        server-side cursor, so that the full result set is never held
+        in memory by the client.
+
+        Parameters
+        ----------
+        query : str
+            A select query.
+        chunksize : int, optional
+            Maximum number of rows per chunk.  Default: 100000
+        as_records : bool, optional
+            If True, yield numpy record arrays instead of pandas
+            DataFrames.  Default: False
+
+        Yields
+        ------
+        pandas.DataFrame or numpy.recarray
+            The next chunk of rows of the query result.
+
+        Notes
+        -----
+        The server-side cursor ties up the connection until the
+        generator is exhausted or closed, so other statements should
+        not be applied with this connection in the meantime.
+        """
+        cursor = self._mysql_connection.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            self._execute(cursor, query)
+            columns = [x[0] for x in cursor.description]
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                if as_records:
+                    yield np.rec.fromrecords(rows, names=columns)
+                else:
+                    yield pd.DataFrame.from_records(list(rows),
+                                                    columns=columns)
+        finally:
+            cursor.close()
+
+    def get_numpy_array(self, query, dtype=None, chunksize=100000):
+        """
+        Retrieve the results of a query as a numpy structured array,
+        bypassing pandas.
+
+        Parameters
+        ----------
+        query : str
+            A select query.
+        dtype : numpy.dtype, list, or dict, optional
+            The dtype of the output array.  If None, it is inferred from
+            the MySQL column types, with FLOAT columns as float32 and
+            BIGINT columns as int64.  If a dict, the numpy types it
+            contains, keyed by column name, override the inferred ones,
+            e.g., dict(psFlux=np.float64).  Default: None
+        chunksize : int, optional
+            Number of rows to fetch from the server at a time.
+            Default: 100000
+
+        Returns
+        -------
+        numpy.ndarray
+            Structured array with one field per selected column.
+
+        Notes
+        -----
+        Rows are streamed with a server-side cursor and each chunk is
+        copied column by column into a preallocated output array,
+        which is grown in place as needed.  NULL values are converted
+        to NaN for floating point fields, but will raise an exception
+        for integer fields, so a floating point type should be given
+        for nullable integer columns.  Likewise, BIGINT UNSIGNED
+        columns with values >= 2**63 need dtype np.uint64.
+        """
+        cursor = self._mysql_connection.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            self._execute(cursor, query)
+            dtype = _result_dtype(cursor.description, dtype)
+            result = np.empty(chunksize, dtype=dtype)
+            nrows = 0
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if not rows:
+                    break
+                if nrows + len(rows) > len(result):
+                    result.resize(max(2*len(result), nrows + len(rows)),
+                                  refcheck=False)
+                block = result[nrows:nrows + len(rows)]
+                for name, column in zip(dtype.names, zip(*rows)):
+                    block[name] = column
+                nrows += len(rows)
+                del block
+        finally:
+            cursor.close()
+        result.resize(nrows, refcheck=False)
+        return result
+
+    def reduce_query(self, query, reducer, initial=None, chunksize=100000,
+                     as_records=False):
+        """
+        Apply a reducing function to the chunks of a query result
+        streamed by iter_query, e.g., to compute aggregates without
+        holding the selected table data in memory.
+
+        Parameters
+        ----------
+        query : str
+            A select query.
+        reducer : function
+            Function of the form reducer(accumulated, chunk) that returns
+            the updated accumulated value.
+        initial : object, optional
+            Initial accumulated value.  Default: None
+        chunksize : int, optional
+            Maximum number of rows per chunk.  Default: 100000
+        as_records : bool, optional
+            If True, pass numpy record arrays to the reducer instead of
+            pandas DataFrames.  Default: False
 
         Returns
         -------
-        pandas.DataFrame : A data frame containing the selected table data.
+        object
+            The final accumulated value.
         """
-        return pd.read_sql(query, con=self._mysql_connection)
+        result = initial
+        for chunk in self.iter_query(query, chunksize=chunksize,
+                                     as_records=as_records):
+            result = reducer(result, chunk)
+        return result
+
+class StagingTable(object):
+    """
+    Class to bulk load data into a db table via an unindexed staging
+    table.  Data are loaded into the staging table, which has the same
+    columns as the target table, and are then merged into the target
+    table in primary key order with a single INSERT ... SELECT
+    statement, so that the index maintenance cost for the target is
+    paid once per merge rather than once per loaded file.
+
+    Used as a context manager, the staging table is created on entry,
+    merged on normal exit, and dropped in either case, e.g.,
+
+    with StagingTable(connection, 'Object', conflict='update') as staging:
+        for csv_file in csv_files:
+            staging.load_csv(csv_file)
+
+    The staging table is a TEMPORARY table, so it is only visible to
+    the session of the DbConnection that created it, and the server
+    drops it if that session ends without a call to drop, e.g., if
+    the process is killed.  The staging table is emptied with DELETE
+    rather than TRUNCATE, so that creating, emptying, and dropping it
+    do not implicitly commit an open DbConnection.transaction block.
+    The ALTER TABLE statements issued for disable_keys=True do commit
+    any open transaction, however.
+
+    Attributes
+    ----------
+    name : str
+        The name of the staging table.
+    columns : tuple
+        The names of the columns of the staging table.
+    """
+    _conflict_clauses = dict(error='INSERT INTO', ignore='INSERT IGNORE INTO',
+                             replace='REPLACE INTO', update='INSERT INTO')
+
+    def __init__(self, connection, target, columns=None, conflict='error',
+                 update_columns=None, disable_keys=False):
+        """
+        Parameters
+        ----------
+        connection : desc.pserv.DbConnection
+            The connection to use.
+        target : str
+            The name of the target table.
+        columns : sequence, optional
+            The target columns to include in the staging table, e.g.,
+            if only some of the columns are filled.  If None, then all
+            of the columns are included.  Default: None
+        conflict : str, optional
+            Policy for rows with primary keys that already exist in the
+            target table: 'error' to raise an exception, 'ignore' to
+            keep the existing rows, 'replace' to replace them, or
+            'update' to update the update_columns of the existing rows.
+            Default: 'error'
+        update_columns : sequence, optional
+            The columns to update for conflict='update'.  If None, then
+            all of the non-primary key staging table columns are used.
+            Default: None
+        disable_keys : bool, optional
+            If True, disable the non-unique indexes of the target table
+            during each merge.  This only has an effect for MyISAM
+            tables.  Default: False
+        """
+        if conflict not in self._conflict_clauses:
+            raise ValueError('Invalid conflict policy: %s' % conflict)
+        self.connection = connection
+        self.target = target
+        self.conflict = conflict
+        self.disable_keys = disable_keys
+        self.name = '%s_staging_%s' % (target, uuid.uuid4().hex[:12])
+        if columns is None:
+            columns = tuple(x[0] for x in connection.get_table_schema(target))
+        self.columns = tuple(columns)
+        self.primary_key = connection.get_primary_key(target)
+        if update_columns is None:
+            update_columns = [x for x in self.columns
+                              if x not in self.primary_key]
+        self.update_columns = tuple(update_columns)
+
+    def create(self):
+        """
+        Create the staging table.
+        """
+        data_types = dict(self.connection.get_table_schema(self.target))
+        self.connection.apply('CREATE TEMPORARY TABLE %s AS SELECT %s '
+                              'FROM %s WHERE 0'
+                              % (self.name, ', '.join(self.columns),
+                                 self.target))
+        self.connection.invalidate_schema_cache(self.name)
+        # Temporary tables are not listed in INFORMATION_SCHEMA, so
+        # register the column types, which are copied from the target,
+        # for the LOAD DATA statements.
+        self.connection.cache_table_schema(
+            self.name, tuple((x, data_types[x]) for x in self.columns))
+
+    def drop(self):
+        """
+        Drop the staging table.
+        """
+        self.connection.apply('DROP TEMPORARY TABLE IF EXISTS %s' % self.name)
+        self.connection.invalidate_schema_cache(self.name)
+
+    def load_csv(self, csv_file):
+        """
+        Load a csv file into the staging table.  See
+        DbConnection.load_csv.
+        """
+        return self.connection.load_csv(self.name, csv_file)
+
+    def load_csv_stream(self, csv_text):
+        """
+        Load csv text into the staging table.  See
+        DbConnection.load_csv_stream.
+        """
+        return self.connection.load_csv_stream(self.name, csv_text)
+
+    def merge_sql(self):
+        """
+        Return the INSERT ... SELECT statement used to merge the staging
+        table into the target table.
+        """
+        columns = ', '.join(self.columns)
+        sql = '%s %s (%s) SELECT %s FROM %s' \
+              % (self._conflict_clauses[self.conflict], self.target,
+                 columns, columns, self.name)
+        if self.primary_key:
+            sql += ' ORDER BY %s' % ', '.join(self.primary_key)
+        if self.conflict == 'update' and self.update_columns:
+            sql += ' ON DUPLICATE KEY UPDATE ' \
+                   + ', '.join('%s=VALUES(%s)' % (x, x)
+                               for x in self.update_columns)
+        return sql
+
+    def merge(self):
+        """
+        Merge the contents of the staging table into the target table
+        and empty the staging table.
+        """
+        if self.disable_keys:
+            self.connection.apply('ALTER TABLE %s DISABLE KEYS' % self.target)
+        try:
+            self.connection.apply(self.merge_sql())
+        finally:
+            if self.disable_keys:
+                self.connection.apply('ALTER TABLE %s ENABLE KEYS'
+                                      % self.target)
+        self.connection.apply('DELETE FROM %s' % self.name)
+
+    def __enter__(self):
+        self.create()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.merge()
+        finally:
+            self.drop()
 
 class BinTableData(OrderedDict):
     """
@@ -220,8 +1192,12 @@ class BinTableData(OrderedDict):
     Its primary purpose is to convert FITS columns that are bool arrays
     into bit-packed long integer columns.  Otherwise it just serves
     up the column arrays from the binary table.
+
+    Columns are read from the binary table and flags are packed only
+    when a column is first accessed, so for a memory-mapped FITS file
+    only the data for the columns that are used are read into memory.
     """
-    def __init__(self, bintable, nbits=64):
+    def __init__(self, bintable, nbits=64, columns=None, rows=None):
         """
         Parameters
         ----------
@@ -229,45 +1205,193 @@ class BinTableData(OrderedDict):
             Binary table to manage.
         nbits : int, optional
             Number of bits per integer.  Default: 64.
+        columns : sequence, optional
+            Names of the columns to serve up, i.e., FITS column names
+            or the names of the packed flag columns, e.g., 'FLAGS1'.
+            Names that do not match any column are ignored.  If None,
+            then all of the columns are used.  Default: None.
+        rows : slice, optional
+            Slice of rows of the binary table to serve up.  If None,
+            then all of the rows are used.  Default: None.
         """
         super(BinTableData, self).__init__()
+        self._data = bintable.data if rows is None else bintable.data[rows]
+        self.nbits = nbits
+        # Mapping of column name to FITS column name and, for packed
+        # flag columns, the index of the packed integer.
+        self._sources = OrderedDict()
         for col in bintable.columns:
             if col.format[-1] == 'X':
-                flag_cols = zip(*(self.pack_flags(x, nbits=nbits)
-                                  for x in bintable.data[col.name]))
-                for i, flags in enumerate(flag_cols):
+                nflags = int(col.format[:-1] or 1)
+                for i in range(-(-nflags//nbits)):
                     name = '%s%i' % (col.name.upper(), i + 1)
-                    self[name] = np.array(flags, dtype=np.uint64)
+                    self._sources[name] = (col.name, i)
             else:
-                self[col.name] = bintable.data[col.name]
-        self.nrows = len(self.values()[0])
+                self._sources[col.name] = (col.name, None)
+        if columns is not None:
+            columns = set(columns)
+            self._sources = OrderedDict((name, source) for name, source
+                                        in self._sources.items()
+                                        if name in columns)
+        self.nrows = len(self._data)
+
+    def __missing__(self, name):
+        if name not in self._sources:
+            raise KeyError(name)
+        colname, index = self._sources[name]
+        if index is None:
+            values = self._data[colname]
+        else:
+            flags = np.asarray(self._data[colname], dtype=bool)
+            flags = flags.reshape(self.nrows, -1)
+            values = self.pack_flags(
+                flags[:, index*self.nbits:(index + 1)*self.nbits],
+                nbits=self.nbits)[:, 0]
+        OrderedDict.__setitem__(self, name, values)
+        return values
+
+    def __setitem__(self, name, values, *args, **kwds):
+        if name not in self._sources:
+            self._sources[name] = None
+        OrderedDict.__setitem__(self, name, values, *args, **kwds)
+
+    def __delitem__(self, name, *args, **kwds):
+        del self._sources[name]
+        if OrderedDict.__contains__(self, name):
+            OrderedDict.__delitem__(self, name, *args, **kwds)
+
+    def __contains__(self, name):
+        return name in self._sources
+
+    def has_key(self, name):
+        "Return True if name is one of the columns."
+        return name in self._sources
+
+    def __iter__(self):
+        return iter(self._sources)
+
+    def __len__(self):
+        return len(self._sources)
+
+    def get(self, name, default=None):
+        "Return the column for name if present, otherwise default."
+        return self[name] if name in self._sources else default
+
+    def keys(self):
+        "Return a list of the column names."
+        return list(self._sources)
+
+    def values(self):
+        "Return a list of the columns, reading any that are not loaded."
+        return [self[name] for name in self._sources]
+
+    def items(self):
+        "Return a list of (name, column) pairs."
+        return [(name, self[name]) for name in self._sources]
 
     @staticmethod
     def pack_flags(flags, nbits=64):
         """
         Pack an array of boolean flags into integers with nbits bits.
+        Flag i of each row is stored in bit i % nbits of integer
+        i // nbits.
 
         Parameters
         ----------
         flags : np.array
-            numpy array of bools.
+            numpy array of bools.  This is either a 1D array with the
+            flags for a single row or a 2D array of shape (nrows, nflags).
         nbits : int, optional
             Number of bits per integer.  Default: 64.
 
         Returns
         -------
-        list : A list of integers with the packed flags.
+        list or np.array : For 1D input, a list of integers with the
+            packed flags.  For 2D input, a uint64 array of shape
+            (nrows, nwords), where nwords = ceil(nflags/nbits).
         """
-        num_ints = int(np.ceil(float(len(flags))/nbits))
-        subarrs = [flags[i*nbits:(i+1)*nbits] for i in range(num_ints)]
-        values = [sum([long(2**i) for i, flag in enumerate(subarr) if flag])
-                  for subarr in subarrs]
-        return values
+        flags = np.asarray(flags, dtype=bool)
+        if flags.ndim == 1:
+            if nbits > 64:
+                num_ints = int(np.ceil(float(len(flags))/nbits))
+                return [sum(1 << i for i in np.flatnonzero(
+                    flags[j*nbits:(j+1)*nbits]).tolist())
+                        for j in range(num_ints)]
+            return [int(x) for x in
+                    BinTableData.pack_flags(flags[np.newaxis, :], nbits)[0]]
+        if not 0 < nbits <= 64:
+            raise ValueError("nbits must be between 1 and 64 for "
+                             "uint64 output: %s" % nbits)
+        nrows, nflags = flags.shape
+        nwords = -(-nflags//nbits)
+        padded = np.zeros((nrows, nwords*nbits), dtype=bool)
+        padded[:, :nflags] = flags
+        padded = padded.reshape(nrows, nwords, nbits)
+        if nbits % 8 == 0:
+            # np.packbits puts the first bit in the most significant
+            # position of each byte, so reverse the bits in each byte,
+            # then pad each word to 8 bytes and view as little-endian
+            # uint64.
+            nbytes = nbits//8
+            bits = padded.reshape(nrows, nwords, nbytes, 8)[..., ::-1]
+            packed = np.zeros((nrows, nwords, 8), dtype=np.uint8)
+            packed[..., :nbytes] = np.packbits(bits, axis=-1)[..., 0]
+            words = packed.reshape(nrows, 8*nwords).view('<u8')
+            return words.astype(np.uint64, copy=False)
+        words = np.zeros((nrows, nwords), dtype=np.uint64)
+        for i in range(nbits):
+            words |= padded[:, :, i].astype(np.uint64) << np.uint64(i)
+        return words
+
+    @staticmethod
+    def unpack_flags(words, nflags=None, nbits=64):
+        """
+        Unpack integers produced by pack_flags into arrays of boolean
+        flags, e.g., for FLAGS1, FLAGS2, ... columns returned by a db
+        query.
+
+        Parameters
+        ----------
+        words : np.array
+            Array of packed integers.  This is either a 1D array with
+            the integers for a single row or a 2D array of shape
+            (nrows, nwords), e.g., np.column_stack((df['FLAGS1'],
+            df['FLAGS2'])).
+        nflags : int, optional
+            Number of flags to return.  If None, then nwords*nbits
+            flags are returned.  Default: None.
+        nbits : int, optional
+            Number of bits per integer.  Default: 64.
+
+        Returns
+        -------
+        np.array : Array of bools of shape (nflags,) for 1D input or
+            (nrows, nflags) for 2D input.
+        """
+        words = np.asarray(words, dtype=np.uint64)
+        if words.ndim == 1:
+            return BinTableData.unpack_flags(words[np.newaxis, :],
+                                             nflags=nflags, nbits=nbits)[0]
+        if not 0 < nbits <= 64:
+            raise ValueError("nbits must be between 1 and 64 for "
+                             "uint64 input: %s" % nbits)
+        nrows, nwords = words.shape
+        if nflags is None:
+            nflags = nwords*nbits
+        if nbits % 8 == 0:
+            nbytes = nbits//8
+            packed = np.ascontiguousarray(words, dtype='<u8').view(np.uint8)
+            packed = packed.reshape(nrows, nwords, 8)[..., :nbytes]
+            bits = np.unpackbits(packed[..., np.newaxis], axis=-1)[..., ::-1]
+        else:
+            shifts = np.arange(nbits, dtype=np.uint64)
+            bits = (words[..., np.newaxis] >> shifts) & np.uint64(1)
+        return bits.reshape(nrows, nwords*nbits)[:, :nflags].astype(bool)
 
 
 def create_csv_file_from_fits(fits_file, fits_hdunum, csv_file,
                               column_mapping=None, callbacks=None,
-                              added_columns=None):
+                              added_columns=None, block_size=10000):
     """
     Create a csv file from a FITS binary table.
 
@@ -288,42 +1412,311 @@ def create_csv_file_from_fits(fits_file, fits_hdunum, csv_file,
          A dictionary of optional callback functions to apply to a
          column, keyed by FITS table column name.  This is used to
          apply any simple transformations to the column, e.g., scaling
-         by flux zeropoint or units conversion.
+         by flux zeropoint or units conversion.  The callbacks are
+         applied to each block of rows separately, so they should act
+         element-wise.
     added_columns : dict, optional
          A dictionary, keyed by column name, of columns to add with the
          value to be set.  If None (default), no extra columns will be
          added.
+    block_size : int, optional
+         Number of rows of the binary table to read and convert at a
+         time.  This sets the peak memory use.  Default: 10000
+    """
+    with open(csv_file, 'w') as csv_output:
+        for text in csv_text_from_fits(fits_file, fits_hdunum,
+                                       column_mapping=column_mapping,
+                                       callbacks=callbacks,
+                                       added_columns=added_columns,
+                                       block_size=block_size):
+            csv_output.write(text)
+
+def create_csv_files_from_fits(fits_file, fits_hdunum, targets,
+                               block_size=10000):
     """
+    Create several csv files, e.g., for different db tables, in a
+    single pass through a FITS binary table.  Each block of rows is
+    read once for all of the csv files, and a callback that is used
+    for the same FITS column by more than one csv file is applied only
+    once.
+
+    Parameters
+    ----------
+    fits_file : str
+         Name of the FITS file.
+    fits_hdunum : int
+         HDU number of the binary table to process.
+    targets : dict
+         (column_mapping, callbacks) tuples keyed by the name of the
+         csv file to create.  See create_csv_file_from_fits for a
+         description of column_mapping and callbacks, either of which
+         may be None.
+    block_size : int, optional
+         Number of rows of the binary table to read and convert at a
+         time.  Default: 10000
+    """
+    csv_outputs = []
+    try:
+        with fits.open(fits_file, memmap=True) as hdulist:
+            bintable = hdulist[fits_hdunum]
+            column_mappings = [_get_column_mapping(bintable, column_mapping,
+                                                   None)
+                               for column_mapping, _ in targets.values()]
+            callbacks = [x if x is not None else {}
+                         for _, x in targets.values()]
+            for csv_file, column_mapping in zip(targets, column_mappings):
+                csv_outputs.append(open(csv_file, 'w'))
+                csv_outputs[-1].write(_csv_header(column_mapping.keys()))
+            # Only read the columns that are used by any of the files.
+            columns = list(itertools.chain(*[x.values()
+                                             for x in column_mappings]))
+            for start in range(0, len(bintable.data), block_size):
+                bintable_data = BinTableData(bintable, columns=columns,
+                                             rows=slice(start,
+                                                        start + block_size))
+                calibrated = dict()
+                for csv_output, column_mapping, funcs \
+                        in zip(csv_outputs, column_mappings, callbacks):
+                    block = _make_block(bintable_data, column_mapping,
+                                        funcs, {}, calibrated)
+                    csv_output.write(_csv_rows(block))
+    finally:
+        for csv_output in csv_outputs:
+            csv_output.close()
+
+def csv_text_from_fits(fits_file, fits_hdunum, column_mapping=None,
+                       callbacks=None, added_columns=None, block_size=10000):
+    """
+    Generator of csv text from a FITS binary table, e.g., for use with
+    DbConnection.load_csv_stream.  See create_csv_file_from_fits for a
+    description of the parameters.
+
+    Parameters
+    ----------
+    block_size : int, optional
+         Number of csv rows per yielded string.  Default: 10000
+
+    Yields
+    ------
+    str
+         The header line of the csv data, then blocks of csv rows.
+    """
+    with fits.open(fits_file, memmap=True) as hdulist:
+        bintable = hdulist[fits_hdunum]
+        column_mapping = _get_column_mapping(bintable, column_mapping,
+                                             added_columns)
+        yield _csv_header(column_mapping.keys())
+        for block in _row_blocks(bintable, column_mapping, callbacks,
+                                 added_columns, block_size):
+            yield _csv_rows(block)
+
+def csv_text_from_columns(columns, block_size=10000):
+    """
+    Generator of csv text from column arrays, e.g., for use with
+    DbConnection.load_csv_stream.  The formatting is the same as for
+    csv_text_from_fits.
+
+    Parameters
+    ----------
+    columns : OrderedDict
+         numpy arrays of equal length keyed by csv column name.
+         Scalar values are used for every row.
+    block_size : int, optional
+         Number of csv rows per yielded string.  Default: 10000
+
+    Yields
+    ------
+    str
+         The header line of the csv data, then blocks of csv rows.
+    """
+    nrows = max([np.size(x) for x in columns.values() if np.ndim(x) > 0]
+                or [1])
+    columns = OrderedDict((name, np.asarray(values) if np.ndim(values) > 0
+                           else np.broadcast_to(np.array(values), (nrows,)))
+                          for name, values in columns.items())
+    yield _csv_header(columns.keys())
+    for start in range(0, nrows, block_size):
+        yield _csv_rows(OrderedDict((name, values[start:start + block_size])
+                                    for name, values in columns.items()))
+
+def _csv_header(colnames):
+    "Return the csv header line for the column names."
+    csv_output = StringIO()
+    writer = csv.writer(csv_output, delimiter=',', lineterminator='\n',
+                        quotechar="'")
+    writer.writerow(list(colnames))
+    return csv_output.getvalue()
+
+def _csv_rows(block):
+    """
+    Return the csv text for a block of rows given as an OrderedDict of
+    equal length column arrays.  Columns with zero stride, i.e., that
+    are broadcast from a single value, are formatted only once.
+    """
+    nrows = len(next(iter(block.values()))) if block else 0
+    fields = [itertools.repeat(_format_column(column[:1])[0], nrows)
+              if column.strides == (0,) else _format_column(column)
+              for column in block.values()]
+    lines = [','.join(row) for row in zip(*fields)]
+    if len(block) == 1:
+        # csv.writer quotes a row consisting of one empty field.
+        lines = [line if line else "''" for line in lines]
+    return '\n'.join(lines) + '\n'
+
+def row_blocks_from_fits(fits_file, fits_hdunum, column_mapping=None,
+                         callbacks=None, added_columns=None,
+                         block_size=100000):
+    """
+    Generator of blocks of rows from a FITS binary table, with the
+    column mapping, callbacks, and added columns applied.  Only one
+    block of rows is read from the memory-mapped FITS file at a time,
+    so the memory used does not depend on the size of the table.  See
+    create_csv_file_from_fits for a description of the parameters.
+
+    Parameters
+    ----------
+    block_size : int, optional
+         Maximum number of rows per block.  Default: 100000
+
+    Yields
+    ------
+    OrderedDict
+         numpy arrays for a block of rows, keyed by output column
+         name.  Constant columns are read-only arrays broadcast from
+         the single value.
+    """
+    with fits.open(fits_file, memmap=True) as hdulist:
+        bintable = hdulist[fits_hdunum]
+        column_mapping = _get_column_mapping(bintable, column_mapping,
+                                             added_columns)
+        for block in _row_blocks(bintable, column_mapping, callbacks,
+                                 added_columns, block_size):
+            yield block
+
+def _get_column_mapping(bintable, column_mapping, added_columns):
+    """
+    Check that the added columns do not collide with the columns of
+    the binary table and return the column mapping to use.
+    """
+    bintable_data = BinTableData(bintable)
+    if added_columns is None:
+        added_columns = {}
+    for name in added_columns:
+        if bintable_data.has_key(name):
+            raise RuntimeError("Column named %s already exists in the binary table data." % name)
+    if column_mapping is None:
+        column_mapping = OrderedDict([(name, name) for name in
+                                      itertools.chain(bintable_data,
+                                                      added_columns)])
+    return column_mapping
+
+def _row_blocks(bintable, column_mapping, callbacks, added_columns,
+                block_size):
+    "Generator of blocks of rows for row_blocks_from_fits."
     if callbacks is None:
         callbacks = {}
-    bintable_data = BinTableData(fits.open(fits_file)[fits_hdunum])
-    if added_columns is not None:
-        for name, value in added_columns.items():
-            if bintable_data.has_key(name):
-                raise RuntimeError("Column named %s already exists in the binary table data." % name)
-            bintable_data[name] = np.array([value]*bintable_data.nrows)
-    if column_mapping is None:
-        column_mapping = OrderedDict([(name, name) for name in bintable_data])
-    with open(csv_file, 'w') as csv_output:
-        writer = csv.writer(csv_output, delimiter=',', lineterminator='\n',
-                            quotechar="'")
-        colnames = list(column_mapping.keys())
-        writer.writerow(colnames)
-        columns = []
-        for colname in column_mapping.values():
-            if colname in bintable_data.keys():
+    if added_columns is None:
+        added_columns = {}
+    # Only read the columns that are used.
+    columns = list(column_mapping.values()) + list(added_columns)
+    for start in range(0, len(bintable.data), block_size):
+        bintable_data = BinTableData(bintable, columns=columns,
+                                     rows=slice(start, start + block_size))
+        yield _make_block(bintable_data, column_mapping, callbacks,
+                          added_columns)
+
+def _make_block(bintable_data, column_mapping, callbacks, added_columns,
+                calibrated=None):
+    """
+    Return the OrderedDict of output column arrays for a block of rows
+    of a binary table.  If calibrated is a dict, then it is used to
+    cache the callback results for the FITS columns so that they can
+    be shared by the blocks for other column mappings.
+    """
+    nrows = bintable_data.nrows
+    block = OrderedDict()
+    for name, colname in column_mapping.items():
+        if colname in added_columns:
+            value = np.array(added_columns[colname])
+            if colname in callbacks:
+                coldata = callbacks[colname](value.repeat(nrows))
+            else:
+                coldata = np.broadcast_to(value, (nrows,))
+        elif colname in bintable_data:
+            if colname not in callbacks:
                 coldata = bintable_data[colname]
-                try:
-                    coldata = callbacks[colname](coldata)
-                except KeyError:
-                    pass
-                columns.append(coldata.tolist())
-            else: # Assume colname is a numeric or string constant.
-                columns.append([colname]*bintable_data.nrows)
-        for row in zip(*tuple(columns)):
-            row = [x if isinstance(x, str) or np.isfinite(x)
-                   else '\N' for x in row]
-            writer.writerow(row)
+            elif calibrated is None:
+                coldata = callbacks[colname](bintable_data[colname])
+            else:
+                key = (colname, id(callbacks[colname]))
+                if key not in calibrated:
+                    calibrated[key] \
+                        = callbacks[colname](bintable_data[colname])
+                coldata = calibrated[key]
+        else: # Assume colname is a numeric or string constant.
+            coldata = np.broadcast_to(np.array(colname), (nrows,))
+        block[name] = np.asarray(coldata)
+    return block
+
+_quoted_chars = (',', "'", '\n', '\r')
+
+def _quote_field(field):
+    """
+    Quote a string field as csv.writer does with the delimiter and
+    quotechar used by csv_text_from_fits and the default
+    QUOTE_MINIMAL quoting.
+    """
+    if any(char in field for char in _quoted_chars):
+        return "'" + field.replace("'", "''") + "'"
+    return field
+
+def _format_field(value):
+    """
+    Format a single value as a csv field, using \\N for non-finite
+    numbers.
+    """
+    if isinstance(value, str):
+        return _quote_field(value)
+    if not np.isfinite(value):
+        return '\\N'
+    if isinstance(value, float):
+        return float.__repr__(value)
+    return str(value)
+
+def _format_column(values):
+    """
+    Format a column of values as a list of csv fields.  The output is
+    the same as for csv.writer applied to values.tolist(), with
+    non-finite values replaced by \\N, but the formatting is done for
+    the whole column at once.
+
+    Parameters
+    ----------
+    values : np.array
+        The column values.
+
+    Returns
+    -------
+    list : The csv fields.
+    """
+    kind = values.dtype.kind
+    if kind == 'f':
+        fields = list(map(float.__repr__, values.tolist()))
+        for i in np.flatnonzero(~np.isfinite(values)):
+            fields[i] = '\\N'
+        return fields
+    if kind in 'iub':
+        return values.astype(str).tolist()
+    if kind in 'SU':
+        values = values.astype(str)
+        needs_quotes = np.zeros(len(values), dtype=bool)
+        for char in _quoted_chars:
+            needs_quotes |= np.char.find(values, char) >= 0
+        fields = values.tolist()
+        for i in np.flatnonzero(needs_quotes):
+            fields[i] = _quote_field(fields[i])
+        return fields
+    return [_format_field(x) for x in values.tolist()]
 
 def create_schema_from_fits(fits_file, hdunum, outfile, table_name,
                             primary_key='', add_columns=()):
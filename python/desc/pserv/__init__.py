@@ -1,3 +1,5 @@
 from __future__ import absolute_import
 from .Pserv import *
 from .repository_info import *
+from .instrumentation import *
+from .manifest import *
@@ -0,0 +1,199 @@
+"""
+Tools for recording the execution times of SQL statements.
+"""
+from __future__ import absolute_import, print_function, division
+import re
+import sys
+import json
+import math
+import atexit
+import threading
+from collections import OrderedDict
+
+__all__ = ['StatementStats', 'fingerprint']
+
+_string_literals = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+_numbers = re.compile(r'\b\d+(?:\.\d*)?(?:[eE][-+]?\d+)?\b')
+_placeholders = re.compile(r'%s|%\([^)]*\)s')
+_value_lists = re.compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+')
+_whitespace = re.compile(r'\s+')
+
+def fingerprint(sql):
+    """
+    Reduce an SQL statement to a fingerprint by replacing string and
+    numeric literals and DBAPI placeholders with '?', collapsing lists
+    of value tuples, and normalizing whitespace, so that statements
+    that differ only in their values are grouped together.
+
+    Parameters
+    ----------
+    sql : str
+        The SQL statement.
+
+    Returns
+    -------
+    str
+        The fingerprint.
+    """
+    sql = _string_literals.sub('?', sql)
+    sql = _placeholders.sub('?', sql)
+    sql = _numbers.sub('?', sql)
+    sql = _value_lists.sub(r'\1, ...', sql)
+    return _whitespace.sub(' ', sql).strip()
+
+class _Timings(object):
+    """
+    Accumulated wall times and row counts for one kind of statement,
+    with a histogram of wall times in decade bins.
+    """
+    min_decade = -6
+    max_decade = 3
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.
+        self.max_time = 0.
+        self.nrows = 0
+        self.histogram = OrderedDict(
+            ('1e%+i' % i, 0) for i in range(self.min_decade,
+                                             self.max_decade + 1))
+
+    def add(self, wall_time, nrows=0):
+        "Add a statement execution."
+        self.count += 1
+        self.total_time += wall_time
+        self.max_time = max(self.max_time, wall_time)
+        if nrows > 0:
+            self.nrows += nrows
+        if wall_time > 0:
+            decade = int(math.floor(math.log10(wall_time)))
+        else:
+            decade = self.min_decade
+        decade = min(max(decade, self.min_decade), self.max_decade)
+        self.histogram['1e%+i' % decade] += 1
+
+    def to_dict(self):
+        "Return the accumulated values as a dict."
+        return OrderedDict((('count', self.count),
+                            ('total_time', self.total_time),
+                            ('max_time', self.max_time),
+                            ('nrows', self.nrows),
+                            ('histogram', self.histogram)))
+
+class StatementStats(object):
+    """
+    Class to accumulate the wall times and the numbers of rows affected
+    or returned by SQL statements, grouped by statement fingerprint,
+    and the wall times of commits.  It is safe to share an instance
+    among connections used by different threads.
+    """
+    def __init__(self):
+        self.statements = OrderedDict()
+        self.commits = _Timings()
+        self._lock = threading.Lock()
+
+    def record(self, sql, wall_time, nrows=0):
+        """
+        Record the execution of an SQL statement.
+
+        Parameters
+        ----------
+        sql : str
+            The SQL statement.
+        wall_time : float
+            The execution time in seconds.
+        nrows : int, optional
+            The number of rows affected or returned.  Negative values,
+            which DBAPI 2 cursors use for unknown row counts, are
+            ignored.  Default: 0
+        """
+        key = fingerprint(sql)
+        with self._lock:
+            if key not in self.statements:
+                self.statements[key] = _Timings()
+            self.statements[key].add(wall_time, nrows)
+
+    def record_commit(self, wall_time):
+        """
+        Record a commit.
+
+        Parameters
+        ----------
+        wall_time : float
+            The time in seconds for the commit.
+        """
+        with self._lock:
+            self.commits.add(wall_time)
+
+    def to_dict(self):
+        """
+        Return the accumulated statistics as a dict, with the entries
+        for the statements ordered by decreasing total time.
+        """
+        with self._lock:
+            statements = sorted(self.statements.items(),
+                                key=lambda x: -x[1].total_time)
+            return OrderedDict(
+                (('statements', OrderedDict((key, timings.to_dict())
+                                            for key, timings in statements)),
+                 ('commits', self.commits.to_dict())))
+
+    def to_json(self, indent=2):
+        "Return the accumulated statistics as a JSON string."
+        return json.dumps(self.to_dict(), indent=indent)
+
+    def summary(self, width=70):
+        """
+        Return a table of the accumulated statistics, with one line per
+        statement fingerprint ordered by decreasing total time.
+
+        Parameters
+        ----------
+        width : int, optional
+            Maximum number of characters of each fingerprint to show.
+            Default: 70
+        """
+        stats = self.to_dict()
+        lines = ['%8s %12s %12s %12s %12s  %s'
+                 % ('count', 'total (s)', 'mean (ms)', 'max (ms)', 'rows',
+                    'statement')]
+        entries = list(stats['statements'].items())
+        entries.append(('COMMIT', stats['commits']))
+        for key, entry in entries:
+            if entry['count'] == 0:
+                continue
+            lines.append('%8i %12.3f %12.3f %12.3f %12i  %s'
+                         % (entry['count'], entry['total_time'],
+                            1e3*entry['total_time']/entry['count'],
+                            1e3*entry['max_time'], entry['nrows'],
+                            key[:width]))
+        return '\n'.join(lines)
+
+    def dump(self, outfile=None, json_format=False):
+        """
+        Write the summary table or the JSON representation of the
+        statistics.
+
+        Parameters
+        ----------
+        outfile : str, optional
+            The output file.  If None, then write to stdout.
+            Default: None
+        json_format : bool, optional
+            If True, write JSON instead of the summary table.
+            Default: False
+        """
+        text = self.to_json() if json_format else self.summary()
+        if outfile is None:
+            print(text)
+            sys.stdout.flush()
+        else:
+            with open(outfile, 'w') as output:
+                output.write(text + '\n')
+
+    def dump_at_exit(self, outfile=None, json_format=False):
+        """
+        Register the dump method to be called at interpreter exit.
+        See dump for a description of the parameters.
+        """
+        atexit.register(self.dump, outfile=outfile, json_format=json_format)
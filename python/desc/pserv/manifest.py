@@ -0,0 +1,299 @@
+"""
+Persistent record of the catalogs that have been ingested into the
+db tables, so that an interrupted ingest can be resumed.
+"""
+from __future__ import absolute_import, print_function, division
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import namedtuple, OrderedDict
+
+__all__ = ['IngestManifest', 'ManifestEntry']
+
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'table_name', 'size',
+                                             'mtime', 'checksum', 'nrows',
+                                             'status', 'error', 'timestamp'])
+ManifestEntry.__doc__ = """
+The manifest entry for a catalog and db table.
+
+Attributes
+----------
+path : str
+    Absolute path of the catalog file.
+table_name : str
+    The name of the db table.
+size : int
+    Size of the catalog file in bytes when it was ingested, or None
+    if the file could not be found.
+mtime : float
+    Modification time of the catalog file when it was ingested.
+checksum : str
+    md5 checksum of the catalog file, if checksums are used.
+nrows : int
+    Number of rows loaded, if known.
+status : str
+    'loaded' or 'failed'.
+error : str
+    Description of the exception for a failed ingest.
+timestamp : float
+    Time at which the entry was recorded.
+"""
+
+class IngestManifest(object):
+    """
+    Record, in an SQLite file, of the status of the ingest of each
+    catalog file into each db table.  A catalog that has been loaded
+    is skipped by later runs unless its size, modification time, or,
+    optionally, checksum has changed, so that rerunning an ingest
+    after a partial failure only redoes the failed and changed
+    catalogs.
+
+    Attributes
+    ----------
+    manifest_file : str
+        The SQLite file.
+    use_checksums : bool
+        Flag to compare md5 checksums as well as the sizes and
+        modification times of the catalog files.
+    """
+    loaded = 'loaded'
+    failed = 'failed'
+
+    def __init__(self, manifest_file, use_checksums=False):
+        """
+        Class constructor
+
+        Parameters
+        ----------
+        manifest_file : str
+            The SQLite file.  It is created if it does not exist.
+        use_checksums : bool, optional
+            Flag to compute and compare md5 checksums of the catalog
+            files.  This requires reading each file in full.
+            Default: False
+        """
+        self.manifest_file = manifest_file
+        self.use_checksums = use_checksums
+        # The manifest may be updated by loader threads, so guard the
+        # SQLite connection with a lock.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(manifest_file, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("""create table if not exists ingests
+                                  (path TEXT, table_name TEXT,
+                                   size INTEGER, mtime REAL, checksum TEXT,
+                                   nrows INTEGER, status TEXT, error TEXT,
+                                   timestamp REAL,
+                                   primary key (path, table_name))""")
+
+    def close(self):
+        "Close the SQLite connection."
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def checksum(path, chunk_size=2**20):
+        """
+        Compute the md5 checksum of a file.
+
+        Parameters
+        ----------
+        path : str
+            The file name.
+        chunk_size : int, optional
+            Number of bytes to read at a time.  Default: 1 MB
+
+        Returns
+        -------
+        str
+            The hex digest.
+        """
+        md5 = hashlib.md5()
+        with open(path, 'rb') as input_:
+            for chunk in iter(lambda: input_.read(chunk_size), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def file_info(self, path):
+        """
+        Get the size, modification time, and, if checksums are used,
+        the checksum of a file.
+
+        Parameters
+        ----------
+        path : str
+            The file name.
+
+        Returns
+        -------
+        tuple
+            (size, mtime, checksum).  All are None if the file does not
+            exist, and checksum is None if checksums are not used.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None, None, None
+        checksum = self.checksum(path) if self.use_checksums else None
+        return stat.st_size, stat.st_mtime, checksum
+
+    def entry(self, path, table_name):
+        """
+        Get the manifest entry for a catalog and db table.
+
+        Parameters
+        ----------
+        path : str
+            The catalog file name.
+        table_name : str
+            The name of the db table.
+
+        Returns
+        -------
+        ManifestEntry or None
+            None if there is no entry.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'select * from ingests where path=? and table_name=?',
+                (os.path.abspath(path), table_name)).fetchone()
+        return ManifestEntry(*row) if row is not None else None
+
+    def needs_ingest(self, path, table_name):
+        """
+        Determine whether a catalog needs to be ingested into a db
+        table, i.e., it has not been loaded, its last ingest failed,
+        or the file has changed since it was loaded.
+
+        Parameters
+        ----------
+        path : str
+            The catalog file name.
+        table_name : str
+            The name of the db table.
+
+        Returns
+        -------
+        bool
+        """
+        entry = self.entry(path, table_name)
+        if entry is None or entry.status != self.loaded:
+            return True
+        size, mtime, checksum = self.file_info(path)
+        if size is None:
+            # The catalog was loaded, but has since been removed.
+            return False
+        if (size, mtime) != (entry.size, entry.mtime):
+            return True
+        return (checksum is not None and entry.checksum is not None
+                and checksum != entry.checksum)
+
+    def pending(self, path, table_names):
+        """
+        Get the db tables into which a catalog needs to be ingested.
+
+        Parameters
+        ----------
+        path : str
+            The catalog file name.
+        table_names : sequence
+            The names of the db tables to be filled from the catalog.
+
+        Returns
+        -------
+        list
+            The table names for which needs_ingest is True.
+        """
+        return [table_name for table_name in table_names
+                if self.needs_ingest(path, table_name)]
+
+    def record(self, path, table_name, status, nrows=None, error=None):
+        """
+        Record the outcome of the ingest of a catalog into a db table,
+        along with the current size, modification time, and checksum
+        of the catalog file.  Any previous entry is replaced.
+
+        Parameters
+        ----------
+        path : str
+            The catalog file name.
+        table_name : str
+            The name of the db table.
+        status : str
+            IngestManifest.loaded or IngestManifest.failed.
+        nrows : int, optional
+            Number of rows loaded.
+        error : Exception or str, optional
+            The reason for a failure.
+        """
+        size, mtime, checksum = self.file_info(path)
+        if error is not None:
+            error = '%s: %s' % (type(error).__name__, error) \
+                    if isinstance(error, Exception) else str(error)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'insert or replace into ingests values (?,?,?,?,?,?,?,?,?)',
+                (os.path.abspath(path), table_name, size, mtime, checksum,
+                 nrows, status, error, time.time()))
+
+    def record_loaded(self, path, table_name, nrows=None):
+        "Record a successful ingest.  See record."
+        self.record(path, table_name, self.loaded, nrows=nrows)
+
+    def record_failed(self, path, table_name, error):
+        "Record a failed ingest.  See record."
+        self.record(path, table_name, self.failed, error=error)
+
+    def entries(self, status=None, table_name=None):
+        """
+        Get the manifest entries.
+
+        Parameters
+        ----------
+        status : str, optional
+            Only return entries with this status.
+        table_name : str, optional
+            Only return entries for this db table.
+
+        Returns
+        -------
+        list
+            ManifestEntry tuples ordered by path and table name.
+        """
+        query = 'select * from ingests'
+        constraints = OrderedDict((('status', status),
+                                   ('table_name', table_name)))
+        values = [x for x in constraints.values() if x is not None]
+        if values:
+            query += ' where ' + ' and '.join('%s=?' % name for name, value
+                                              in constraints.items()
+                                              if value is not None)
+        query += ' order by path, table_name'
+        with self._lock:
+            rows = self._conn.execute(query, values).fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def summary(self):
+        """
+        Count the entries by table name and status.
+
+        Returns
+        -------
+        OrderedDict
+            Numbers of entries and of rows loaded, keyed by (table_name,
+            status).
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                """select table_name, status, count(*), sum(nrows)
+                   from ingests group by table_name, status
+                   order by table_name, status""").fetchall()
+        return OrderedDict(((table_name, status), (count, nrows))
+                           for table_name, status, count, nrows in rows)
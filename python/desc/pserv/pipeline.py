@@ -0,0 +1,542 @@
+"""
+Tools for pipelining the conversion of FITS catalogs to csv files with
+the loading of those files into the database.
+"""
+from __future__ import absolute_import, print_function, division
+import os
+import sys
+import time
+import tempfile
+import threading
+import multiprocessing
+from collections import namedtuple, OrderedDict
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+from .Pserv import create_csv_file_from_fits, create_csv_files_from_fits
+
+__all__ = ['CatalogJob', 'TableTarget', 'MultiTableJob', 'ingest_pipelined',
+           'LoadJob', 'LoadReport', 'load_in_parallel', 'ConversionJob',
+           'ConversionResult', 'convert_catalogs']
+
+try:
+    _string_types = (basestring,)
+except NameError:
+    _string_types = (str,)
+
+CatalogJob = namedtuple('CatalogJob', ['name', 'fits_file', 'table_name',
+                                       'column_mapping', 'callbacks',
+                                       'fits_hdunum'])
+CatalogJob.__new__.__defaults__ = (None, None, 1)
+CatalogJob.__doc__ = """
+A FITS catalog to be converted and loaded into a db table.
+
+Attributes
+----------
+name : str
+    Label used to report failures.
+fits_file : str
+    Name of the FITS file.
+table_name : str
+    The name of the db table to load into.
+column_mapping : dict, optional
+    Mapping of csv column names to FITS column names or constants.
+    See create_csv_file_from_fits.
+callbacks : dict, optional
+    Callback functions keyed by FITS column name.  These must be
+    picklable, e.g., FluxCalibrator objects rather than lambdas, so
+    that they can be sent to the worker processes.
+fits_hdunum : int, optional
+    HDU number of the binary table.  Default: 1
+"""
+
+TableTarget = namedtuple('TableTarget', ['table_name', 'column_mapping',
+                                         'callbacks'])
+TableTarget.__new__.__defaults__ = (None, None)
+TableTarget.__doc__ = """
+A db table to be filled from a FITS catalog by a MultiTableJob.
+
+Attributes
+----------
+table_name : str
+    The name of the db table to load into.
+column_mapping : dict, optional
+    Mapping of csv column names to FITS column names or constants.
+    See create_csv_file_from_fits.
+callbacks : dict, optional
+    Picklable callback functions keyed by FITS column name.
+"""
+
+MultiTableJob = namedtuple('MultiTableJob', ['name', 'fits_file', 'targets',
+                                             'fits_hdunum'])
+MultiTableJob.__new__.__defaults__ = (1,)
+MultiTableJob.__doc__ = """
+A FITS catalog to be converted and loaded into several db tables with
+a single read of the catalog.  See create_csv_files_from_fits.
+
+Attributes
+----------
+name : str
+    Label used to report failures.
+fits_file : str
+    Name of the FITS file.
+targets : list
+    TableTarget tuples for the db tables to fill.
+fits_hdunum : int, optional
+    HDU number of the binary table.  Default: 1
+"""
+
+def _table_targets(job):
+    "Return the TableTargets for a CatalogJob or MultiTableJob."
+    if isinstance(job, MultiTableJob):
+        return list(job.targets)
+    return [TableTarget(job.table_name, job.column_mapping, job.callbacks)]
+
+ConversionJob = namedtuple('ConversionJob', ['fits_file', 'column_mapping',
+                                             'callbacks', 'output',
+                                             'fits_hdunum'])
+ConversionJob.__new__.__defaults__ = (None, None, None, 1)
+ConversionJob.__doc__ = """
+A FITS catalog to be converted to a csv file.
+
+Attributes
+----------
+fits_file : str
+    Name of the FITS file.
+column_mapping : dict, optional
+    Mapping of csv column names to FITS column names or constants.
+    See create_csv_file_from_fits.
+callbacks : dict, optional
+    Callback functions keyed by FITS column name.  These must be
+    picklable so that they can be sent to the worker processes.
+output : str, optional
+    Name of the csv file to write.  If None, then a uniquely named
+    file is created.
+fits_hdunum : int, optional
+    HDU number of the binary table.  Default: 1
+"""
+
+ConversionResult = namedtuple('ConversionResult', ['job', 'output', 'error'])
+ConversionResult.__doc__ = """
+Result of a conversion by convert_catalogs.
+
+Attributes
+----------
+job : ConversionJob
+    The job that was run.
+output : str
+    Name of the csv file.
+error : Exception
+    The exception raised by the conversion or None if it succeeded.
+    The output file of a failed conversion is removed.
+"""
+
+LoadJob = namedtuple('LoadJob', ['name', 'table_name', 'source'])
+LoadJob.__doc__ = """
+Data to be loaded into a db table.
+
+Attributes
+----------
+name : str
+    Label used to report results and failures.
+table_name : str
+    The name of the db table to load into.
+source : str or iterable
+    The name of a csv file, or an iterable of csv text starting with
+    the header line, e.g., as produced by desc.pserv.csv_text_from_fits.
+"""
+
+class LoadReport(namedtuple('LoadReport', ['loaded', 'failures',
+                                           'elapsed'])):
+    """
+    Results of load_in_parallel.
+
+    Attributes
+    ----------
+    loaded : OrderedDict
+        Numbers of rows loaded, keyed by job name.
+    failures : OrderedDict
+        Exceptions raised by failed jobs, keyed by job name.
+    elapsed : float
+        Wall time in seconds.
+    """
+    @property
+    def nrows(self):
+        "Total number of rows loaded."
+        return sum(max(x, 0) for x in self.loaded.values())
+
+    @property
+    def rows_per_second(self):
+        "Overall load rate."
+        return self.nrows/self.elapsed if self.elapsed > 0 else 0.
+
+    def summary(self):
+        "Return a one-line summary of the results."
+        return ('%i jobs loaded, %i failed: %i rows in %.1f s (%.1f rows/s)'
+                % (len(self.loaded), len(self.failures), self.nrows,
+                   self.elapsed, self.rows_per_second))
+
+def _load_job(connection, job):
+    """
+    Load the data for a LoadJob with the specified connection and
+    return the number of rows loaded.
+    """
+    if isinstance(job.source, _string_types):
+        return connection.load_csv(job.table_name, job.source)
+    return connection.load_csv_stream(job.table_name, job.source)
+
+def load_in_parallel(connection, jobs, num_connections=4, verbose=False):
+    """
+    Load data into db tables using several connections, each used by
+    its own worker thread.
+
+    Parameters
+    ----------
+    connection : desc.pserv.DbConnection
+        Connection to the database.  Each worker thread checks out its
+        own connection from the connection pool.  Any object with
+        checkout, load_csv, and load_csv_stream methods with the same
+        signatures can be used, e.g., a stand-in for testing.
+    jobs : iterable
+        LoadJob tuples describing the data to load.
+    num_connections : int, optional
+        Number of worker threads and connections.  Default: 4
+    verbose : bool, optional
+        Flag to print the name of each job as it is loaded and a
+        summary at the end.  Default: False
+
+    Returns
+    -------
+    LoadReport
+        The numbers of rows loaded and the failures, keyed by job
+        name, and the elapsed time.
+
+    Notes
+    -----
+    Threads rather than processes are used so that csv text generators
+    can be loaded.  The database client library releases the GIL while
+    waiting on the server, so the loads proceed concurrently.
+    """
+    t0 = time.time()
+    job_queue = queue.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    loaded = OrderedDict()
+    failures = OrderedDict()
+    connection_errors = []
+    lock = threading.Lock()
+
+    def load_jobs():
+        try:
+            with connection.checkout() as loader_connection:
+                while True:
+                    try:
+                        job = job_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    try:
+                        nrows = _load_job(loader_connection, job)
+                        with lock:
+                            loaded[job.name] = nrows
+                        if verbose:
+                            print("Loaded", job.name)
+                            sys.stdout.flush()
+                    except Exception as eobj:
+                        with lock:
+                            failures[job.name] = eobj
+        except Exception as eobj:
+            with lock:
+                connection_errors.append(eobj)
+
+    threads = [threading.Thread(target=load_jobs)
+               for _ in range(num_connections)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Jobs left over if connections could not be made are failures.
+    while not job_queue.empty():
+        job = job_queue.get_nowait()
+        failures[job.name] = connection_errors[-1]
+    report = LoadReport(loaded, failures, time.time() - t0)
+    if verbose:
+        print(report.summary())
+        sys.stdout.flush()
+    return report
+
+def _convert_catalog(args):
+    """
+    Worker function to convert a FITS catalog to a csv file.
+
+    Parameters
+    ----------
+    args : tuple
+        (ConversionJob, output directory).  If the job has no output
+        file name, a uniquely named file is created in the output
+        directory.
+
+    Returns
+    -------
+    tuple
+        (ConversionJob, csv file name, exception or None)
+    """
+    job, output_dir = args
+    csv_file = job.output
+    try:
+        if csv_file is None:
+            prefix = os.path.basename(job.fits_file).split('.')[0] + '_'
+            fd, csv_file = tempfile.mkstemp(prefix=prefix, suffix='.csv',
+                                            dir=output_dir)
+            os.close(fd)
+        create_csv_file_from_fits(job.fits_file, job.fits_hdunum, csv_file,
+                                  column_mapping=job.column_mapping,
+                                  callbacks=job.callbacks)
+    except Exception as eobj:
+        if csv_file is not None:
+            _remove(csv_file)
+        return job, csv_file, eobj
+    return job, csv_file, None
+
+def _convert_catalog_tables(args):
+    """
+    Worker function to convert a FITS catalog to a csv file for each
+    of the db tables of a CatalogJob or MultiTableJob.
+
+    Parameters
+    ----------
+    args : tuple
+        (job, list of csv file names, one per TableTarget)
+
+    Returns
+    -------
+    tuple
+        (job, list of csv file names, exception or None)
+    """
+    job, csv_files = args
+    try:
+        targets = OrderedDict((csv_file, (target.column_mapping,
+                                          target.callbacks))
+                              for csv_file, target
+                              in zip(csv_files, _table_targets(job)))
+        create_csv_files_from_fits(job.fits_file, job.fits_hdunum, targets)
+    except Exception as eobj:
+        return job, csv_files, eobj
+    return job, csv_files, None
+
+def _remove(csv_file):
+    "Remove a file, ignoring any errors."
+    try:
+        os.remove(csv_file)
+    except OSError:
+        pass
+
+def convert_catalogs(jobs, processes=None, output_dir=None, queue_depth=4):
+    """
+    Generator that converts FITS catalogs to csv files with
+    create_csv_file_from_fits in a pool of worker processes.
+
+    Parameters
+    ----------
+    jobs : iterable
+        ConversionJob tuples describing the catalogs to convert.
+    processes : int, optional
+        Number of worker processes.  If None, then the number of cpus
+        is used.  Default: None
+    output_dir : str, optional
+        Directory for the csv files of jobs without an output file
+        name.  If None, then the system default temporary directory is
+        used.  Default: None
+    queue_depth : int, optional
+        Maximum number of converted catalogs waiting to be consumed.
+        Conversions are submitted to the pool only while there are
+        fewer than processes + queue_depth results converted or in
+        conversion but not yet consumed, where a result is consumed
+        when the next one is requested.  This bounds the disk space
+        used by the csv files.  Default: 4
+
+    Yields
+    ------
+    ConversionResult
+        The result of each job, in order of completion.
+
+    Raises
+    ------
+    RuntimeError
+        If more than one job has the same output file name.
+
+    Notes
+    -----
+    If the generator is closed early, the conversions already
+    submitted are allowed to finish, and the csv files created for
+    jobs without an output file name are removed.
+    """
+    jobs = list(jobs)
+    outputs = [job.output for job in jobs if job.output is not None]
+    if len(set(outputs)) != len(outputs):
+        raise RuntimeError("Conversion jobs must have unique output files.")
+    if not jobs:
+        return
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+    slots = threading.Semaphore(processes + queue_depth)
+    stop = threading.Event()
+
+    def tasks():
+        for job in jobs:
+            slots.acquire()
+            if stop.is_set():
+                return
+            yield job, output_dir
+
+    pool = multiprocessing.Pool(processes)
+    results = pool.imap_unordered(_convert_catalog, tasks())
+    try:
+        for job, csv_file, eobj in results:
+            yield ConversionResult(job, csv_file, eobj)
+            slots.release()
+    finally:
+        # Release the task generator, then remove the files of the
+        # conversions that finished after the generator was closed.
+        stop.set()
+        for _ in range(processes + queue_depth):
+            slots.release()
+        pool.close()
+        for job, csv_file, eobj in results:
+            if job.output is None and eobj is None:
+                _remove(csv_file)
+        pool.join()
+
+def ingest_pipelined(connection, jobs, processes=None, loaders=1,
+                     queue_depth=4, output_dir=None, verbose=False,
+                     on_loaded=None):
+    """
+    Convert FITS catalogs to csv files in a pool of worker processes
+    while loader threads load the converted files into the database.
+
+    Parameters
+    ----------
+    connection : desc.pserv.DbConnection
+        Connection to the database.  Each loader thread checks out its
+        own connection from the connection pool.
+    jobs : iterable
+        CatalogJob or MultiTableJob tuples describing the catalogs to
+        ingest.  The tables of a MultiTableJob are loaded in order by
+        the same loader thread.
+    processes : int, optional
+        Number of conversion worker processes.  If None, then the
+        number of cpus is used.  Default: None
+    loaders : int, optional
+        Number of loader threads.  Default: 1
+    queue_depth : int, optional
+        Maximum number of converted catalogs waiting to be loaded.
+        Conversions are submitted to the pool only while there are
+        fewer than processes + queue_depth catalogs converted or in
+        conversion but not yet loaded, which bounds the disk space
+        used by the csv files.  Default: 4
+    output_dir : str, optional
+        Directory for the temporary csv files.  If None, then the
+        system default temporary directory is used.  Default: None
+    verbose : bool, optional
+        Flag to print the name of each catalog as it is loaded.
+        Default: False
+    on_loaded : function, optional
+        Function called as on_loaded(job, table_name, nrows) by the
+        loader thread after each table of a job is loaded, e.g., to
+        record the progress of the ingest.  Default: None
+
+    Returns
+    -------
+    OrderedDict
+        Exceptions raised by failed conversions or loads, keyed by
+        job name.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    failed_ingests = OrderedDict()
+    failures_lock = threading.Lock()
+    slots = threading.Semaphore(processes + queue_depth)
+    stop = threading.Event()
+    load_queue = queue.Queue(maxsize=queue_depth)
+
+    def record_failure(job, eobj):
+        with failures_lock:
+            failed_ingests[job.name] = eobj
+
+    def tasks():
+        for job in jobs:
+            slots.acquire()
+            if stop.is_set():
+                return
+            csv_files = []
+            for _ in _table_targets(job):
+                fd, csv_file = tempfile.mkstemp(suffix='.csv',
+                                                dir=output_dir)
+                os.close(fd)
+                csv_files.append(csv_file)
+            yield job, csv_files
+
+    def load_queued(loader_connection, error=None):
+        while True:
+            item = load_queue.get()
+            if item is None:
+                break
+            job, csv_files = item
+            try:
+                if loader_connection is None:
+                    raise error
+                for target, csv_file in zip(_table_targets(job), csv_files):
+                    nrows = loader_connection.load_csv(target.table_name,
+                                                       csv_file)
+                    if on_loaded is not None:
+                        on_loaded(job, target.table_name, nrows)
+                if verbose:
+                    print("Loaded", job.name)
+                    sys.stdout.flush()
+            except Exception as eobj:
+                record_failure(job, eobj)
+            finally:
+                for csv_file in csv_files:
+                    _remove(csv_file)
+                slots.release()
+
+    def load_catalogs():
+        try:
+            with connection.checkout() as loader_connection:
+                load_queued(loader_connection)
+        except Exception as eobj:
+            # Keep draining the queue so that the producer does not block.
+            load_queued(None, eobj)
+
+    threads = [threading.Thread(target=load_catalogs) for _ in range(loaders)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for job, csv_files, eobj \
+                in pool.imap_unordered(_convert_catalog_tables, tasks()):
+            if eobj is not None:
+                record_failure(job, eobj)
+                for csv_file in csv_files:
+                    _remove(csv_file)
+                slots.release()
+                continue
+            load_queue.put((job, csv_files))
+        pool.close()
+    except:
+        # Release the task generator so that the pool can shut down.
+        stop.set()
+        for _ in range(processes + queue_depth):
+            slots.release()
+        pool.terminate()
+        raise
+    finally:
+        for _ in threads:
+            load_queue.put(None)
+        for thread in threads:
+            thread.join()
+        pool.join()
+    return failed_ingests
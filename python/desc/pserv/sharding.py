@@ -0,0 +1,261 @@
+"""
+Tools for partitioning an ingest among several processes or batch
+jobs, e.g., the tasks of a Slurm job array, and for merging their
+results.
+"""
+from __future__ import absolute_import, print_function, division
+import os
+import glob
+import json
+import fcntl
+import heapq
+from collections import OrderedDict
+
+__all__ = ['file_sizes', 'order_by_size', 'assign_shards', 'select_shard',
+           'WorkQueue', 'write_shard_results', 'merge_shard_results']
+
+def file_sizes(paths):
+    """
+    Get the sizes of files, as a measure of the work needed to ingest
+    them.
+
+    Parameters
+    ----------
+    paths : sequence
+        The file names.
+
+    Returns
+    -------
+    list
+        The sizes in bytes.  Files that do not exist have size 0.
+    """
+    sizes = []
+    for path in paths:
+        try:
+            sizes.append(os.path.getsize(path))
+        except OSError:
+            sizes.append(0)
+    return sizes
+
+def order_by_size(items, sizes):
+    """
+    Sort work items by decreasing size, so that the largest items are
+    started first.  Items of equal size keep their original order, so
+    that every process that builds the same work list gets the same
+    ordering.
+
+    Parameters
+    ----------
+    items : sequence
+        The work items.
+    sizes : sequence
+        The size of each item.
+
+    Returns
+    -------
+    tuple
+        (items, sizes) lists in the new order.
+    """
+    order = sorted(range(len(items)), key=lambda i: -sizes[i])
+    return [items[i] for i in order], [sizes[i] for i in order]
+
+def assign_shards(sizes, num_shards):
+    """
+    Assign work items to shards with the longest processing time
+    first rule: in order of decreasing size, each item is assigned to
+    the shard with the smallest total size so far.  The assignment
+    depends only on the sizes, so independent processes compute the
+    same assignment.
+
+    Parameters
+    ----------
+    sizes : sequence
+        The size of each item.
+    num_shards : int
+        The number of shards.
+
+    Returns
+    -------
+    list
+        The shard index of each item.
+    """
+    if num_shards < 1:
+        raise ValueError('num_shards must be at least 1.')
+    shards = [(0, shard) for shard in range(num_shards)]
+    assignments = [None]*len(sizes)
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        total, shard = heapq.heappop(shards)
+        assignments[i] = shard
+        heapq.heappush(shards, (total + sizes[i], shard))
+    return assignments
+
+def select_shard(items, sizes, shard_index, num_shards):
+    """
+    Select the work items for one shard.  See assign_shards.
+
+    Parameters
+    ----------
+    items : sequence
+        The full work list.
+    sizes : sequence
+        The size of each item.
+    shard_index : int
+        The index of the shard, 0 <= shard_index < num_shards, e.g.,
+        the task id of a Slurm job array.
+    num_shards : int
+        The number of shards.
+
+    Returns
+    -------
+    list
+        The items for the shard in order of decreasing size.
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError('shard_index must be in the range [0, %i).'
+                         % num_shards)
+    items, sizes = order_by_size(items, sizes)
+    assignments = assign_shards(sizes, num_shards)
+    return [item for item, shard in zip(items, assignments)
+            if shard == shard_index]
+
+class WorkQueue(object):
+    """
+    Work list shared by processes, possibly on different nodes, that
+    claim items one at a time.  Each process builds the same list of
+    items.  The index of the next unclaimed item is kept in a counter
+    file, which is updated under an exclusive lock.  Processes that
+    finish early therefore claim more of the items, which balances
+    the load without knowing the cost of each item in advance.
+
+    Attributes
+    ----------
+    lock_file : str
+        The counter file.  It must not exist, or be empty, at the
+        start of a run, and it must be on a file system shared by the
+        processes that supports POSIX locks.
+    items : list
+        The work items, e.g., from order_by_size.
+    """
+    def __init__(self, lock_file, items):
+        """
+        Class constructor
+
+        Parameters
+        ----------
+        lock_file : str
+            The counter file.
+        items : sequence
+            The work items.
+        """
+        self.lock_file = lock_file
+        self.items = list(items)
+
+    def claim(self):
+        """
+        Claim the next item.
+
+        Returns
+        -------
+        int or None
+            The index of the claimed item, or None if all of the items
+            have been claimed.
+        """
+        with open(self.lock_file, 'a+') as counter:
+            fcntl.lockf(counter, fcntl.LOCK_EX)
+            try:
+                counter.seek(0)
+                text = counter.read().strip()
+                index = int(text) if text else 0
+                if index >= len(self.items):
+                    return None
+                counter.seek(0)
+                counter.truncate()
+                counter.write('%i\n' % (index + 1))
+                counter.flush()
+                os.fsync(counter.fileno())
+            finally:
+                fcntl.lockf(counter, fcntl.LOCK_UN)
+        return index
+
+    def __iter__(self):
+        while True:
+            index = self.claim()
+            if index is None:
+                return
+            yield self.items[index]
+
+def write_shard_results(results_dir, shard, loaded, failures):
+    """
+    Write the results of one shard to a json file, results_dir/
+    shard_<shard>.json, for merge_shard_results.
+
+    Parameters
+    ----------
+    results_dir : str
+        Directory for the results files.  It is created if needed.
+    shard : int or str
+        Label for the shard, e.g., its index.
+    loaded : dict
+        Numbers of rows loaded, keyed by catalog name.  The values
+        must be json serializable, e.g., ints or dicts of ints keyed
+        by table name.
+    failures : dict
+        Exceptions, or descriptions of them, keyed by catalog name.
+
+    Returns
+    -------
+    str
+        The name of the results file.
+    """
+    if not os.path.isdir(results_dir):
+        try:
+            os.makedirs(results_dir)
+        except OSError:
+            # Another shard may have created it.
+            if not os.path.isdir(results_dir):
+                raise
+    results = OrderedDict((('shard', str(shard)),
+                           ('loaded', OrderedDict(loaded)),
+                           ('failures', OrderedDict(
+                               (name, '%s: %s' % (type(eobj).__name__, eobj)
+                                if isinstance(eobj, Exception) else str(eobj))
+                               for name, eobj in failures.items()))))
+    results_file = os.path.join(results_dir, 'shard_%s.json' % shard)
+    # Write to a temporary file and rename it, so that a partially
+    # written file is never merged.
+    with open(results_file + '.tmp', 'w') as output:
+        json.dump(results, output, indent=2)
+    os.rename(results_file + '.tmp', results_file)
+    return results_file
+
+def merge_shard_results(results_dir):
+    """
+    Merge the results written by write_shard_results.
+
+    Parameters
+    ----------
+    results_dir : str
+        Directory containing the results files.
+
+    Returns
+    -------
+    tuple
+        (loaded, failures, shards), where loaded and failures are
+        OrderedDicts keyed by catalog name, and shards is the list of
+        shard labels found.  A catalog that failed in one shard but
+        was loaded by another, e.g., on a rerun, is only reported as
+        loaded.
+    """
+    loaded = OrderedDict()
+    failures = OrderedDict()
+    shards = []
+    for results_file in sorted(glob.glob(os.path.join(results_dir,
+                                                      'shard_*.json'))):
+        with open(results_file) as input_:
+            results = json.load(input_, object_pairs_hook=OrderedDict)
+        shards.append(results['shard'])
+        loaded.update(results['loaded'])
+        failures.update(results['failures'])
+    for name in loaded:
+        failures.pop(name, None)
+    return loaded, failures, shards
@@ -4,18 +4,26 @@ Utilities for ingesting Stack data products into the MySQL tables.
 from __future__ import absolute_import, print_function, division
 import os
 import sys
+import fnmatch
+import itertools
+import multiprocessing
 from collections import OrderedDict
 import sqlite3
 import numpy as np
 import astropy.io.fits as fits
+import lsst.afw.geom as afwGeom
 import lsst.afw.math as afwMath
 import lsst.daf.persistence as dp
 import lsst.utils as lsstUtils
-from .Pserv import create_csv_file_from_fits
+from .Pserv import create_csv_file_from_fits, create_csv_files_from_fits, \
+    csv_text_from_fits, csv_text_from_columns, StagingTable
 
-__all__ = ['FluxCalibrator', 'make_ccdVisitId', 'create_table',
+__all__ = ['FluxCalibrator', 'ZeroPointLookup', 'make_ccdVisitId',
+           'make_ccdVisitIds', 'decode_ccdVisitIds', 'create_table',
            'ingest_registry', 'ingest_calexp_info',
-           'ingest_ForcedSource_data', 'ingest_Object_data']
+           'make_ForcedSource_mapping', 'make_ForcedSourceExtra_mapping',
+           'ingest_ForcedSource_data', 'ingest_forced_source_tables',
+           'ingest_Object_data']
 
 class FluxCalibrator(object):
     """
@@ -24,8 +32,10 @@ class FluxCalibrator(object):
 
     Attributes
     ----------
-    zeroPoint : float
-        Zero point in ADU for the exposure in question.
+    zeroPoint : float or np.array
+        Zero point in ADU for the exposure in question, or an array
+        of zero points, one per row of flux values, so that fluxes
+        from many exposures can be calibrated in a single call.
     """
     def __init__(self, zeroPoint):
         """
@@ -33,8 +43,9 @@ class FluxCalibrator(object):
 
         Parameters
         ----------
-        zeroPoint : float
-            Zero point in ADU for the exposure in question.
+        zeroPoint : float or np.array
+            Zero point in ADU for the exposure in question, or an
+            array of per-row zero points.
         """
 
         self.zeroPoint = zeroPoint
@@ -73,10 +84,129 @@ class FluxCalibrator(object):
         float or np.array
             Source flux(es) in nanomaggies.
         """
-        try:
-            return np.array([self.get_nanomaggies(x) for x in flux])
-        except TypeError:
+        if np.ndim(flux) == 0:
             return self.get_nanomaggies(flux)
+        # Compute in double precision, as for the Python floats used
+        # by get_nanomaggies, operating in place on the new array.
+        nanomaggies = np.array(flux, dtype=np.float64)
+        nanomaggies *= 1e9
+        nanomaggies /= self.zeroPoint
+        return nanomaggies
+
+    def calibrate_columns(self, columns, pattern='base_*Flux*'):
+        """
+        Convert all of the flux columns of a catalog to nanomaggies in
+        one pass.
+
+        Parameters
+        ----------
+        columns : dict
+            Column arrays keyed by name, e.g., a BinTableData object
+            or a block of rows from desc.pserv.row_blocks_from_fits.
+            The arrays of the matching columns are replaced by the
+            calibrated values.
+        pattern : str, optional
+            fnmatch-style pattern for the names of the flux columns.
+            Default: 'base_*Flux*'
+
+        Returns
+        -------
+        list
+            The names of the calibrated columns.
+        """
+        names = [name for name in columns
+                 if fnmatch.fnmatchcase(str(name), pattern)]
+        if not names:
+            return names
+        fluxes = self(np.array([columns[name] for name in names]))
+        for name, flux in zip(names, fluxes):
+            columns[name] = flux
+        return names
+
+    def callbacks(self, column_names, pattern='base_*Flux*'):
+        """
+        Make the callbacks for create_csv_file_from_fits to calibrate
+        the flux columns.
+
+        Parameters
+        ----------
+        column_names : sequence
+            Names of the FITS columns, e.g., column_mapping.values().
+            Entries that are not strings are ignored.
+        pattern : str, optional
+            fnmatch-style pattern for the names of the flux columns.
+            Default: 'base_*Flux*'
+
+        Returns
+        -------
+        dict
+            This object keyed by the matching column names.
+        """
+        return dict((name, self) for name in column_names
+                    if fnmatch.fnmatchcase(str(name), pattern))
+
+class ZeroPointLookup(object):
+    """
+    Zero points from the CcdVisit table for all of the ccdVisitIds of
+    a project, retrieved with a single query.
+
+    Attributes
+    ----------
+    project : str
+        The project name.
+    zeroPoints : dict
+        Zero points in ADU keyed by ccdVisitId.  Visits with a NULL
+        zeroPoint, e.g., those with missing calexps, are omitted.
+    """
+    def __init__(self, connection, project):
+        """
+        Class constructor
+
+        Parameters
+        ----------
+        connection : desc.pserv.DbConnection
+            Connection to the database with the CcdVisit table, which
+            must be filled already.
+        project : str
+            The project name.
+        """
+        self.project = project
+        query = """select ccdVisitId, zeroPoint from CcdVisit
+                   where project='%s' and zeroPoint is not null""" % project
+        self.zeroPoints = connection.apply(
+            query, lambda curs: dict((int(ccdVisitId), float(zeroPoint))
+                                     for ccdVisitId, zeroPoint in curs))
+
+    def __len__(self):
+        return len(self.zeroPoints)
+
+    def __contains__(self, ccdVisitId):
+        return ccdVisitId in self.zeroPoints
+
+    def __getitem__(self, ccdVisitId):
+        try:
+            return self.zeroPoints[ccdVisitId]
+        except KeyError:
+            raise KeyError('No zeroPoint in CcdVisit for ccdVisitId %i, '
+                           'project %s' % (ccdVisitId, self.project))
+
+    def calibrator(self, ccdVisitId):
+        """
+        Make the FluxCalibrator for a ccdVisitId.
+
+        Parameters
+        ----------
+        ccdVisitId : int
+            The ccdVisitId of the catalog to be calibrated.
+
+        Returns
+        -------
+        FluxCalibrator or None
+            None if there is no zero point for the ccdVisitId.
+        """
+        if ccdVisitId not in self.zeroPoints:
+            return None
+        return FluxCalibrator(self.zeroPoints[ccdVisitId])
 
 def make_ccdVisitId(visit, raft, sensor):
     """
@@ -104,6 +234,100 @@ def make_ccdVisitId(visit, raft, sensor):
     ccdVisitId = int(raft[:3:2] + sensor[:3:2] + "%07i" % visit)
     return ccdVisitId
 
+# ccdVisitIds are RRSS*_max_visit + visitId.
+_max_visit = 10**7
+
+def make_ccdVisitIds(visits, rafts, sensors):
+    """
+    Create the ccdVisitIds for arrays of visits, rafts, and sensors.
+    The ids are the same as those returned by make_ccdVisitId, but are
+    computed with integer arithmetic on whole arrays.
+
+    Parameters
+    ----------
+    visits : array_like
+        visitIds, which must be less than 10**7.
+    rafts : array_like
+        Raft identifiers in 'r,c' format, e.g., '2,2'.
+    sensors : array_like
+        Sensor identifiers in 'r,c' format, e.g., '1,1'.
+
+    Returns
+    -------
+    np.array
+        The int64 ccdVisitIds.
+
+    Raises
+    ------
+    ValueError
+        If a visit is outside of [0, 10**7) or a raft or sensor is not
+        in 'r,c' format.
+
+    Notes
+    -----
+    The arguments are broadcast against each other, so, e.g., a single
+    raft and sensor can be used with an array of visits.
+    """
+    visits = np.asarray(visits, dtype=np.int64)
+    if np.any((visits < 0) | (visits >= _max_visit)):
+        raise ValueError('visitIds must be in the range [0, %i).'
+                         % _max_visit)
+    visits, raft_digits, sensor_digits \
+        = np.broadcast_arrays(visits, _location_digits(rafts),
+                              _location_digits(sensors))
+    return (raft_digits*100 + sensor_digits)*_max_visit + visits
+
+def decode_ccdVisitIds(ccdVisitIds):
+    """
+    Recover the visits, rafts, and sensors from ccdVisitIds, e.g., to
+    group query results by raft or sensor without a join to the
+    CcdVisit table.  This is the inverse of make_ccdVisitIds.
+
+    Parameters
+    ----------
+    ccdVisitIds : array_like
+        The ccdVisitIds.
+
+    Returns
+    -------
+    tuple
+        (visits, rafts, sensors) arrays, with the rafts and sensors in
+        'r,c' format, e.g., '2,2'.
+
+    Raises
+    ------
+    ValueError
+        If an id does not correspond to a valid raft and sensor.
+    """
+    ccdVisitIds = np.asarray(ccdVisitIds, dtype=np.int64)
+    if np.any((ccdVisitIds < 0) | (ccdVisitIds >= 10000*_max_visit)):
+        raise ValueError('Invalid ccdVisitId.')
+    rrss, visits = np.divmod(ccdVisitIds, _max_visit)
+    return (visits, _location_strings(rrss//100),
+            _location_strings(rrss % 100))
+
+def _location_digits(locations):
+    """
+    Convert raft or sensor identifiers in 'r,c' format to the
+    two-digit integers rc.
+    """
+    chars = np.asarray(locations).astype('S3')
+    codes = chars.reshape(-1).view(np.uint8).reshape(-1, 3).astype(np.int64)
+    digits = codes[:, ::2] - ord('0')
+    if np.any((digits < 0) | (digits > 9)):
+        raise ValueError("Raft and sensor identifiers must be in 'r,c' "
+                         "format.")
+    return (10*digits[:, 0] + digits[:, 1]).reshape(chars.shape)
+
+def _location_strings(digits):
+    "Convert two-digit integers rc to 'r,c' identifiers."
+    digits = np.asarray(digits)
+    codes = np.empty(digits.shape + (3,), dtype=np.uint8)
+    codes[..., 0] = digits//10 + ord('0')
+    codes[..., 1] = ord(',')
+    codes[..., 2] = digits % 10 + ord('0')
+    return codes.view('S3').reshape(digits.shape).astype(str)
+
 def create_table(connection, table_name, dry_run=False, clobber=False):
     """
     Create the specified table using the corresponding script in the
@@ -123,11 +347,12 @@ def create_table(connection, table_name, dry_run=False, clobber=False):
     """
     if clobber and not dry_run:
         connection.apply('drop table if exists %s' % table_name)
+        connection.invalidate_schema_cache(table_name)
     create_script = os.path.join(lsstUtils.getPackageDir('pserv'), 'sql',
                                  'create_%s.sql' % table_name)
     connection.run_script(create_script, dry_run=dry_run)
 
-def ingest_registry(connection, registry_file, project):
+def ingest_registry(connection, registry_file, project, batch_size=1000):
     """
     Ingest some relevant data from a registry.sqlite3 file into
     the CcdVisit table.
@@ -138,29 +363,182 @@ def ingest_registry(connection, registry_file, project):
         The connection object to use to modify the CcdVisit table.
     registry_file : str
         The sqlite registry file containing the visit information.
+    project : str
+        The name of the project for which the Level 2 analyses run.
+    batch_size : int, optional
+        Number of rows per multi-row insert statement.  Default: 1000
     """
     registry = sqlite3.connect(registry_file)
     query = """select taiObs, visit, filter, raft, ccd,
                expTime from raw where channel='0,0' order by visit asc"""
-    for row in registry.execute(query):
-        taiObs, visit, filter_, raft, ccd, expTime = tuple(row)
-        taiObs = taiObs[:len('2016-03-18 00:00:00.000000')]
-        ccdVisitId = make_ccdVisitId(visit, raft, ccd)
-        query = """insert into CcdVisit set ccdVisitId=%(ccdVisitId)i,
-                   visitId=%(visit)i, ccdName='%(ccd)s',
-                   raftName='%(raft)s', filterName='%(filter_)s',
-                   obsStart='%(taiObs)s', project='%(project)s'
-                   on duplicate key update
-                   visitId=%(visit)i, ccdName='%(ccd)s',
-                   raftName='%(raft)s', filterName='%(filter_)s',
-                   obsStart='%(taiObs)s'""" % locals()
-        try:
-            connection.apply(query)
-        except Exception as eobj:
-            print("query:", query)
-            raise eobj
+    try:
+        rows = registry.execute(query).fetchall()
+    finally:
+        registry.close()
+    if not rows:
+        return
+    taiObs, visits, filters, rafts, ccds = \
+        (np.array(column) for column in list(zip(*rows))[:5])
+    # Truncate the obsStart values to microsecond precision, e.g.,
+    # '2016-03-18 00:00:00.000000'.
+    obsStart = taiObs.astype('%s26' % taiObs.dtype.kind)
+    ccdVisitIds = make_ccdVisitIds(visits, rafts, ccds)
+    rows = zip(ccdVisitIds.tolist(), visits.tolist(), ccds.tolist(),
+               rafts.tolist(), filters.tolist(), obsStart.tolist(),
+               itertools.repeat(project))
+    query = """insert into CcdVisit (ccdVisitId, visitId, ccdName,
+               raftName, filterName, obsStart, project)
+               values (%s, %s, %s, %s, %s, %s, %s)
+               on duplicate key update
+               visitId=values(visitId), ccdName=values(ccdName),
+               raftName=values(raftName), filterName=values(filterName),
+               obsStart=values(obsStart)"""
+    with connection.transaction():
+        connection.apply_many(query, rows, batch_size=batch_size)
+
+def _clipped_std(values, nsigma=3., niter=3):
+    """
+    Compute the standard deviation of the finite values of an array
+    with iterative sigma clipping, following afwMath.STDEVCLIP: the
+    clipping starts about the median with the interquartile range
+    estimate of sigma, then uses the mean and standard deviation of
+    the retained values for each iteration.
+
+    Parameters
+    ----------
+    values : np.array
+        The values.
+    nsigma : float, optional
+        Clipping threshold in units of sigma.  Default: 3.
+    niter : int, optional
+        Number of clipping iterations.  Default: 3
 
-def ingest_calexp_info(connection, repo, project):
+    Returns
+    -------
+    float
+        The clipped standard deviation, or nan if there are fewer than
+        two finite values.
+    """
+    values = np.asarray(values, dtype=np.float64).ravel()
+    values = values[np.isfinite(values)]
+    if values.size < 2:
+        return np.nan
+    center = np.median(values)
+    quartiles = np.percentile(values, (25., 75.))
+    sigma = 0.741*(quartiles[1] - quartiles[0])
+    for _ in range(niter):
+        clipped = values[np.abs(values - center) < nsigma*sigma]
+        if clipped.size < 2:
+            break
+        center = clipped.mean()
+        sigma = clipped.std(ddof=1)
+    return sigma
+
+_butlers = {}
+
+def _calexp_stats(args):
+    """
+    Worker function to compute the CcdVisit statistics for a calexp.
+
+    Parameters
+    ----------
+    args : tuple
+        (repo, dataId, sky_noise_stride, metadata_only).  See
+        ingest_calexp_info.
+
+    Returns
+    -------
+    tuple
+        (ccdVisitId, zeroPoint, seeing, skyBg, skyNoise) or None if the
+        zero point is not available.  skyNoise is None for
+        metadata_only=True.
+    """
+    repo, dataId, sky_noise_stride, metadata_only = args
+    # Each process creates its Butler once.
+    if repo not in _butlers:
+        _butlers[repo] = dp.Butler(repo)
+    butler = _butlers[repo]
+    if metadata_only:
+        # A single pixel subimage has the Calib, Wcs, and Psf, without
+        # reading the pixel data.
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(1, 1))
+        calexp = butler.get('calexp_sub', dataId, bbox=bbox)
+    else:
+        calexp = butler.get('calexp', dataId)
+    ccdVisitId = make_ccdVisitId(dataId['visit'], dataId['raft'],
+                                 dataId['sensor'])
+
+    # Compute zeroPoint, seeing, skyBg, skyNoise column values.
+    try:
+        zeroPoint = calexp.getCalib().getFluxMag0()[0]
+    except:
+        return None
+    # For the psf_fwhm (=seeing) calculation, see
+    # https://github.com/lsst/meas_deblender/blob/master/python/lsst/meas/deblender/deblend.py#L227
+    pixel_scale = calexp.getWcs().pixelScale().asArcseconds()
+    seeing = (calexp.getPsf().computeShape().getDeterminantRadius()
+              *2.35*pixel_scale)
+    # Retrieving the nominal background image is computationally
+    # expensive and just returns an interpolated version of the
+    # stats_image (see
+    # https://github.com/lsst/afw/blob/master/src/math/BackgroundMI.cc#L87),
+    # so just get the stats image.
+    calexp_bg = butler.get('calexpBackground', dataId)
+    bg_image = calexp_bg[0][0].getStatsImage()
+    skyBg = afwMath.makeStatistics(bg_image, afwMath.MEDIAN).getValue()
+    if metadata_only:
+        skyNoise = None
+    elif sky_noise_stride is not None and sky_noise_stride > 1:
+        pixels = calexp.getMaskedImage().getImage().getArray()
+        skyNoise = _clipped_std(pixels[::sky_noise_stride,
+                                       ::sky_noise_stride])
+    else:
+        skyNoise = afwMath.makeStatistics(calexp.getMaskedImage(),
+                                          afwMath.STDEVCLIP).getValue()
+    return ccdVisitId, zeroPoint, seeing, skyBg, skyNoise
+
+def _update_CcdVisit_stats(connection, rows, project, batch_size=1000):
+    """
+    Update the zeroPoint, seeing, skyBg, and skyNoise columns of the
+    CcdVisit table with a single join-update from a temporary table.
+    Null skyNoise values leave the existing values unchanged.
+
+    Parameters
+    ----------
+    connection : desc.pserv.DbConnection
+        The connection object to use to modify the CcdVisit table.
+    rows : sequence
+        (ccdVisitId, zeroPoint, seeing, skyBg, skyNoise) tuples.
+    project : str
+        The project name.
+    batch_size : int, optional
+        Number of rows per insert into the temporary table.
+        Default: 1000
+    """
+    # MySQL does not accept nan, so use NULL for non-finite values.
+    rows = [tuple(x if x is None or np.isfinite(x) else None for x in row)
+            for row in rows]
+    connection.apply("""create temporary table if not exists
+                        CcdVisit_stats (ccdVisitId BIGINT PRIMARY KEY,
+                        zeroPoint FLOAT, seeing FLOAT, skyBg FLOAT,
+                        skyNoise FLOAT)""")
+    try:
+        with connection.transaction():
+            connection.apply('delete from CcdVisit_stats')
+            connection.apply_many("""insert into CcdVisit_stats
+                                     values (%s, %s, %s, %s, %s)""",
+                                  rows, batch_size=batch_size)
+            connection.apply("""update CcdVisit c join CcdVisit_stats s
+                                on c.ccdVisitId=s.ccdVisitId
+                                set c.zeroPoint=s.zeroPoint,
+                                c.seeing=s.seeing, c.skyBg=s.skyBg,
+                                c.skyNoise=coalesce(s.skyNoise, c.skyNoise)
+                                where c.project='%s'""" % project)
+    finally:
+        connection.apply('drop temporary table if exists CcdVisit_stats')
+
+def ingest_calexp_info(connection, repo, project, processes=1,
+                       sky_noise_stride=None, metadata_only=False):
     """
     Extract information such as zeroPoint, seeing, sky background, sky
     noise, etc., from the calexp products and insert the values into
@@ -177,6 +555,18 @@ def ingest_calexp_info(connection, repo, project):
         run.  This is used to differentiate different projects in
         the MySQL tables that may have colliding primary keys, e.g.,
         various runs of Twinkles, or PhoSim Deep results.
+    processes : int, optional
+        Number of worker processes used to read the calexps.
+        Default: 1
+    sky_noise_stride : int, optional
+        If greater than 1, estimate skyNoise from every
+        sky_noise_stride-th pixel in each direction with a numpy
+        clipped standard deviation, instead of using afwMath.STDEVCLIP
+        on the full masked image.  Default: None
+    metadata_only : bool, optional
+        If True, read only the calibration, WCS, and PSF of each
+        calexp and not its pixels.  skyNoise is then left unchanged.
+        Default: False
     """
     # Use the Butler to find all of the visit/sensor combinations.
     butler = dp.Butler(repo)
@@ -184,52 +574,113 @@ def ingest_calexp_info(connection, repo, project):
     num_datarefs = len(datarefs)
     print('Ingesting %i visit/sensor combinations' % num_datarefs)
     sys.stdout.flush()
-    nrows = 0
-    for dataref in datarefs:
-        if nrows % int(num_datarefs/20) == 0:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        calexp = dataref.get('calexp')
-        calexp_bg = dataref.get('calexpBackground')
-        ccdVisitId = make_ccdVisitId(dataref.dataId['visit'],
-                                     dataref.dataId['raft'],
-                                     dataref.dataId['sensor'])
-
-        # Compute zeroPoint, seeing, skyBg, skyNoise column values.
-        try:
-            zeroPoint = calexp.getCalib().getFluxMag0()[0]
-        except:
-            continue
-        # For the psf_fwhm (=seeing) calculation, see
-        # https://github.com/lsst/meas_deblender/blob/master/python/lsst/meas/deblender/deblend.py#L227
-        pixel_scale = calexp.getWcs().pixelScale().asArcseconds()
-        seeing = (calexp.getPsf().computeShape().getDeterminantRadius()
-                  *2.35*pixel_scale)
-        # Retrieving the nominal background image is computationally
-        # expensive and just returns an interpolated version of the
-        # stats_image (see
-        # https://github.com/lsst/afw/blob/master/src/math/BackgroundMI.cc#L87),
-        # so just get the stats image.
-        #bg_image = calexp_bg.getImage()
-        bg_image = calexp_bg[0][0].getStatsImage()
-        skyBg = afwMath.makeStatistics(bg_image, afwMath.MEDIAN).getValue()
-        skyNoise = afwMath.makeStatistics(calexp.getMaskedImage(),
-                                          afwMath.STDEVCLIP).getValue()
-        query = """update CcdVisit set zeroPoint=%(zeroPoint)15.9e,
-                   seeing=%(seeing)15.9e,
-                   skyBg=%(skyBg)15.9e, skyNoise=%(skyNoise)15.9e
-                   where ccdVisitId=%(ccdVisitId)i and
-                   project='%(project)s'""" % locals()
-        connection.apply(query)
-        nrows += 1
+    tasks = [(repo, dict(dataref.dataId), sky_noise_stride, metadata_only)
+             for dataref in datarefs]
+    rows = []
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(_calexp_stats, tasks)
+    else:
+        pool = None
+        results = (_calexp_stats(task) for task in tasks)
+    try:
+        for i, row in enumerate(results):
+            if i % max(num_datarefs//20, 1) == 0:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+            if row is not None:
+                rows.append(row)
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
     print('!')
+    if rows:
+        _update_CcdVisit_stats(connection, rows, project)
+
+def make_ForcedSource_mapping(ccdVisitId, flux_calibration, project,
+                              psFlux='base_PsfFlux_flux',
+                              psFlux_Sigma='base_PsfFlux_fluxSigma',
+                              flags=0):
+    """
+    Make the column mapping and callbacks used by
+    create_csv_file_from_fits to convert a forced source catalog for
+    loading into the ForcedSource table.  See ingest_ForcedSource_data
+    for a description of the parameters.
+
+    Returns
+    -------
+    tuple
+        (column_mapping, callbacks)
+    """
+    column_mapping = OrderedDict((('objectId', 'objectId'),
+                                  ('ccdVisitId', ccdVisitId),
+                                  ('psFlux', psFlux),
+                                  ('psFlux_Sigma', psFlux_Sigma),
+                                  ('flags', flags),
+                                  ('project', project)))
+    # Callbacks to apply calibration and convert to nanomaggies.
+    callbacks = dict(((psFlux, flux_calibration),
+                      (psFlux_Sigma, flux_calibration)))
+    return column_mapping, callbacks
+
+def make_ForcedSourceExtra_mapping(ccdVisitId, flux_calibration, project,
+                                   radii=('3_0', '9_0', '17_0', '25_0',
+                                          '50_0'),
+                                   flags=0):
+    """
+    Make the column mapping and callbacks used by
+    create_csv_file_from_fits to convert the aperture fluxes of a
+    forced source catalog for loading into the ForcedSourceExtra
+    table.
+
+    Parameters
+    ----------
+    ccdVisitId : int
+        Unique identifier of the visit-raft-sensor combination.
+    flux_calibration : function
+        A callback function to convert from ADU to nanomaggies.
+    project : str
+        The project name.
+    radii : tuple, optional
+        The labels of the base_CircularApertureFlux radii, as used in
+        the ForcedSourceExtra column names.
+    flags : int, optional
+        Value to insert in the flag column.  Default: 0
+
+    Returns
+    -------
+    tuple
+        (column_mapping, callbacks)
+    """
+    column_mapping = OrderedDict((('objectId', 'objectId'),
+                                  ('ccdVisitId', ccdVisitId)))
+    callbacks = dict()
+    for radius in radii:
+        for suffix, fits_suffix in (('Flux', 'flux'),
+                                    ('Flux_Sigma', 'fluxSigma')):
+            colname = 'base_CircularApertureFlux_%s_%s' % (radius,
+                                                           fits_suffix)
+            column_mapping['ap_%s_%s' % (radius, suffix)] = colname
+            callbacks[colname] = flux_calibration
+    column_mapping['flags'] = flags
+    column_mapping['project'] = project
+    return column_mapping, callbacks
+
+# Functions to make the column mappings and callbacks for the tables
+# filled from the forced source catalogs, keyed by table name.
+forced_source_mappings = OrderedDict(
+    (('ForcedSource', make_ForcedSource_mapping),
+     ('ForcedSourceExtra', make_ForcedSourceExtra_mapping)))
 
 def ingest_ForcedSource_data(connection, catalog_file, ccdVisitId,
                              flux_calibration, project,
                              psFlux='base_PsfFlux_flux',
                              psFlux_Sigma='base_PsfFlux_fluxSigma',
                              flags=0, fits_hdunum=1, csv_file='temp.csv',
-                             cleanup=True):
+                             cleanup=True, use_fifo=False):
     """
     Load the forced source catalog data into the ForcedSource table.
     Create a temporary csv file to take advantage of the efficient
@@ -270,22 +721,91 @@ def ingest_ForcedSource_data(connection, catalog_file, ccdVisitId,
         'LOAD DATA LOCAL INFILE' statement. Default: 'temp.csv'
     cleanup : bool, optional
         Flag to delete the csv_file after loading the data. Default: True
+    use_fifo : bool, optional
+        Flag to stream the csv data to the server through a named pipe
+        instead of writing csv_file.  Default: False
+
+    Returns
+    -------
+    int
+        The number of rows loaded.
     """
-    column_mapping = OrderedDict((('objectId', 'objectId'),
-                                  ('ccdVisitId', ccdVisitId),
-                                  ('psFlux', psFlux),
-                                  ('psFlux_Sigma', psFlux_Sigma),
-                                  ('flags', flags),
-                                  ('project', project)))
-    # Callbacks to apply calibration and convert to nanomaggies.
-    callbacks = dict(((psFlux, flux_calibration),
-                      (psFlux_Sigma, flux_calibration)))
+    column_mapping, callbacks \
+        = make_ForcedSource_mapping(ccdVisitId, flux_calibration, project,
+                                    psFlux=psFlux, psFlux_Sigma=psFlux_Sigma,
+                                    flags=flags)
+    if use_fifo:
+        csv_text = csv_text_from_fits(catalog_file, fits_hdunum,
+                                      column_mapping=column_mapping,
+                                      callbacks=callbacks)
+        return connection.load_csv_stream('ForcedSource', csv_text)
     create_csv_file_from_fits(catalog_file, fits_hdunum, csv_file,
                               column_mapping=column_mapping,
                               callbacks=callbacks)
-    connection.load_csv('ForcedSource', csv_file)
+    nrows = connection.load_csv('ForcedSource', csv_file)
     if cleanup:
         os.remove(csv_file)
+    return nrows
+
+def ingest_forced_source_tables(connection, catalog_file, ccdVisitId,
+                                flux_calibration, project,
+                                table_names=('ForcedSource',
+                                             'ForcedSourceExtra'),
+                                fits_hdunum=1, csv_prefix='temp',
+                                cleanup=True):
+    """
+    Load the forced source catalog data into several tables with a
+    single read of the catalog.  A csv file is written for each table
+    by create_csv_files_from_fits and then loaded.
+
+    Parameters
+    ----------
+    connection : desc.pserv.DbConnection
+        The connection object to use to load the tables.
+    catalog_file : str
+        The path to the catalog file produced by the forcedPhotCcd.py
+        task.
+    ccdVisitId : int
+        Unique identifier of the visit-raft-sensor combination.
+    flux_calibration : function
+        A callback function to convert from ADU to nanomaggies.
+    project : str
+        The project name.
+    table_names : sequence, optional
+        The tables to fill.  These must be keys of
+        forced_source_mappings.
+        Default: ('ForcedSource', 'ForcedSourceExtra')
+    fits_hdunum : int, optional
+        The HDU number of the binary table containing the forced source
+        data.
+    csv_prefix : str, optional
+        Prefix of the csv file names, which are csv_prefix + '_' +
+        table name + '.csv'.  Default: 'temp'
+    cleanup : bool, optional
+        Flag to delete the csv files after loading the data.
+        Default: True
+
+    Returns
+    -------
+    OrderedDict
+        The numbers of rows loaded, keyed by table name.
+    """
+    targets = OrderedDict()
+    for table_name in table_names:
+        csv_file = '%s_%s.csv' % (csv_prefix, table_name)
+        targets[csv_file] = forced_source_mappings[table_name](
+            ccdVisitId, flux_calibration, project)
+    nrows = OrderedDict()
+    try:
+        create_csv_files_from_fits(catalog_file, fits_hdunum, targets)
+        for table_name, csv_file in zip(table_names, targets):
+            nrows[table_name] = connection.load_csv(table_name, csv_file)
+        return nrows
+    finally:
+        if cleanup:
+            for csv_file in targets:
+                if os.path.exists(csv_file):
+                    os.remove(csv_file)
 
 def ingest_Object_data(connection, catalog_file, project):
     """
@@ -303,33 +823,31 @@ def ingest_Object_data(connection, catalog_file, project):
         run.  This is used to differentiate different projects in
         the MySQL tables that may have colliding primary keys, e.g.,
         various runs of Twinkles, or PhoSim Deep results.
+
+    Returns
+    -------
+    int
+        The number of objects in the catalog.
     """
-    data = fits.open(catalog_file)[1].data
-    nobjs = len(data['id'])
-    print("Ingesting %i objects" % nobjs)
-    sys.stdout.flush()
-    nrows = 0
-    for objectId, ra, dec, parent, extendedness \
-            in zip(data['id'],
-                   data['coord_ra'],
-                   data['coord_dec'],
-                   data['parent'],
-                   data['base_ClassificationExtendedness_value']):
-        if nrows % int(nobjs/20) == 0:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        ra_val = ra*180./np.pi
-        dec_val = dec*180./np.pi
-        if np.isnan(extendedness):
-            extendedness = 1.
-        query = """insert into Object
-                   (objectId, parentObjectId, psRa, psDecl, extendedness,
-                   project)
-                   values (%i, %i, %17.9e, %17.9e, %17.9e, '%s')
-                   on duplicate key update psRa=%17.9e, psDecl=%17.9e,
-                   extendedness=%17.9e""" \
-            % (objectId, parent, ra_val, dec_val, extendedness, project,
-               ra_val, dec_val, extendedness)
-        connection.apply(query)
-        nrows += 1
-    print("!")
+    with fits.open(catalog_file, memmap=True) as hdulist:
+        data = hdulist[1].data
+        nobjs = len(data)
+        print("Ingesting %i objects" % nobjs)
+        sys.stdout.flush()
+        extendedness = data['base_ClassificationExtendedness_value']
+        columns = OrderedDict(
+            (('objectId', data['id']),
+             ('parentObjectId', data['parent']),
+             ('psRa', data['coord_ra']*180./np.pi),
+             ('psDecl', data['coord_dec']*180./np.pi),
+             ('extendedness', np.where(np.isnan(extendedness), 1.,
+                                       extendedness)),
+             ('project', project)))
+        # Load into a staging table and upsert into Object with a
+        # single INSERT ... SELECT ... ON DUPLICATE KEY UPDATE.
+        with StagingTable(connection, 'Object', columns=columns.keys(),
+                          conflict='update',
+                          update_columns=('psRa', 'psDecl',
+                                          'extendedness')) as staging:
+            staging.load_csv_stream(csv_text_from_columns(columns))
+    return nobjs
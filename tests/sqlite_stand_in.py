@@ -0,0 +1,167 @@
+"""
+SQLite stand-in for DbConnection and FITS catalog helpers shared by
+the unit tests that do not need a MySQL server.
+"""
+from __future__ import absolute_import, print_function
+import os
+import re
+import csv
+import sqlite3
+from contextlib import contextmanager
+from collections import OrderedDict
+import numpy as np
+import astropy.io.fits as fits
+
+_sql_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'sql')
+
+_join_update = re.compile(r'^update (\w+) (\w+) join (\w+) (\w+) on (.+?) '
+                          r'set (.+?) where (.+)$', re.IGNORECASE)
+
+def _sqlite_sql(sql):
+    """
+    Translate the MySQL statements used by desc.pserv to SQLite.
+    Only the constructs used by the package are handled.
+    """
+    sql = ' '.join(sql.split())
+    match = _join_update.match(sql)
+    if match:
+        # update T a join S b on COND set a.x=... where W
+        #   -> update T as a set x=... from S as b where (COND) and W
+        target, alias, other, other_alias, on, assignments, where \
+            = match.groups()
+        assignments = re.sub(r'(^|, )%s\.(\w+)=' % alias, r'\1\2=',
+                             assignments)
+        sql = 'update %s as %s set %s from %s as %s where (%s) and %s' \
+              % (target, alias, assignments, other, other_alias, on, where)
+    sql = re.sub(r'^insert ignore into', 'insert or ignore into', sql,
+                 flags=re.IGNORECASE)
+    sql = re.sub(r'^drop temporary table', 'drop table', sql,
+                 flags=re.IGNORECASE)
+    upsert = re.search(r' on duplicate key update (.+)$', sql, re.IGNORECASE)
+    if upsert:
+        assignments = re.sub(r'values\((\w+)\)', r'excluded.\1',
+                             upsert.group(1), flags=re.IGNORECASE)
+        sql = sql[:upsert.start()]
+        if re.search(r' select ', sql, re.IGNORECASE):
+            # SQLite needs a where clause before the upsert clause of
+            # an insert ... select statement.
+            sql = re.sub(r'( order by .+)?$', r' where true\1', sql,
+                         count=1, flags=re.IGNORECASE)
+        sql += ' on conflict do update set ' + assignments
+    return sql
+
+class SQLiteConnection(object):
+    """
+    Stand-in for DbConnection that uses an SQLite database file, or an
+    in-memory database for the default db_file=':memory:'.  The MySQL
+    statements used by desc.pserv are translated by _sqlite_sql.
+    """
+    def __init__(self, db_file=':memory:'):
+        self.db_file = db_file
+        self.sqlite = sqlite3.connect(db_file, timeout=60,
+                                      check_same_thread=False)
+        self._in_transaction = False
+
+    @contextmanager
+    def checkout(self):
+        connection = SQLiteConnection(self.db_file)
+        try:
+            yield connection
+        finally:
+            connection.sqlite.close()
+
+    @contextmanager
+    def transaction(self, commit_every=None):
+        if self._in_transaction:
+            yield self
+            return
+        self._in_transaction = True
+        try:
+            yield self
+        except:
+            self.sqlite.rollback()
+            raise
+        else:
+            self.sqlite.commit()
+        finally:
+            self._in_transaction = False
+
+    @contextmanager
+    def _statement(self):
+        "Commit each statement outside of a transaction block."
+        if self._in_transaction:
+            yield
+            return
+        with self.sqlite:
+            yield
+
+    def apply(self, sql, cursorFunc=lambda curs: None):
+        with self._statement():
+            return cursorFunc(self.sqlite.execute(_sqlite_sql(sql)))
+
+    def apply_many(self, sql, rows, batch_size=1000):
+        sql = _sqlite_sql(sql).replace('%s', '?')
+        with self._statement():
+            return self.sqlite.executemany(sql, [tuple(row)
+                                                 for row in rows]).rowcount
+
+    def run_script(self, script, dry_run=False):
+        with open(script) as script_data:
+            self.apply(script_data.read())
+
+    def load_csv(self, table_name, csv_file):
+        with open(csv_file) as csv_input:
+            return self.load_csv_stream(table_name, csv_input)
+
+    def load_csv_stream(self, table_name, csv_text):
+        reader = csv.reader(''.join(csv_text).splitlines())
+        header = next(reader)
+        rows = list(reader)
+        sql = 'insert into %s (%s) values (%s)' \
+              % (table_name, ', '.join(header), ', '.join('?'*len(header)))
+        with self._statement():
+            self.sqlite.executemany(sql, rows)
+        return len(rows)
+
+    def get_table_schema(self, table_name):
+        return tuple((x[1], x[2].lower()) for x in self.apply(
+            'pragma table_info(%s)' % table_name, lambda curs: curs))
+
+    def get_primary_key(self, table_name):
+        columns = self.apply('pragma table_info(%s)' % table_name,
+                             lambda curs: [x for x in curs if x[5] > 0])
+        return tuple(x[1] for x in sorted(columns, key=lambda x: x[5]))
+
+    def cache_table_schema(self, table_name, data_types):
+        pass
+
+    def invalidate_schema_cache(self, table_name=None):
+        pass
+
+    def rows(self, table_name):
+        "Return the rows of a table."
+        return self.apply('select * from %s' % table_name,
+                          lambda curs: curs.fetchall())
+
+def create_table(connection, table_name):
+    "Create a table with the corresponding script in the sql subfolder."
+    connection.run_script(os.path.join(_sql_dir,
+                                       'create_%s.sql' % table_name))
+
+def write_table(fits_file, columns):
+    """
+    Write a FITS binary table with the int64 and float64 columns in an
+    OrderedDict of arrays keyed by column name.
+    """
+    hdu = fits.BinTableHDU.from_columns(
+        [fits.Column(name=name, format='K' if values.dtype.kind in 'iu'
+                     else 'D', array=values)
+         for name, values in columns.items()])
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(fits_file)
+
+def write_catalog(fits_file, ids):
+    "Write a FITS binary table with id and flux columns."
+    write_table(fits_file, OrderedDict((('id', np.array(ids)),
+                                        ('flux', np.array(ids,
+                                                          dtype=float)))))
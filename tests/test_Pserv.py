@@ -130,6 +130,105 @@ class PservTestCase(unittest.TestCase):
         table_data = self._query_test_table()
         self._compare_to_ref_data(table_data)
 
+    def test_apply_many(self):
+        """
+        Test the apply_many method by inserting the reference data in
+        batches with bound parameters.
+        """
+        query = "insert into %s values (%%s, %%s, %%s, %%s, %%s)" \
+                % self.test_table
+        nrows = self.connection.apply_many(query, self.data, batch_size=3)
+        self.assertEqual(nrows, len(self.data))
+        table_data = self._query_test_table()
+        self._compare_to_ref_data(table_data)
+
+    def _count_rows(self, connection=None):
+        "Count the rows in the test table."
+        if connection is None:
+            connection = self.connection
+        return connection.apply('select count(*) from %s' % self.test_table,
+                                lambda curs: curs.fetchone()[0])
+
+    def test_transaction(self):
+        """
+        Test that transaction blocks commit on exit and roll back on
+        errors.
+        """
+        query = "insert into %s values (%%s, %%s, %%s, %%s, %%s)" \
+                % self.test_table
+        other = desc.pserv.DbConnection(**_db_info)
+        with self.connection.transaction():
+            self.connection.apply_many(query, self.data[:2])
+            self.connection.apply_many(query, self.data[2:])
+            self.assertEqual(self._count_rows(other), 0)
+            other.rollback()
+        self.assertEqual(self._count_rows(other), len(self.data))
+        other.rollback()
+
+        def failed_insert():
+            with self.connection.transaction():
+                self.connection.apply_many(query, self.data)
+                raise RuntimeError('abort')
+        self.assertRaises(RuntimeError, failed_insert)
+        self.assertEqual(self._count_rows(), len(self.data))
+
+        # Test intermediate commits.
+        with self.connection.transaction(commit_every=2):
+            self.connection.apply_many(query, self.data[:2])
+            self.assertEqual(self._count_rows(other), len(self.data) + 2)
+            other.rollback()
+        other.close()
+
+    def test_autocommit_policy(self):
+        "Test disabling autocommit for a connection."
+        connection = desc.pserv.DbConnection(autocommit=False, **_db_info)
+        self.assertFalse(connection.autocommit)
+        self._fill_test_table()
+        connection.apply('delete from %s' % self.test_table)
+        self.assertEqual(self._count_rows(), len(self.data))
+        connection.rollback()
+        self.assertEqual(self._count_rows(connection), len(self.data))
+        connection.apply('delete from %s' % self.test_table)
+        connection.commit()
+        self.connection.rollback()
+        self.assertEqual(self._count_rows(), 0)
+        connection.close()
+
+    def test_instrumentation(self):
+        "Test the recording of statement execution statistics."
+        stats = self.connection.enable_instrumentation()
+        self._fill_test_table()
+        self._fill_test_table()
+        self._query_test_table()
+        entries = stats.to_dict()['statements']
+        insert = "insert into %s values (?, ?, ?, ?, ?), ...;" \
+                 % self.test_table
+        self.assertEqual(entries[insert]['count'], 2)
+        self.assertEqual(entries[insert]['nrows'], 2*len(self.data))
+        self.assertEqual(stats.to_dict()['commits']['count'], 2)
+        self.assertIn(insert, stats.summary(width=200))
+        with self.connection.checkout() as other:
+            self.assertIs(other.stats, stats)
+
+    def test_connection_pool(self):
+        """
+        Test that connections to the same database share an engine and
+        that checked out connections are returned to the pool.
+        """
+        connection = desc.pserv.DbConnection(**_db_info)
+        self.assertIs(connection._engine, self.connection._engine)
+        checkedout = self.connection._engine.pool.checkedout()
+        with self.connection.checkout() as other:
+            self.assertIs(other._engine, self.connection._engine)
+            self.assertEqual(other.apply('select 1', lambda c: c.fetchone()[0]),
+                             1)
+            self.assertEqual(self.connection._engine.pool.checkedout(),
+                             checkedout + 1)
+        self.assertEqual(self.connection._engine.pool.checkedout(), checkedout)
+        connection.close()
+        self.assertEqual(self.connection._engine.pool.checkedout(),
+                         checkedout - 1)
+
     def _create_fits_bintable(self):
         """
         Create the test FITS file with a binary table with the data in
@@ -306,6 +405,96 @@ class PservTestCase(unittest.TestCase):
         table_data = self._query_test_table()
         self._compare_to_ref_data(table_data)
 
+    def test_load_csv_stream(self):
+        """
+        Test loading csv data streamed from a FITS binary table through
+        a named pipe.
+        """
+        column_mapping = OrderedDict((('keywd', 'KEYWORD'),
+                                      ('int_value', 'INT_VALUE'),
+                                      ('float_value', 'FLOAT_VALUE'),
+                                      ('double_value', 'DOUBLE_VALUE'),
+                                      ('project', self.project)))
+        csv_text = desc.pserv.csv_text_from_fits(self.fits_file, 1,
+                                                 column_mapping=column_mapping,
+                                                 block_size=3)
+        with open(self.csv_file) as csv_input:
+            self.assertEqual(''.join(csv_text), csv_input.read())
+        csv_text = desc.pserv.csv_text_from_fits(self.fits_file, 1,
+                                                 column_mapping=column_mapping,
+                                                 block_size=3)
+        self.connection.load_csv_stream(self.test_table, csv_text)
+        table_data = self._query_test_table()
+        self._compare_to_ref_data(table_data)
+
+    def test_staging_table(self):
+        """
+        Test loading data via a staging table with the conflict
+        policies for existing primary keys.
+        """
+        self.connection.apply('alter table %s add primary key (keywd)'
+                              % self.test_table)
+        self.connection.invalidate_schema_cache(self.test_table)
+        self.assertEqual(self.connection.get_primary_key(self.test_table),
+                         ('keywd',))
+        with desc.pserv.StagingTable(self.connection, self.test_table) \
+                as staging:
+            staging.load_csv(self.csv_file)
+            staging_name = staging.name
+        self._compare_to_ref_data(self._query_test_table())
+        self.assertEqual(self.connection.get_table_schema(staging_name), ())
+
+        # The staging table does not commit an enclosing transaction.
+        def rolled_back_load():
+            with self.connection.transaction():
+                self.connection.apply('delete from %s' % self.test_table)
+                with desc.pserv.StagingTable(self.connection, self.test_table,
+                                             conflict='replace') as staging:
+                    staging.load_csv(self.csv_file)
+                raise RuntimeError('roll back')
+        self.assertRaises(RuntimeError, rolled_back_load)
+        self.assertEqual(len(self._query_test_table()), len(self.data))
+        self._compare_to_ref_data(self._query_test_table())
+
+        query = "update %s set int_value=0" % self.test_table
+        self.connection.apply(query)
+        with desc.pserv.StagingTable(self.connection, self.test_table,
+                                     conflict='ignore') as staging:
+            staging.load_csv(self.csv_file)
+        self.assertTrue(all(row[1] == 0 for row in self._query_test_table()))
+
+        with desc.pserv.StagingTable(self.connection, self.test_table,
+                                     conflict='update',
+                                     update_columns=('int_value',)) \
+                as staging:
+            staging.load_csv(self.csv_file)
+        self._compare_to_ref_data(self._query_test_table())
+
+        def duplicate_load():
+            with desc.pserv.StagingTable(self.connection,
+                                         self.test_table) as staging:
+                staging.load_csv(self.csv_file)
+        self.assertRaises(Exception, duplicate_load)
+
+    def test_schema_cache(self):
+        """
+        Test the caching and invalidation of table schema information.
+        """
+        schema = self.connection.get_table_schema(self.test_table)
+        self.assertEqual(tuple(x[0] for x in schema),
+                         ('keywd', 'int_value', 'float_value',
+                          'double_value', 'project'))
+        self.connection.load_csv(self.test_table, self.csv_file)
+        self.connection.apply('alter table %s drop column double_value'
+                              % self.test_table)
+        self.assertEqual(len(self.connection.get_table_schema(self.test_table)),
+                         5)
+        self.connection.invalidate_schema_cache(self.test_table)
+        self.assertEqual(len(self.connection.get_table_schema(self.test_table)),
+                         4)
+        self.assertRaises(RuntimeError, self.connection.load_csv,
+                          *(self.test_table, self.csv_file))
+
     def test_incorrect_csv_mapping(self):
         """
         Test that an incorrect column mapping raises a RuntimeError.
@@ -398,6 +587,51 @@ class PservTestCase(unittest.TestCase):
         self.assertEqual(df['keywd'].values[0], 'a')
         self.assertAlmostEqual(df['double_value'].values[2], np.pi, places=5)
 
+    def test_get_pandas_data_frame_chunks(self):
+        """
+        Test streaming of query results in chunks and the reduce_query
+        method.
+        """
+        self._fill_test_table()
+        query = "select * from %s order by int_value" % self.test_table
+        chunks = list(self.connection.get_pandas_data_frame(query,
+                                                            chunksize=3))
+        self.assertEqual([df.shape for df in chunks], [(3, 5), (1, 5)])
+        self.assertEqual(chunks[1]['keywd'].values[0], 'c')
+
+        chunks = list(self.connection.iter_query(query, chunksize=2,
+                                                 as_records=True))
+        self.assertEqual([len(x) for x in chunks], [2, 2])
+        self.assertEqual(chunks[0]['int_value'][0], 1)
+
+        query = "select int_value from %s" % self.test_table
+        total = self.connection.reduce_query(
+            query, lambda acc, df: acc + df['int_value'].sum(), initial=0,
+            chunksize=3)
+        self.assertEqual(total, sum(row[1] for row in self.data))
+
+    def test_get_numpy_array(self):
+        """
+        Test get_numpy_array which retrieves a structured array with
+        the table data given a select query.
+        """
+        self._fill_test_table()
+        query = "select * from %s order by int_value" % self.test_table
+        data = self.connection.get_numpy_array(query, chunksize=3)
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data.dtype['int_value'], np.int32)
+        self.assertEqual(data.dtype['float_value'], np.float32)
+        self.assertEqual(data.dtype['double_value'], np.float64)
+        self.assertEqual(data['keywd'][2], 'c')
+        self.assertAlmostEqual(data['double_value'][2], np.pi, places=5)
+
+        # Test overriding the inferred types.
+        query = "select int_value, float_value from %s" % self.test_table
+        data = self.connection.get_numpy_array(
+            query, dtype=dict(int_value=np.int64, float_value=np.float64))
+        self.assertEqual(data.dtype['int_value'], np.int64)
+        self.assertEqual(data.dtype['float_value'], np.float64)
+
 class BinTableDataTestCase(unittest.TestCase):
     "TestCase class for BinTableData class."
     def setUp(self):
@@ -424,5 +658,200 @@ class BinTableDataTestCase(unittest.TestCase):
             for bigint, value in zip(packed, values):
                 self.assertEqual(bigint, value)
 
+    def test_pack_flag_arrays(self):
+        "Test packing and unpacking of 2D arrays of flags."
+        np.random.seed(1234)
+        nrows = 50
+        nflags = 142
+        flags = np.random.random((nrows, nflags)) < 0.3
+        flags[0] = True
+        for nbits in (64, 32, 8, 13):
+            words = desc.pserv.BinTableData.pack_flags(flags, nbits=nbits)
+            self.assertEqual(words.dtype, np.uint64)
+            self.assertEqual(words.shape, (nrows, -(-nflags//nbits)))
+            for row, row_words in zip(flags, words):
+                expected = [sum(2**i for i, flag in
+                                enumerate(row[j*nbits:(j+1)*nbits]) if flag)
+                            for j in range(len(row_words))]
+                self.assertEqual(row_words.tolist(), expected)
+            unpacked = desc.pserv.BinTableData.unpack_flags(words, nflags,
+                                                            nbits=nbits)
+            np.testing.assert_array_equal(unpacked, flags)
+            np.testing.assert_array_equal(
+                desc.pserv.BinTableData.unpack_flags(words[3], nflags,
+                                                     nbits=nbits), flags[3])
+
+    def test_column_projection(self):
+        "Test the selection and lazy reading of columns."
+        np.random.seed(91)
+        nrows = 20
+        flags = np.random.random((nrows, 142)) < 0.5
+        columns = [fits.Column(name='id', format='K', array=np.arange(nrows)),
+                   fits.Column(name='flux', format='D',
+                               array=np.random.random(nrows)),
+                   fits.Column(name='flags', format='142X', array=flags)]
+        bintable = fits.BinTableHDU.from_columns(columns)
+        all_data = desc.pserv.BinTableData(bintable)
+        self.assertEqual(all_data.keys(),
+                         ['id', 'flux', 'FLAGS1', 'FLAGS2', 'FLAGS3'])
+        self.assertEqual(all_data.nrows, nrows)
+        bintable_data = desc.pserv.BinTableData(
+            bintable, columns=('id', 'FLAGS2', 'my project'))
+        self.assertEqual(bintable_data.keys(), ['id', 'FLAGS2'])
+        self.assertEqual(len(bintable_data), 2)
+        self.assertIn('FLAGS2', bintable_data)
+        self.assertNotIn('FLAGS1', bintable_data)
+        self.assertNotIn('flux', bintable_data)
+        self.assertRaises(KeyError, bintable_data.__getitem__, 'flux')
+        # Columns are read when first accessed.
+        self.assertEqual(dict.__len__(bintable_data), 0)
+        np.testing.assert_array_equal(bintable_data['FLAGS2'],
+                                      all_data['FLAGS2'])
+        np.testing.assert_array_equal(bintable_data['id'], np.arange(nrows))
+        self.assertEqual(dict.__len__(bintable_data), 2)
+        expected = desc.pserv.BinTableData.pack_flags(flags)
+        np.testing.assert_array_equal(all_data['FLAGS3'], expected[:, 2])
+
+class CsvTextTestCase(unittest.TestCase):
+    "TestCase class for the csv formatting of FITS binary table data."
+    def setUp(self):
+        self.fits_file = 'test_csv_text.fits'
+        np.random.seed(5678)
+        nrows = 100
+        self.doubles = np.random.normal(size=nrows)*10.**np.arange(-50, 50)
+        self.doubles[::7] = np.nan
+        self.doubles[::11] = np.inf
+        self.floats = np.random.normal(size=nrows).astype(np.float32)
+        self.floats[::5] = -np.inf
+        self.ints = np.arange(-nrows//2, nrows//2)
+        self.strings = np.array(['a', 'b,c', "d'e", 'plain']*(nrows//4))
+        columns = [fits.Column(name='doubles', format='D',
+                               array=self.doubles),
+                   fits.Column(name='floats', format='E', array=self.floats),
+                   fits.Column(name='ints', format='K', array=self.ints),
+                   fits.Column(name='strings', format='8A',
+                               array=self.strings)]
+        hdulist = fits.HDUList([fits.PrimaryHDU(),
+                                fits.BinTableHDU.from_columns(columns)])
+        hdulist.writeto(self.fits_file, clobber=True)
+
+    def tearDown(self):
+        os.remove(self.fits_file)
+
+    @staticmethod
+    def _csv_writer_text(colnames, columns):
+        "Format the columns using csv.writer."
+        rows = [colnames]
+        for row in zip(*columns):
+            rows.append([x if isinstance(x, str) or np.isfinite(x)
+                         else '\\N' for x in row])
+        csv_output = desc.pserv.Pserv.StringIO()
+        writer = csv.writer(csv_output, delimiter=',', lineterminator='\n',
+                            quotechar="'")
+        writer.writerows(rows)
+        return csv_output.getvalue()
+
+    def test_csv_text_from_fits(self):
+        "Test that the csv text matches the output of csv.writer."
+        nrows = len(self.ints)
+        column_mapping = OrderedDict((('doubles', 'doubles'),
+                                      ('floats', 'floats'),
+                                      ('ints', 'ints'),
+                                      ('strings', 'strings'),
+                                      ('project', "my, project"),
+                                      ('zero', 0),
+                                      ('nan', np.nan)))
+        callbacks = dict(floats=lambda x: 2*x)
+        expected = self._csv_writer_text(
+            list(column_mapping.keys()),
+            (self.doubles.tolist(), (2*self.floats).tolist(),
+             self.ints.tolist(), self.strings.tolist(),
+             nrows*["my, project"], nrows*[0], nrows*[np.nan]))
+        for block_size in (1, 7, 1000):
+            csv_text = desc.pserv.csv_text_from_fits(
+                self.fits_file, 1, column_mapping=column_mapping,
+                callbacks=callbacks, block_size=block_size)
+            self.assertEqual(''.join(csv_text), expected)
+
+    def test_added_columns(self):
+        "Test csv output for added columns."
+        nrows = len(self.ints)
+        column_mapping = OrderedDict((('ints', 'ints'), ('added', 'added'),
+                                      ('scaled', 'scaled')))
+        csv_text = desc.pserv.csv_text_from_fits(
+            self.fits_file, 1, column_mapping=column_mapping,
+            callbacks=dict(scaled=lambda x: x/2.),
+            added_columns=dict(added='Run1.1', scaled=3))
+        expected = self._csv_writer_text(
+            list(column_mapping.keys()),
+            (self.ints.tolist(), nrows*['Run1.1'], nrows*[1.5]))
+        self.assertEqual(''.join(csv_text), expected)
+
+    def test_csv_text_from_columns(self):
+        "Test csv output for column arrays and scalars."
+        nrows = len(self.ints)
+        columns = OrderedDict((('doubles', self.doubles),
+                               ('strings', self.strings),
+                               ('project', 'my project')))
+        expected = self._csv_writer_text(
+            list(columns.keys()), (self.doubles.tolist(),
+                                   self.strings.tolist(),
+                                   nrows*['my project']))
+        csv_text = list(desc.pserv.csv_text_from_columns(columns,
+                                                         block_size=40))
+        self.assertEqual(len(csv_text), 4)
+        self.assertEqual(''.join(csv_text), expected)
+
+    def test_row_blocks_from_fits(self):
+        "Test the generator of blocks of rows."
+        column_mapping = OrderedDict((('id', 'ints'), ('flux', 'doubles'),
+                                      ('ccdVisitId', 12345)))
+        blocks = list(desc.pserv.row_blocks_from_fits(
+            self.fits_file, 1, column_mapping=column_mapping,
+            callbacks=dict(doubles=lambda x: 2*x), block_size=30))
+        self.assertEqual([len(block['id']) for block in blocks],
+                         [30, 30, 30, 10])
+        for block in blocks:
+            self.assertEqual(list(block.keys()), ['id', 'flux', 'ccdVisitId'])
+        np.testing.assert_array_equal(
+            np.concatenate([block['id'] for block in blocks]), self.ints)
+        np.testing.assert_array_equal(
+            np.concatenate([block['flux'] for block in blocks]),
+            2*self.doubles)
+        np.testing.assert_array_equal(blocks[-1]['ccdVisitId'], 10*[12345])
+
+    def test_create_csv_files_from_fits(self):
+        "Test writing csv files for several tables in one pass."
+        ncalls = []
+        def scale(x):
+            ncalls.append(len(x))
+            return 2*x
+        targets = OrderedDict()
+        targets['test_table1.csv'] \
+            = (OrderedDict((('id', 'ints'), ('flux', 'doubles'),
+                            ('project', 'my project'))),
+               dict(doubles=scale))
+        targets['test_table2.csv'] \
+            = (OrderedDict((('id', 'ints'), ('flux2', 'doubles'),
+                            ('floats', 'floats'))),
+               dict(doubles=scale))
+        targets['test_table3.csv'] = (None, None)
+        try:
+            desc.pserv.create_csv_files_from_fits(self.fits_file, 1, targets,
+                                                  block_size=30)
+            for csv_file, (column_mapping, callbacks) in targets.items():
+                with open(csv_file) as csv_input:
+                    expected = ''.join(desc.pserv.csv_text_from_fits(
+                        self.fits_file, 1, column_mapping=column_mapping,
+                        callbacks=callbacks))
+                    self.assertEqual(csv_input.read(), expected)
+        finally:
+            for csv_file in targets:
+                if os.path.exists(csv_file):
+                    os.remove(csv_file)
+        # The shared callback was applied once per block during the
+        # single pass, then once for each of the two reference files.
+        self.assertEqual(ncalls, [30, 30, 30, 10, 100, 100])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+"""
+Unit tests for the instrumentation module.
+"""
+from __future__ import absolute_import, print_function
+import json
+import unittest
+import desc.pserv
+
+class InstrumentationTestCase(unittest.TestCase):
+    "TestCase for the fingerprint function and StatementStats class."
+    def test_fingerprint(self):
+        "Test the removal of literals from SQL statements."
+        sql = """update CcdVisit set zeroPoint= 1.234567890e+02,
+                 seeing=3.2 where ccdVisitId=22110921297 and
+                 project='Twinkles Run3'"""
+        self.assertEqual(desc.pserv.fingerprint(sql),
+                         'update CcdVisit set zeroPoint= ?, seeing=? where '
+                         + 'ccdVisitId=? and project=?')
+        sql = """insert into Object (objectId, FLAGS1) values (%s, %s)
+                 on duplicate key update FLAGS1=values(FLAGS1)"""
+        self.assertEqual(desc.pserv.fingerprint(sql),
+                         'insert into Object (objectId, FLAGS1) values '
+                         + '(?, ?) on duplicate key update '
+                         + 'FLAGS1=values(FLAGS1)')
+        sql = "insert into t values (1, 'a'), (2, 'b''c'),(3,'d')"
+        self.assertEqual(desc.pserv.fingerprint(sql),
+                         'insert into t values (?, ?), ...')
+
+    def test_statement_stats(self):
+        "Test the accumulation of statement statistics."
+        stats = desc.pserv.StatementStats()
+        stats.record('select zeroPoint from CcdVisit where ccdVisitId=1',
+                     0.002, 1)
+        stats.record('select zeroPoint from CcdVisit where ccdVisitId=2',
+                     0.5, 1)
+        stats.record('drop table if exists my_test', 0.1, -1)
+        stats.record_commit(0.01)
+        results = json.loads(stats.to_json())
+        key = 'select zeroPoint from CcdVisit where ccdVisitId=?'
+        self.assertEqual(list(results['statements'].keys())[0], key)
+        entry = results['statements'][key]
+        self.assertEqual(entry['count'], 2)
+        self.assertEqual(entry['nrows'], 2)
+        self.assertAlmostEqual(entry['total_time'], 0.502)
+        self.assertAlmostEqual(entry['max_time'], 0.5)
+        self.assertEqual(entry['histogram']['1e-3'], 1)
+        self.assertEqual(entry['histogram']['1e-1'], 1)
+        self.assertEqual(
+            results['statements']['drop table if exists my_test']['nrows'], 0)
+        self.assertEqual(results['commits']['count'], 1)
+        self.assertEqual(len(stats.summary().split('\n')), 4)
+
+if __name__ == '__main__':
+    unittest.main()
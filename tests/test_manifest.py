@@ -0,0 +1,89 @@
+"""
+Unit tests for the manifest module.
+"""
+from __future__ import absolute_import, print_function
+import os
+import shutil
+import tempfile
+import unittest
+import desc.pserv
+
+class IngestManifestTestCase(unittest.TestCase):
+    "TestCase for the IngestManifest class."
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.tmpdir, 'manifest.sqlite3')
+        self.catalogs = []
+        for i in range(3):
+            catalog = os.path.join(self.tmpdir, 'catalog_%i.fits' % i)
+            with open(catalog, 'w') as output:
+                output.write('catalog %i\n' % i)
+            self.catalogs.append(catalog)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume(self):
+        "Test that loaded catalogs are skipped by a new manifest object."
+        tables = ['ForcedSource', 'ForcedSourceExtra']
+        with desc.pserv.IngestManifest(self.manifest_file) as manifest:
+            self.assertEqual(manifest.pending(self.catalogs[0], tables),
+                             tables)
+            manifest.record_loaded(self.catalogs[0], 'ForcedSource', 10)
+            manifest.record_loaded(self.catalogs[0], 'ForcedSourceExtra', 10)
+            manifest.record_loaded(self.catalogs[1], 'ForcedSource', 20)
+            manifest.record_failed(self.catalogs[1], 'ForcedSourceExtra',
+                                   RuntimeError('bad catalog'))
+        with desc.pserv.IngestManifest(self.manifest_file) as manifest:
+            self.assertEqual(manifest.pending(self.catalogs[0], tables), [])
+            self.assertEqual(manifest.pending(self.catalogs[1], tables),
+                             ['ForcedSourceExtra'])
+            self.assertEqual(manifest.pending(self.catalogs[2], tables),
+                             tables)
+            entry = manifest.entry(self.catalogs[1], 'ForcedSourceExtra')
+            self.assertEqual(entry.status, 'failed')
+            self.assertEqual(entry.error, 'RuntimeError: bad catalog')
+            self.assertEqual(entry.size, os.path.getsize(self.catalogs[1]))
+            self.assertEqual(len(manifest.entries()), 4)
+            self.assertEqual(len(manifest.entries(status='loaded')), 3)
+            self.assertEqual(
+                len(manifest.entries(table_name='ForcedSourceExtra')), 2)
+            summary = manifest.summary()
+            self.assertEqual(summary[('ForcedSource', 'loaded')], (2, 30))
+            self.assertEqual(summary[('ForcedSourceExtra', 'failed')],
+                             (1, None))
+            # Retrying the failure replaces the entry.
+            manifest.record_loaded(self.catalogs[1], 'ForcedSourceExtra', 20)
+            self.assertEqual(manifest.pending(self.catalogs[1], tables), [])
+            self.assertEqual(len(manifest.entries()), 4)
+
+    def test_changed_files(self):
+        "Test that catalogs that have changed are ingested again."
+        catalog = self.catalogs[0]
+        with desc.pserv.IngestManifest(self.manifest_file) as manifest:
+            manifest.record_loaded(catalog, 'ForcedSource', 10)
+            self.assertFalse(manifest.needs_ingest(catalog, 'ForcedSource'))
+            with open(catalog, 'a') as output:
+                output.write('more rows\n')
+            self.assertTrue(manifest.needs_ingest(catalog, 'ForcedSource'))
+        with desc.pserv.IngestManifest(self.manifest_file,
+                                       use_checksums=True) as manifest:
+            manifest.record_loaded(catalog, 'ForcedSource', 10)
+            entry = manifest.entry(catalog, 'ForcedSource')
+            self.assertEqual(entry.checksum,
+                             desc.pserv.IngestManifest.checksum(catalog))
+            # Same size and modification time, but different contents.
+            stat = os.stat(catalog)
+            with open(catalog, 'r+') as output:
+                output.write('C')
+            os.utime(catalog, (stat.st_atime, stat.st_mtime))
+            self.assertTrue(manifest.needs_ingest(catalog, 'ForcedSource'))
+            # Catalogs that have been removed are not ingested again.
+            os.remove(catalog)
+            manifest.record_loaded(self.catalogs[1], 'ForcedSource', 10)
+            os.remove(self.catalogs[1])
+            self.assertFalse(manifest.needs_ingest(self.catalogs[1],
+                                                   'ForcedSource'))
+
+if __name__ == '__main__':
+    unittest.main()
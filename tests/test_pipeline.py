@@ -0,0 +1,162 @@
+"""
+Unit tests for the pipeline module.
+"""
+from __future__ import absolute_import, print_function
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from warnings import filterwarnings
+import desc.pserv
+import desc.pserv.pipeline as pserv_pipeline
+from sqlite_stand_in import SQLiteConnection, write_catalog
+
+filterwarnings('ignore')
+
+class PipelineTestCase(unittest.TestCase):
+    "TestCase for the pipeline module using an SQLite stand-in database."
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.connection = SQLiteConnection(os.path.join(self.tmpdir,
+                                                        'test.db'))
+        self.connection.apply('''create table ForcedSource
+                                 (objectId BIGINT, psFlux DOUBLE,
+                                  project CHAR(30))''')
+        self.column_mapping = OrderedDict((('objectId', 'id'),
+                                           ('psFlux', 'flux'),
+                                           ('project', 'my project')))
+        self.jobs = []
+        for i in range(5):
+            fits_file = os.path.join(self.tmpdir, 'catalog_%i.fits' % i)
+            write_catalog(fits_file, range(10*i, 10*i + 3))
+            self.jobs.append(pserv_pipeline.CatalogJob(fits_file, fits_file,
+                                                       'ForcedSource',
+                                                       self.column_mapping))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ingest_pipelined(self):
+        "Test that all catalogs are loaded and failures are reported."
+        missing_file = os.path.join(self.tmpdir, 'missing.fits')
+        jobs = self.jobs + [pserv_pipeline.CatalogJob('missing', missing_file,
+                                                      'ForcedSource',
+                                                      self.column_mapping)]
+        failures = pserv_pipeline.ingest_pipelined(self.connection, jobs,
+                                                   processes=2, loaders=2,
+                                                   queue_depth=1,
+                                                   output_dir=self.tmpdir)
+        self.assertEqual(list(failures.keys()), ['missing'])
+        rows = self.connection.rows('ForcedSource')
+        self.assertEqual(len(rows), 15)
+        self.assertEqual(sorted(int(row[0]) for row in rows),
+                         sorted(10*i + j for i in range(5) for j in range(3)))
+        self.assertTrue(all(row[2] == 'my project' for row in rows))
+        # The temporary csv files should have been removed.
+        self.assertEqual([x for x in os.listdir(self.tmpdir)
+                          if x.endswith('.csv')], [])
+
+    def test_multi_table_jobs(self):
+        "Test loading several tables from single reads of the catalogs."
+        self.connection.apply('''create table FluxTable
+                                 (objectId BIGINT, flux DOUBLE)''')
+        flux_mapping = OrderedDict((('objectId', 'id'), ('flux', 'flux')))
+        jobs = [pserv_pipeline.MultiTableJob(
+            job.name, job.fits_file,
+            [pserv_pipeline.TableTarget('ForcedSource', self.column_mapping),
+             pserv_pipeline.TableTarget('FluxTable', flux_mapping)])
+                for job in self.jobs[:3]]
+        jobs.extend(self.jobs[3:])
+        loaded = []
+        failures = pserv_pipeline.ingest_pipelined(
+            self.connection, jobs, processes=2, output_dir=self.tmpdir,
+            on_loaded=lambda job, table_name, nrows:
+            loaded.append((job.name, table_name, nrows)))
+        self.assertEqual(len(failures), 0)
+        self.assertEqual(len(loaded), 8)
+        self.assertEqual(
+            sorted(x[:2] for x in loaded if x[1] == 'FluxTable'),
+            [(job.name, 'FluxTable') for job in self.jobs[:3]])
+        self.assertTrue(all(x[2] == 3 for x in loaded))
+        self.assertEqual(len(self.connection.rows('ForcedSource')), 15)
+        rows = self.connection.rows('FluxTable')
+        self.assertEqual(sorted(int(row[0]) for row in rows),
+                         [10*i + j for i in range(3) for j in range(3)])
+        self.assertTrue(all(float(row[0]) == float(row[1]) for row in rows))
+        self.assertEqual([x for x in os.listdir(self.tmpdir)
+                          if x.endswith('.csv')], [])
+
+    def test_convert_catalogs(self):
+        "Test the conversion of catalogs by a pool of processes."
+        missing_file = os.path.join(self.tmpdir, 'missing.fits')
+        output = os.path.join(self.tmpdir, 'catalog_0.csv')
+        jobs = [pserv_pipeline.ConversionJob(job.fits_file,
+                                             self.column_mapping)
+                for job in self.jobs]
+        jobs[0] = jobs[0]._replace(output=output)
+        jobs.append(pserv_pipeline.ConversionJob(missing_file))
+        results = list(pserv_pipeline.convert_catalogs(
+            jobs, processes=3, output_dir=self.tmpdir))
+        self.assertEqual(len(results), len(jobs))
+        self.assertEqual(len(set(result.output for result in results)),
+                         len(jobs))
+        for result in results:
+            if result.job.fits_file == missing_file:
+                self.assertIsNotNone(result.error)
+                self.assertFalse(os.path.exists(result.output))
+                continue
+            self.assertIsNone(result.error)
+            self.assertEqual(self.connection.load_csv('ForcedSource',
+                                                      result.output), 3)
+        self.assertIn(output, [result.output for result in results])
+        self.assertEqual(len(self.connection.rows('ForcedSource')), 15)
+        self.assertRaises(RuntimeError, list,
+                          pserv_pipeline.convert_catalogs(2*jobs[:1]))
+
+    def test_convert_catalogs_backpressure(self):
+        "Test that unconsumed conversions are bounded and cleaned up."
+        output_dir = os.path.join(self.tmpdir, 'csv')
+        os.mkdir(output_dir)
+        jobs = [pserv_pipeline.ConversionJob(job.fits_file,
+                                             self.column_mapping)
+                for job in self.jobs]
+        results = pserv_pipeline.convert_catalogs(jobs, processes=2,
+                                                  output_dir=output_dir,
+                                                  queue_depth=0)
+        first = next(results)
+        # Only the conversions that fit in the processes + queue_depth
+        # slots have been started.
+        self.assertLessEqual(len(os.listdir(output_dir)), 2)
+        results.close()
+        # Only the consumed result is left.
+        self.assertEqual(os.listdir(output_dir),
+                         [os.path.basename(first.output)])
+
+    def test_load_in_parallel(self):
+        "Test loading csv files and csv text with several connections."
+        jobs = []
+        for i, job in enumerate(self.jobs):
+            if i % 2 == 0:
+                csv_file = os.path.join(self.tmpdir, 'catalog_%i.csv' % i)
+                desc.pserv.create_csv_file_from_fits(
+                    job.fits_file, 1, csv_file,
+                    column_mapping=self.column_mapping)
+                source = csv_file
+            else:
+                source = desc.pserv.csv_text_from_fits(
+                    job.fits_file, 1, column_mapping=self.column_mapping)
+            jobs.append(pserv_pipeline.LoadJob(job.name, 'ForcedSource',
+                                               source))
+        jobs.append(pserv_pipeline.LoadJob('bad table', 'NoSuchTable',
+                                           jobs[0].source))
+        report = pserv_pipeline.load_in_parallel(self.connection, jobs,
+                                                 num_connections=3)
+        self.assertEqual(list(report.failures.keys()), ['bad table'])
+        self.assertEqual(len(report.loaded), 5)
+        self.assertEqual(report.nrows, 15)
+        self.assertEqual(len(self.connection.rows('ForcedSource')), 15)
+        self.assertTrue(report.rows_per_second > 0)
+
+if __name__ == '__main__':
+    unittest.main()
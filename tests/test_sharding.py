@@ -0,0 +1,151 @@
+"""
+Unit tests for the sharding module.
+"""
+from __future__ import absolute_import, print_function
+import os
+import imp
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from collections import OrderedDict
+from warnings import filterwarnings
+import numpy as np
+import desc.pserv.sharding as pserv_sharding
+import desc.pserv.utils as pserv_utils
+from sqlite_stand_in import SQLiteConnection, create_table, write_catalog, \
+    write_table
+
+filterwarnings('ignore')
+
+_load_db = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'bin', 'load_db.py')
+
+def _ingest_worker(lock_file, catalogs, db_file, results_dir, shard):
+    """
+    Ingest the forced source catalogs claimed from a WorkQueue with
+    load_db.ingest_forced_catalogs and write the results.  The workers
+    share the working directory in which the csv files are written.
+    """
+    load_db = imp.load_source('load_db', _load_db)
+    os.chdir(os.path.dirname(lock_file))
+    connection = SQLiteConnection(db_file)
+    loaded = OrderedDict()
+    failures = load_db.ingest_forced_catalogs(
+        connection, None, 'Twinkles',
+        catalogs=pserv_sharding.WorkQueue(lock_file, catalogs),
+        loaded=loaded)
+    pserv_sharding.write_shard_results(results_dir, shard, loaded, failures)
+
+class ShardingTestCase(unittest.TestCase):
+    "TestCase for the sharding module."
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_select_shard(self):
+        "Test the partitioning of a work list into balanced shards."
+        sizes = [3, 10, 1, 7, 7, 2, 9, 4, 5, 8, 6, 2]
+        items = ['catalog_%i' % i for i in range(len(sizes))]
+        ordered_items, ordered_sizes \
+            = pserv_sharding.order_by_size(items, sizes)
+        self.assertEqual(ordered_sizes, sorted(sizes, reverse=True))
+        # Ties keep their original order.
+        self.assertEqual(ordered_items[3:5], ['catalog_3', 'catalog_4'])
+        num_shards = 3
+        shards = [pserv_sharding.select_shard(items, sizes, i, num_shards)
+                  for i in range(num_shards)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(items))
+        totals = [sum(sizes[items.index(x)] for x in shard)
+                  for shard in shards]
+        self.assertLessEqual(max(totals) - min(totals), max(sizes))
+        self.assertEqual(pserv_sharding.assign_shards(sizes, num_shards),
+                         pserv_sharding.assign_shards(sizes, num_shards))
+        self.assertRaises(ValueError, pserv_sharding.select_shard,
+                          items, sizes, num_shards, num_shards)
+
+    def test_file_sizes(self):
+        "Test the file sizes used to order the work list."
+        catalog = os.path.join(self.tmpdir, 'catalog.fits')
+        write_catalog(catalog, range(10))
+        missing = os.path.join(self.tmpdir, 'missing.fits')
+        self.assertEqual(pserv_sharding.file_sizes([catalog, missing]),
+                         [os.path.getsize(catalog), 0])
+
+    def test_work_queue(self):
+        "Test concurrent ingest by processes claiming from a WorkQueue."
+        db_file = os.path.join(self.tmpdir, 'test.db')
+        connection = SQLiteConnection(db_file)
+        create_table(connection, 'CcdVisit')
+        create_table(connection, 'ForcedSource')
+        catalogs = []
+        for i in range(12):
+            ccdVisitId = pserv_utils.make_ccdVisitId(i, '2,2', '1,1')
+            catalog_file = os.path.join(self.tmpdir, 'catalog_%i.fits' % i)
+            catalogs.append(('v%i-fr' % i, '2,2', '1,1', ccdVisitId,
+                             catalog_file))
+            if i == 11:
+                # A catalog without a zero point in CcdVisit.
+                continue
+            connection.apply_many("""insert into CcdVisit
+                                     (ccdVisitId, zeroPoint, project)
+                                     values (%s, %s, %s)""",
+                                  [(ccdVisitId, 1e10, 'Twinkles')])
+            if i == 10:
+                # A missing catalog file.
+                continue
+            nobjs = i + 1
+            write_table(catalog_file, OrderedDict(
+                (('objectId', np.arange(100*i, 100*i + nobjs)),
+                 ('base_PsfFlux_flux', np.ones(nobjs)),
+                 ('base_PsfFlux_fluxSigma', np.ones(nobjs)/10.))))
+        catalogs, _ = pserv_sharding.order_by_size(
+            catalogs, pserv_sharding.file_sizes([x[-1] for x in catalogs]))
+        lock_file = os.path.join(self.tmpdir, 'work_queue.lock')
+        results_dir = os.path.join(self.tmpdir, 'results')
+        workers = [multiprocessing.Process(target=_ingest_worker,
+                                           args=(lock_file, catalogs,
+                                                 db_file, results_dir, i))
+                   for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        loaded, failures, shards \
+            = pserv_sharding.merge_shard_results(results_dir)
+        self.assertEqual(sorted(shards), ['0', '1', '2'])
+        catalog_files = sorted(x[-1] for x in catalogs)
+        self.assertEqual(sorted(failures.keys()), catalog_files[2:4])
+        self.assertEqual(sorted(loaded.keys()),
+                         catalog_files[:2] + catalog_files[4:])
+        # Each catalog was loaded exactly once.
+        rows = connection.rows('ForcedSource')
+        self.assertEqual(len(rows), sum(range(1, 11)))
+        self.assertEqual(sum(x['ForcedSource'] for x in loaded.values()),
+                         len(rows))
+        # The csv files written by the workers have been removed.
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         sorted([os.path.basename(x) for x in catalog_files
+                                 if os.path.exists(x)]
+                                + ['results', 'test.db', 'work_queue.lock']))
+        # All of the items have been claimed.
+        self.assertEqual(list(pserv_sharding.WorkQueue(lock_file,
+                                                       catalogs)), [])
+
+    def test_merge_shard_results(self):
+        "Test that catalogs loaded on a rerun are not reported as failed."
+        pserv_sharding.write_shard_results(
+            self.tmpdir, 0, {'a': 3}, {'b': RuntimeError('bad catalog')})
+        pserv_sharding.write_shard_results(self.tmpdir, 1, {'b': 5}, {})
+        pserv_sharding.write_shard_results(self.tmpdir, 2, {},
+                                           {'c': 'missing'})
+        loaded, failures, shards \
+            = pserv_sharding.merge_shard_results(self.tmpdir)
+        self.assertEqual(shards, ['0', '1', '2'])
+        self.assertEqual(dict(loaded), {'a': 3, 'b': 5})
+        self.assertEqual(dict(failures), {'c': 'missing'})
+
+if __name__ == '__main__':
+    unittest.main()
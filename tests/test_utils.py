@@ -0,0 +1,313 @@
+"""
+Unit tests for the utils module.
+"""
+from __future__ import absolute_import, print_function
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from warnings import filterwarnings
+import numpy as np
+import desc.pserv.utils as pserv_utils
+from sqlite_stand_in import SQLiteConnection, create_table, write_table
+
+filterwarnings('ignore')
+
+class FluxCalibratorTestCase(unittest.TestCase):
+    "TestCase for the FluxCalibrator class."
+    def setUp(self):
+        np.random.seed(42)
+        self.nrows = 20
+        self.zeroPoint = 3.4e12
+        self.fluxes = np.random.normal(1e3, 1e2, size=self.nrows)
+
+    def tearDown(self):
+        pass
+
+    def test_call(self):
+        "Test the conversion of scalars and arrays."
+        calibrator = pserv_utils.FluxCalibrator(self.zeroPoint)
+        self.assertEqual(calibrator(self.fluxes[0]),
+                         calibrator.get_nanomaggies(self.fluxes[0]))
+        for fluxes in (self.fluxes, self.fluxes.astype(np.float32),
+                       self.fluxes.tolist()):
+            expected = [calibrator.get_nanomaggies(float(x)) for x in fluxes]
+            nanomaggies = calibrator(fluxes)
+            self.assertEqual(nanomaggies.dtype, np.float64)
+            self.assertEqual(nanomaggies.tolist(), expected)
+        # The input array is not modified.
+        fluxes = self.fluxes.copy()
+        calibrator(fluxes)
+        np.testing.assert_array_equal(fluxes, self.fluxes)
+
+    def test_per_row_zero_points(self):
+        "Test calibration with an array of zero points."
+        zeroPoints = np.random.uniform(1e12, 1e13, size=self.nrows)
+        calibrator = pserv_utils.FluxCalibrator(zeroPoints)
+        expected = [pserv_utils.FluxCalibrator(zp).get_nanomaggies(flux)
+                    for flux, zp in zip(self.fluxes, zeroPoints)]
+        np.testing.assert_array_equal(calibrator(self.fluxes), expected)
+
+    def test_calibrate_columns(self):
+        "Test the calibration of all of the flux columns of a catalog."
+        calibrator = pserv_utils.FluxCalibrator(self.zeroPoint)
+        columns = OrderedDict((('objectId', np.arange(self.nrows)),
+                               ('base_PsfFlux_flux', self.fluxes),
+                               ('base_PsfFlux_fluxSigma', self.fluxes/10.)))
+        self.assertEqual(calibrator.calibrate_columns(columns),
+                         ['base_PsfFlux_flux', 'base_PsfFlux_fluxSigma'])
+        np.testing.assert_array_equal(columns['objectId'],
+                                      np.arange(self.nrows))
+        np.testing.assert_array_equal(columns['base_PsfFlux_flux'],
+                                      calibrator(self.fluxes))
+        np.testing.assert_array_equal(columns['base_PsfFlux_fluxSigma'],
+                                      calibrator(self.fluxes/10.))
+
+    def test_callbacks(self):
+        "Test the callbacks for the flux columns of a column mapping."
+        calibrator = pserv_utils.FluxCalibrator(self.zeroPoint)
+        column_mapping = OrderedDict(
+            (('objectId', 'objectId'), ('ccdVisitId', 22101234),
+             ('ap_3_0_Flux', 'base_CircularApertureFlux_3_0_flux'),
+             ('ap_3_0_Flux_Sigma', 'base_CircularApertureFlux_3_0_fluxSigma'),
+             ('project', 'my project')))
+        callbacks = calibrator.callbacks(column_mapping.values())
+        self.assertEqual(sorted(callbacks.keys()),
+                         ['base_CircularApertureFlux_3_0_flux',
+                          'base_CircularApertureFlux_3_0_fluxSigma'])
+        self.assertTrue(all(x is calibrator for x in callbacks.values()))
+
+class ZeroPointLookupTestCase(unittest.TestCase):
+    "TestCase for the ZeroPointLookup class."
+    def setUp(self):
+        self.connection = SQLiteConnection()
+        self.connection.apply('''create table CcdVisit
+                                 (ccdVisitId BIGINT, zeroPoint FLOAT,
+                                  project CHAR(30))''')
+        rows = [(2211000100, 3.4e12, 'Twinkles'),
+                (2211000101, None, 'Twinkles'),
+                (2211000102, 5.6e12, 'other project')]
+        self.connection.apply_many('insert into CcdVisit values (%s, %s, %s)',
+                                   rows)
+
+    def test_lookup(self):
+        "Test the zero points and FluxCalibrators for a project."
+        zero_points = pserv_utils.ZeroPointLookup(self.connection, 'Twinkles')
+        self.assertEqual(len(zero_points), 1)
+        self.assertIn(2211000100, zero_points)
+        self.assertEqual(zero_points[2211000100], 3.4e12)
+        self.assertEqual(zero_points.calibrator(2211000100).zeroPoint, 3.4e12)
+        for ccdVisitId in (2211000101, 2211000102, 2211000103):
+            self.assertNotIn(ccdVisitId, zero_points)
+            self.assertIsNone(zero_points.calibrator(ccdVisitId))
+            self.assertRaises(KeyError, zero_points.__getitem__, ccdVisitId)
+
+class CcdVisitIdTestCase(unittest.TestCase):
+    "TestCase for the ccdVisitId functions."
+    def test_make_ccdVisitIds(self):
+        "Test that the array version matches make_ccdVisitId."
+        np.random.seed(1234)
+        locations = ['%i,%i' % (i, j) for i in range(5) for j in range(5)]
+        visits = np.random.randint(0, 10**7, size=100)
+        visits[:2] = (0, 10**7 - 1)
+        rafts = np.random.choice(locations, size=len(visits))
+        sensors = np.random.choice(locations, size=len(visits))
+        expected = [pserv_utils.make_ccdVisitId(*x)
+                    for x in zip(visits, rafts, sensors)]
+        ccdVisitIds = pserv_utils.make_ccdVisitIds(visits, rafts, sensors)
+        self.assertEqual(ccdVisitIds.dtype, np.int64)
+        self.assertEqual(ccdVisitIds.tolist(), expected)
+        self.assertEqual(pserv_utils.make_ccdVisitIds(visits, '2,2',
+                                                      '1,0').tolist(),
+                         [pserv_utils.make_ccdVisitId(visit, '2,2', '1,0')
+                          for visit in visits])
+        self.assertEqual(pserv_utils.make_ccdVisitIds(
+            visits[:3].tolist(), rafts[:3].tolist(), sensors[:3].tolist()
+        ).tolist(), expected[:3])
+        for args in ((10**7, '2,2', '1,1'), (-1, '2,2', '1,1'),
+                     (1, 'R22', '1,1'), (1, '2,2', '')):
+            self.assertRaises(ValueError, pserv_utils.make_ccdVisitIds,
+                              *args)
+
+    def test_decode_ccdVisitIds(self):
+        "Test the recovery of visits, rafts, and sensors."
+        visits = np.array([0, 1, 230, 9999999])
+        rafts = np.array(['0,1', '2,2', '4,3', '1,0'])
+        sensors = np.array(['2,2', '0,0', '1,2', '2,1'])
+        ccdVisitIds = pserv_utils.make_ccdVisitIds(visits, rafts, sensors)
+        decoded = pserv_utils.decode_ccdVisitIds(ccdVisitIds)
+        self.assertEqual(decoded[0].tolist(), visits.tolist())
+        self.assertEqual(decoded[1].tolist(), rafts.tolist())
+        self.assertEqual(decoded[2].tolist(), sensors.tolist())
+        visit, raft, sensor = pserv_utils.decode_ccdVisitIds(
+            pserv_utils.make_ccdVisitId(1234, '2,2', '1,1'))
+        self.assertEqual((int(visit), str(raft), str(sensor)),
+                         (1234, '2,2', '1,1'))
+        self.assertRaises(ValueError, pserv_utils.decode_ccdVisitIds, [-1])
+
+class IngestObjectDataTestCase(unittest.TestCase):
+    "TestCase for ingest_Object_data."
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.catalog = os.path.join(self.tmpdir, 'merged_coadd.fits')
+        self.connection = SQLiteConnection()
+        create_table(self.connection, 'Object')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write_catalog(self, ids, parents, ra, dec, extendedness):
+        "Write a merged coadd catalog with coordinates in radians."
+        if os.path.exists(self.catalog):
+            os.remove(self.catalog)
+        write_table(self.catalog, OrderedDict(
+            (('id', np.array(ids)), ('parent', np.array(parents)),
+             ('coord_ra', np.radians(ra)), ('coord_dec', np.radians(dec)),
+             ('base_ClassificationExtendedness_value',
+              np.array(extendedness, dtype=float)))))
+
+    def _objects(self):
+        "Return the Object rows loaded from the test catalogs."
+        return self.connection.apply(
+            """select objectId, parentObjectId, psRa, psDecl, extendedness,
+               project from Object order by project, objectId""",
+            lambda curs: curs.fetchall())
+
+    def test_ingest_Object_data(self):
+        "Test the converted rows and the update of existing objects."
+        self._write_catalog([10, 11, 12], [0, 10, 10], [53., 53.5, 54.],
+                            [-27., -27.5, -28.], [0., 1., np.nan])
+        self.assertEqual(pserv_utils.ingest_Object_data(
+            self.connection, self.catalog, 'Twinkles'), 3)
+        objects = self._objects()
+        self.assertEqual([row[:2] for row in objects],
+                         [(10, 0), (11, 10), (12, 10)])
+        np.testing.assert_allclose([row[2] for row in objects],
+                                   [53., 53.5, 54.])
+        np.testing.assert_allclose([row[3] for row in objects],
+                                   [-27., -27.5, -28.])
+        # NaN extendedness values are set to 1.
+        self.assertEqual([row[4] for row in objects], [0., 1., 1.])
+        self.assertTrue(all(row[5] == 'Twinkles' for row in objects))
+
+        # Re-ingesting updates the coordinates and extendedness of
+        # existing objects, keeps their parents, and adds new objects.
+        self._write_catalog([11, 12, 13], [0, 0, 11], [60., 61., 62.],
+                            [-30., -31., -32.], [0., 0., 1.])
+        pserv_utils.ingest_Object_data(self.connection, self.catalog,
+                                       'Twinkles')
+        objects = self._objects()
+        self.assertEqual([row[:2] for row in objects],
+                         [(10, 0), (11, 10), (12, 10), (13, 11)])
+        np.testing.assert_allclose([row[2] for row in objects],
+                                   [53., 60., 61., 62.])
+        np.testing.assert_allclose([row[3] for row in objects],
+                                   [-27., -30., -31., -32.])
+        self.assertEqual([row[4] for row in objects], [0., 0., 0., 1.])
+
+        # Objects with the same ids in other projects are kept apart.
+        pserv_utils.ingest_Object_data(self.connection, self.catalog,
+                                       'other project')
+        self.assertEqual(len(self._objects()), 7)
+
+class IngestRegistryTestCase(unittest.TestCase):
+    "TestCase for ingest_registry."
+    def setUp(self):
+        self.registry_file = os.path.join(os.path.dirname(__file__),
+                                          'image_repo', 'registry.sqlite3')
+        self.connection = SQLiteConnection()
+        create_table(self.connection, 'CcdVisit')
+
+    def _ccd_visits(self):
+        "Return the CcdVisit columns filled from the registry."
+        return self.connection.apply(
+            """select ccdVisitId, visitId, ccdName, raftName, filterName,
+               obsStart, project, zeroPoint from CcdVisit
+               order by ccdVisitId""", lambda curs: curs.fetchall())
+
+    def test_ingest_registry(self):
+        "Test the CcdVisit rows made from the registry raw table."
+        pserv_utils.ingest_registry(self.connection, self.registry_file,
+                                    'p', batch_size=10)
+        rows = self._ccd_visits()
+        self.assertEqual(len(rows), 45)
+        self.assertEqual(rows[0], (22000921297, 921297, '0,0', '2,2', 'r',
+                                   '2025-09-16T06:55:27.240001', 'p', None))
+        self.assertEqual(sorted(set(row[1] for row in rows)),
+                         [921297, 1414156, 1648025, 1668469, 1973403])
+        for row in rows:
+            self.assertEqual(row[0],
+                             pserv_utils.make_ccdVisitId(row[1], row[3],
+                                                         row[2]))
+        # Ingesting again updates the rows without changing the
+        # columns that are not filled from the registry.
+        self.connection.apply('update CcdVisit set zeroPoint=1e12, '
+                              "filterName='x'")
+        pserv_utils.ingest_registry(self.connection, self.registry_file, 'p')
+        self.assertEqual(self._ccd_visits(),
+                         [row[:-1] + (1e12,) for row in rows])
+
+class UpdateCcdVisitStatsTestCase(unittest.TestCase):
+    "TestCase for the join-update of the CcdVisit statistics."
+    def setUp(self):
+        self.connection = SQLiteConnection()
+        create_table(self.connection, 'CcdVisit')
+        self.connection.apply_many(
+            """insert into CcdVisit (ccdVisitId, skyNoise, project)
+               values (%s, %s, %s)""",
+            [(1, 5., 'Twinkles'), (2, 5., 'Twinkles'), (3, 5., 'Twinkles'),
+             (1, 5., 'other project')])
+
+    def _stats(self, project='Twinkles'):
+        "Return the statistics columns for a project."
+        return self.connection.apply(
+            """select ccdVisitId, zeroPoint, seeing, skyBg, skyNoise
+               from CcdVisit where project='%s' order by ccdVisitId"""
+            % project, lambda curs: curs.fetchall())
+
+    def test_update_CcdVisit_stats(self):
+        "Test the update of the statistics columns of a project."
+        rows = [(1, 1e12, 0.5, 100., None), (2, 2e12, np.nan, 200., 3.),
+                (4, 4e12, 0.5, 400., 4.)]
+        pserv_utils._update_CcdVisit_stats(self.connection, rows,
+                                           'Twinkles', batch_size=2)
+        # Null skyNoise values keep the existing values, and nan
+        # values are stored as NULL.  Rows without a match in
+        # CcdVisit are ignored.
+        self.assertEqual(self._stats(),
+                         [(1, 1e12, 0.5, 100., 5.), (2, 2e12, None, 200., 3.),
+                          (3, None, None, None, 5.)])
+        self.assertEqual(self._stats('other project'),
+                         [(1, None, None, None, 5.)])
+        # The temporary table is dropped after each update.
+        self.assertEqual(
+            self.connection.get_table_schema('CcdVisit_stats'), ())
+        pserv_utils._update_CcdVisit_stats(self.connection, rows[1:2],
+                                           'other project')
+        self.assertEqual(self._stats('other project'),
+                         [(1, None, None, None, 5.)])
+        pserv_utils._update_CcdVisit_stats(self.connection,
+                                           [(1, 3e12, 0.7, 300., None)],
+                                           'other project')
+        self.assertEqual(self._stats('other project'),
+                         [(1, 3e12, 0.7, 300., 5.)])
+        self.assertEqual(self._stats()[0], (1, 1e12, 0.5, 100., 5.))
+
+class ClippedStdTestCase(unittest.TestCase):
+    "TestCase for the clipped standard deviation used for skyNoise."
+    def test_clipped_std(self):
+        "Test that outliers and non-finite values are rejected."
+        np.random.seed(1)
+        sigma = 5.
+        image = np.random.normal(100., sigma, size=(400, 400))
+        image[::50, ::50] = 1e5
+        image[1, :10] = np.nan
+        std = pserv_utils._clipped_std(image)
+        self.assertLess(abs(std - sigma)/sigma, 0.05)
+        subsampled = pserv_utils._clipped_std(image[::4, ::4])
+        self.assertLess(abs(subsampled - sigma)/sigma, 0.05)
+        self.assertTrue(np.isnan(pserv_utils._clipped_std([1.])))
+
+if __name__ == '__main__':
+    unittest.main()